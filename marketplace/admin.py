@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import Category, Post, PostMedia, Response
+from django.contrib.admin.views.main import ORDER_VAR
+from .models import Category, Post, PostMedia, Response, OutgoingEmail, Profile
+from .search import get_search_backend
 
 class PostMediaInline(admin.TabularInline):
     model = PostMedia
@@ -25,9 +27,34 @@ class CategoryAdmin(admin.ModelAdmin):
 
 @admin.register(Post)
 class PostAdmin(admin.ModelAdmin):
-    list_display = ['author', 'category', 'title', 'price', 'type_post', 'is_active', 'updated_at']
+    list_display = ['author', 'category', 'title', 'price', 'type_post', 'is_active', 'updated_at',
+                    'response_count']
     list_filter = ['category', 'type_post', 'is_active', 'updated_at']
-    #search_fields = ['category', 'author', 'type_post']
+    search_fields = ['title', 'content']
     list_editable = ['price', 'is_active']
     prepopulated_fields = {'slug': ('title',)}
-    inlines = [PostMediaInline, ResponseInline]
\ No newline at end of file
+    inlines = [PostMediaInline, ResponseInline]
+
+    def get_search_results(self, request, queryset, search_term):
+        # Поиск через полнотекстовый индекс вместо icontains по полям
+        if not search_term:
+            return queryset, False
+        # ChangeList сортирует до поиска: сортировку по столбцу (параметр "o")
+        # сохраняем, иначе первой идёт релевантность, затем порядок админки
+        ordering = queryset.query.order_by
+        results = get_search_backend().apply(queryset, search_term)
+        if request.GET.get(ORDER_VAR):
+            return results.order_by(*ordering), False
+        return results.order_by(*results.query.order_by, *ordering), False
+
+
+@admin.register(OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'status', 'attempts', 'created_at', 'sent_at']
+    list_filter = ['status']
+    readonly_fields = ['attempts', 'last_error', 'created_at', 'sent_at']
+
+@admin.register(Profile)
+class ProfileAdmin(admin.ModelAdmin):
+    list_display = ['user', 'post_count', 'digest_notifications', 'digest_sent_at']
+    readonly_fields = ['post_count', 'digest_sent_at']
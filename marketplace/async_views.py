@@ -0,0 +1,137 @@
+"""
+Async-варианты страниц с основной нагрузкой на чтение.
+
+Под ASGI синхронное представление целиком уходит в пул потоков
+(sync_to_async), и число одновременных запросов ограничено этим пулом.
+Здесь все обращения к БД идут через async ORM (aget, acount, async for),
+а контекст шаблона собирается из уже загруженных объектов, поэтому
+рендер не делает ленивых запросов. Подключаются в urls.py настройкой
+MARKETPLACE_ASYNC_VIEWS.
+"""
+import inspect
+
+from asgiref.sync import sync_to_async
+from django.core.paginator import InvalidPage
+from django.http import Http404
+
+from .caching import AsyncAnonymousListingCacheMixin, cached_categories, render_post_cards
+from .facets import cached_facet_rows
+from .models import Post
+from .pagination import apaginate
+from .views import PostView, PostDetailView, ResponseListView
+
+
+class AsyncUserMixin:
+    """
+    Загружает пользователя через request.auser() до синхронных проверок
+    (LoginRequiredMixin, кэш ленты), которые читают request.user.
+    """
+    async def dispatch(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        response = super().dispatch(request, *args, **kwargs)
+        if inspect.isawaitable(response):
+            response = await response
+        return response
+
+
+class AsyncListMixin:
+    """
+    async get() для ListView: страница выбирается заранее,
+    а get_context_data получает её через paginate_queryset.
+    """
+    async def get(self, request, *args, **kwargs):
+        self.object_list = self.get_queryset()
+        await self.aprepare()
+        page_size = self.get_paginate_by(self.object_list)
+        self._paginated = None
+        if page_size:
+            self._paginated = await self.apaginate_queryset(self.object_list, page_size)
+        context = self.get_context_data()
+        return self.render_to_response(context)
+
+    async def aprepare(self):
+        """Загрузка остальных данных контекста до рендера"""
+
+    async def apaginate_queryset(self, queryset, page_size):
+        if getattr(self, 'use_cursor_pagination', lambda: False)():
+            paginator = self.get_cursor_paginator(queryset, page_size)
+            page = await paginator.apage(self.request.GET.get(self.cursor_kwarg))
+            return paginator, page, page.object_list, page.has_other_pages()
+
+        paginator = self.get_paginator(
+            queryset, page_size, orphans=self.get_paginate_orphans(),
+            allow_empty_first_page=self.get_allow_empty(),
+        )
+        page_kwarg = self.page_kwarg
+        page = self.kwargs.get(page_kwarg) or self.request.GET.get(page_kwarg) or 1
+        try:
+            page_number = int(page)
+        except ValueError:
+            if page != 'last':
+                raise Http404('Номер страницы должен быть числом')
+            if 'count' not in paginator.__dict__:
+                paginator.count = await queryset.acount()
+            page_number = paginator.num_pages
+        try:
+            page = await apaginate(paginator, page_number)
+        except InvalidPage as e:
+            raise Http404(f'Неверная страница ({page_number}): {e}')
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def paginate_queryset(self, queryset, page_size):
+        return self._paginated
+
+
+class AsyncPostView(AsyncUserMixin, AsyncAnonymousListingCacheMixin, AsyncListMixin, PostView):
+    async def aprepare(self):
+        self._categories = await sync_to_async(cached_categories)()
+        self._facet_rows = await sync_to_async(cached_facet_rows)()
+
+    async def apaginate_queryset(self, queryset, page_size):
+        paginated = await super().apaginate_queryset(queryset, page_size)
+        # Обращения к кэшу карточек (в том числе DatabaseCache) - в потоке
+        self._post_cards = await sync_to_async(render_post_cards)(paginated[2])
+        return paginated
+
+    def get_categories(self):
+        return self._categories
+
+    def get_facet_rows(self):
+        return self._facet_rows
+
+    def get_post_cards(self, posts):
+        return self._post_cards
+
+
+class AsyncPostDetailView(AsyncUserMixin, PostDetailView):
+    async def get(self, request, *args, **kwargs):
+        state = await self.aget_page_state()
+        response = self.not_modified_response(request, state)
+        if response is not None:
+            return response
+        self.object = await self.aget_object()
+        self._responses = [response async for response in super().get_responses()]
+        context = self.get_context_data(object=self.object)
+        return self.patch_cache_headers(request, state, self.render_to_response(context))
+
+    async def aget_page_state(self):
+        state = await self.get_state_queryset().afirst()
+        if state is None:
+            raise Http404('Объявление не найдено')
+        return state
+
+    async def aget_object(self):
+        queryset = self.get_queryset()
+        try:
+            return await queryset.aget(**{self.get_slug_field(): self.kwargs[self.slug_url_kwarg]})
+        except Post.DoesNotExist:
+            raise Http404('Объявление не найдено')
+
+    def get_responses(self):
+        return self._responses
+
+
+class AsyncResponseListView(AsyncUserMixin, AsyncListMixin, ResponseListView):
+    async def aprepare(self):
+        # Список объявлений для фильтра и счётчики отзывов - одним запросом
+        self._user_posts = [post async for post in self.user_posts_queryset()]
@@ -0,0 +1,821 @@
+'''
+Воспроизводимые замеры производительности страниц маркетплейса.
+
+generate_data() наполняет базу синтетическими пользователями,
+категориями, объявлениями, медиафайлами и отзывами через bulk_create
+(сигналы не срабатывают, поэтому счётчики, фильтры и поисковый
+индекс заполняются здесь же). run_endpoints() замеряет задержку и число
+SQL-запросов каждой страницы через тестовый клиент, run_http() -
+пропускную способность по HTTP. compare() сравнивает результаты
+с сохранённым базовым файлом. run_write_stress() - конкурентные записи
+и чтения из потоков (проверка настроек SQLite), run_notification_benchmark() -
+письмо на каждый отзыв против сводок, run_media_benchmark() - отдача
+медиафайлов целиком и диапазонами при разных способах передачи,
+run_card_benchmark() - рендер ленты с кэшем карточек и без него,
+run_search_benchmark() - первая страница поиска ленты,
+run_startup_profile() - первый и установившийся ответ страниц в профилях
+настроек (запускается в отдельном процессе командой bench_startup).
+'''
+import asyncio
+import copy
+import gzip
+import io
+import itertools
+import os
+import random
+import shutil
+import socket
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core import mail
+from django.db import (DEFAULT_DB_ALIAS, OperationalError, connection, connections,
+                       transaction)
+from django.test import Client, RequestFactory
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext, modify_settings, override_settings
+from django.urls import reverse
+
+from . import digests, facets
+from .caching import bump_listing_version, post_card_cache_key, render_post_cards
+from .loaddriver import Target, raise_file_limit, run_target, summarize
+from .media_serving import RangeNotSatisfiable, parse_range
+from .outbox import process_outbox
+from .models import Category, PendingNotification, Post, PostMedia, Profile, Response
+from .search import get_search_backend
+
+VOCABULARY = (
+    'продам куплю золото меч легендарный доспехи щит кольцо амулет зелье '
+    'аккаунт персонаж прокачка рейд подземелье маунт питомец скин оружие '
+    'лук посох кинжал броня шлем перчатки сапоги плащ руна самоцвет '
+    'эпический редкий уникальный быстро дешево недорого срочно обмен '
+    'gold wow lineage eve dota account boost raid mount'
+).split()
+
+BENCH_PASSWORD = 'bench'
+
+
+def _words(rng, low, high):
+    return ' '.join(rng.choices(VOCABULARY, k=rng.randint(low, high)))
+
+
+def generate_data(users=100, categories=10, posts=1000, media_per_post=1, responses_per_post=2,
+                  seed=42, batch_size=5000, log=None):
+    '''
+    Синтетические данные. Объявления пишутся пачками по batch_size вместе
+    с их медиафайлами и отзывами, счётчики считаются заранее.
+    Возвращает словарь с числом созданных объектов.
+    '''
+    rng = random.Random(seed)
+    # Хеш пароля считается один раз - PBKDF2 на каждого пользователя слишком дорог
+    password = make_password(BENCH_PASSWORD)
+    responses_per_post = min(responses_per_post, max(users - 1, 0))
+
+    with transaction.atomic():
+        user_ids = []
+        for start in range(0, users, batch_size):
+            created = User.objects.bulk_create([
+                User(username=f'bench{n}', email=f'bench{n}@example.com', password=password)
+                for n in range(start, min(start + batch_size, users))
+            ])
+            user_ids.extend(user.pk for user in created)
+        category_ids = [category.pk for category in Category.objects.bulk_create([
+            Category(name=f'Категория {n}', slug=f'bench-category-{n}') for n in range(categories)
+        ])]
+
+    post_counts = dict.fromkeys(user_ids, 0)
+    totals = {'users': users, 'categories': categories, 'posts': 0, 'media': 0, 'responses': 0}
+    numbers = iter(range(posts))
+    while True:
+        chunk = list(itertools.islice(numbers, batch_size))
+        if not chunk:
+            break
+        with transaction.atomic():
+            batch = []
+            for n in chunk:
+                author = user_ids[n % len(user_ids)]
+                post_counts[author] += 1
+                media_count = rng.randint(0, media_per_post * 2) if media_per_post else 0
+                response_count = rng.randint(0, responses_per_post * 2)
+                response_count = min(response_count, len(user_ids) - 1)
+                batch.append(Post(
+                    author_id=author, category_id=rng.choice(category_ids),
+                    title=_words(rng, 3, 6).capitalize(), content=_words(rng, 20, 40),
+                    price=rng.randint(1, 100_000), type_post=rng.choice((Post.WTS, Post.WTB)),
+                    is_active=rng.random() > 0.1, slug=f'bench-{n}',
+                    media_count=media_count, response_count=response_count,
+                    accepted_response_count=response_count // 2,
+                ))
+            batch = Post.objects.bulk_create(batch)
+
+            media, responses = [], []
+            for n, post in zip(chunk, batch):
+                media.extend(
+                    PostMedia(post_id=post.pk, file=f'post_media/bench/{post.pk}-{i}.jpg')
+                    for i in range(post.media_count)
+                )
+                # Авторы отзывов - следующие за автором объявления пользователи,
+                # так пара (автор, объявление) не повторяется
+                responses.extend(
+                    Response(post_id=post.pk, author_id=user_ids[(n + 1 + i) % len(user_ids)],
+                             content=_words(rng, 5, 15), is_accepted=i < post.accepted_response_count)
+                    for i in range(post.response_count)
+                )
+            PostMedia.objects.bulk_create(media)
+            Response.objects.bulk_create(responses)
+
+        totals['posts'] += len(batch)
+        totals['media'] += len(media)
+        totals['responses'] += len(responses)
+        if log:
+            log(f'Объявлений: {totals["posts"]}/{posts}')
+
+    Profile.objects.bulk_create(
+        [Profile(user_id=pk, post_count=count) for pk, count in post_counts.items()],
+        batch_size=batch_size,
+    )
+    get_search_backend().rebuild(Post.objects.all())
+    facets.rebuild()
+    bump_listing_version()
+    return totals
+
+
+def default_endpoints():
+    '''Замеряемые страницы: имя, метод, путь, нужен ли вход, данные формы'''
+    post = (Post.objects.filter(is_active=True)
+            .order_by('-response_count', '-media_count', 'pk').first())
+    if post is None:
+        raise ValueError('Нет данных для замера: сначала generate_data()')
+    category = Category.objects.order_by('pk').first()
+    listing = reverse('post_list')
+    return post.author, [
+        ('post_list', 'get', listing, False, None),
+        ('post_list_filtered', 'get', f'{listing}?type_post=wts&price_min=100&price_max=50000',
+         False, None),
+        ('post_list_search', 'get', f'{listing}?q=золото', False, None),
+        ('post_list_last_page', 'get', f'{listing}?page=last', False, None),
+        ('post_detail', 'get', reverse('post_detail', args=[post.slug]), False, None),
+        ('create_post_form', 'get', reverse('create_post'), True, None),
+        ('create_post', 'post', reverse('create_post'), True,
+         lambda i: {'title': f'Замер {i}', 'type_post': Post.WTS, 'content': 'Продам золото',
+                    'price': 100, 'category': category.pk}),
+        ('response_list', 'get', reverse('response_list'), True, None),
+    ]
+
+
+def _timings_summary(timings):
+    timings = sorted(timings)
+    return {
+        'p50_ms': round(statistics.median(timings) * 1000, 2),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 2),
+        'mean_ms': round(statistics.fmean(timings) * 1000, 2),
+        'rps': round(len(timings) / sum(timings), 1),
+    }
+
+
+def run_endpoints(iterations=50, warmup=5, only=None):
+    '''Задержка и число SQL-запросов каждой страницы через тестовый клиент'''
+    user, endpoints = default_endpoints()
+    anonymous, logged_in = Client(), Client()
+    logged_in.force_login(user)
+    results = {}
+    counter = itertools.count()
+    for name, method, path, login, data in endpoints:
+        if only and name not in only:
+            continue
+        client = logged_in if login else anonymous
+
+        def request():
+            if method == 'post':
+                return client.post(path, data(next(counter)))
+            return client.get(path)
+
+        for _ in range(warmup):
+            request()
+        with CaptureQueriesContext(connection) as ctx:
+            response = request()
+        # Считаем сразу: следующие запросы очищают connection.queries
+        queries = len(ctx.captured_queries)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{name}: {path} вернул {response.status_code}')
+
+        timings = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            request()
+            timings.append(time.perf_counter() - started)
+        results[name] = {'path': path, 'status': response.status_code,
+                         'queries': queries, **_timings_summary(timings)}
+    return results
+
+
+def run_http(paths, concurrency=32, duration=5.0, warmup=1.0, timeout=10.0):
+    '''
+    Пропускная способность по HTTP: поднимает в процессе многопоточный
+    WSGI-сервер (как LiveServerTestCase) и нагружает его loaddriver'ом.
+    '''
+    from django.test.testcases import LiveServerThread
+
+    # Тестовая БД SQLite в памяти доступна только через общее соединение
+    shared = {}
+    conn = connections[DEFAULT_DB_ALIAS]
+    if conn.vendor == 'sqlite' and conn.is_in_memory_db():
+        conn.inc_thread_sharing()
+        shared = {DEFAULT_DB_ALIAS: conn}
+    server = LiveServerThread('127.0.0.1', lambda handler: handler,
+                              connections_override=shared or None)
+    server.daemon = True
+    server.start()
+    server.is_ready.wait()
+    if server.error:
+        raise server.error
+
+    raise_file_limit(concurrency)
+    results = {}
+    try:
+        with modify_settings(ALLOWED_HOSTS={'append': '127.0.0.1'}):
+            for name, path in paths.items():
+                target = Target(name, f'http://127.0.0.1:{server.port}', [path])
+                asyncio.run(run_target(target, concurrency, duration, warmup, timeout))
+                results[name] = summarize(target, duration)
+    finally:
+        server.terminate()
+        server.join()
+        if shared:
+            conn.dec_thread_sharing()
+    return results
+
+
+def compare(current, baseline, threshold=0.2):
+    '''
+    Список регрессий относительно базового файла: p95 выросла больше
+    чем на threshold, запросов к БД стало больше, HTTP rps упал больше
+    чем на threshold.
+    '''
+    problems = []
+    for name, base in baseline.get('endpoints', {}).items():
+        now = current.get('endpoints', {}).get(name)
+        if now is None:
+            problems.append(f'{name}: нет в текущих результатах')
+            continue
+        if now['p95_ms'] > base['p95_ms'] * (1 + threshold):
+            problems.append(f'{name}: p95 {now["p95_ms"]} мс, было {base["p95_ms"]} мс')
+        if now['queries'] > base['queries']:
+            problems.append(f'{name}: запросов {now["queries"]}, было {base["queries"]}')
+    for name, base in baseline.get('http', {}).items():
+        now = current.get('http', {}).get(name)
+        if now and now['rps'] < base['rps'] * (1 - threshold):
+            problems.append(f'{name} (HTTP): {now["rps"]} rps, было {base["rps"]}')
+    return problems
+
+
+def run_write_stress(writers=8, readers=8, duration=5.0):
+    '''
+    Писатели по очереди создают объявления и отзывы на чужие объявления,
+    читатели листают ленту - всё через тестовый клиент в отдельных потоках,
+    как в многопоточном WSGI-сервере. Нужны данные generate_data()
+    с пользователями bench0..bench{writers}. Ошибки "database is locked"
+    считаются отдельно от остальных.
+    '''
+    users = list(User.objects.filter(username__startswith='bench').order_by('pk')[:writers])
+    if len(users) < writers:
+        raise ValueError(f'Нужно не меньше {writers} пользователей bench*')
+    category = Category.objects.order_by('pk').first()
+    # Свежие объявления писателей - кандидаты для отзывов
+    posted = [(post.author_id, post.slug) for post in Post.objects.filter(author__in=users)[:200]]
+    lock = threading.Lock()
+    stats = {'write': [], 'read': [], 'locked': 0, 'errors': []}
+    clock = {}
+    # Замер начинается, когда все потоки готовы (пользователи уже вошли)
+    barrier = threading.Barrier(
+        writers + readers, action=lambda: clock.update(deadline=time.perf_counter() + duration),
+        timeout=60)
+
+    def record(kind, started):
+        with lock:
+            stats[kind].append(time.perf_counter() - started)
+
+    def run(operation):
+        while time.perf_counter() < clock['deadline']:
+            started = time.perf_counter()
+            try:
+                kind = operation()
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                with lock:
+                    stats['locked'] += 1
+                continue
+            record(kind, started)
+
+    def writer(user, n):
+        client = Client()
+        client.force_login(user)
+        responded = set()
+        counter = itertools.count()
+        barrier.wait()
+
+        def operation():
+            i = next(counter)
+            if i % 2 == 0:
+                response = client.post(reverse('create_post'), {
+                    'title': f'Нагрузка {n}-{i}', 'type_post': Post.WTS, 'content': '...',
+                    'price': i, 'category': category.pk,
+                })
+                with lock:
+                    posted.append((user.pk, response.url.rstrip('/').rsplit('/', 1)[-1]))
+                return 'write'
+            with lock:
+                slug = next((slug for author, slug in reversed(posted)
+                             if author != user.pk and slug not in responded), None)
+            if slug is None:
+                return 'write'
+            responded.add(slug)
+            client.post(reverse('add_response', args=[slug]), {'content': 'Беру'})
+            return 'write'
+
+        run(operation)
+
+    def reader(n):
+        client = Client()
+        paths = [reverse('post_list'), f'{reverse("post_list")}?type_post=wts',
+                 f'{reverse("post_list")}?category={category.pk}']
+        counter = itertools.count(n)
+        barrier.wait()
+
+        def operation():
+            response = client.get(paths[next(counter) % len(paths)])
+            if response.status_code != 200:
+                raise RuntimeError(f'Лента вернула {response.status_code}')
+            return 'read'
+
+        run(operation)
+
+    def thread(target, *args):
+        try:
+            target(*args)
+        except Exception as e:
+            barrier.abort()
+            with lock:
+                stats['errors'].append(repr(e))
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=thread, args=(writer, user, n))
+               for n, user in enumerate(users)]
+    threads += [threading.Thread(target=thread, args=(reader, n)) for n in range(readers)]
+    for worker in threads:
+        worker.start()
+    for worker in threads:
+        worker.join()
+
+    result = {'writers': writers, 'readers': readers, 'locked': stats['locked'],
+              'errors': stats['errors']}
+    for kind in ('write', 'read'):
+        timings = sorted(stats[kind])
+        result[f'{kind}s'] = len(timings)
+        result[f'{kind}s_per_s'] = round(len(timings) / duration, 1)
+        result[f'{kind}_p95_ms'] = (
+            round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 2)
+            if timings else None)
+    return result
+
+
+def _drain_outbox(batch_size, threads):
+    started = time.perf_counter()
+    sent = 0
+    while True:
+        done, failed = process_outbox(batch_size, threads)
+        if failed:
+            raise RuntimeError(f'Письма не отправлены: {failed}')
+        if not done:
+            return sent, time.perf_counter() - started
+        sent += done
+        # Тестовый бэкенд копит письма в памяти
+        mail.outbox.clear()
+
+
+def run_notification_benchmark(sample=2000, batch_size=500, threads=4):
+    '''
+    Все отзывы в базе (generate_data) становятся ожидающими уведомлениями.
+    Режим "письмо на отзыв" замеряется на sample отзывах - как CreateResponse:
+    рендер шаблона и письмо в outbox на каждый, режим сводок - на всех.
+    '''
+    from .views import CreateResponse
+
+    view = CreateResponse(request=RequestFactory().get('/'))
+    responses = list(Response.objects.select_related('author', 'post__author')
+                     .order_by('pk')[:sample])
+    started = time.perf_counter()
+    with transaction.atomic():
+        for response in responses:
+            view.send_notification_email(response)
+    enqueue_time = time.perf_counter() - started
+    sent, send_time = _drain_outbox(batch_size, threads)
+    per_response = {
+        'notifications': len(responses), 'emails': sent,
+        'enqueue_s': round(enqueue_time, 2), 'send_s': round(send_time, 2),
+        'notifications_per_s': round(len(responses) / (enqueue_time + send_time), 1),
+    }
+
+    Profile.objects.update(digest_notifications=True, digest_sent_at=None)
+    pending = Response.objects.values_list('pk', 'post__author_id').order_by('pk').iterator()
+    while chunk := list(itertools.islice(pending, 5000)):
+        PendingNotification.objects.bulk_create(
+            [PendingNotification(response_id=pk, recipient_id=author) for pk, author in chunk])
+    started = time.perf_counter()
+    digest_count, notifications = digests.process_digests(batch_size)
+    enqueue_time = time.perf_counter() - started
+    sent, send_time = _drain_outbox(batch_size, threads)
+    digest = {
+        'notifications': notifications, 'emails': sent,
+        'enqueue_s': round(enqueue_time, 2), 'send_s': round(send_time, 2),
+        'notifications_per_s': round(notifications / (enqueue_time + send_time), 1),
+    }
+    return {'per_response': per_response, 'digest': digest}
+
+
+CARD_MODES = ('uncached', 'cold', 'warm')
+
+
+def run_card_benchmark(page_sizes=(12, 48), iterations=200):
+    '''
+    Рендер карточек страницы ленты (render_post_cards) и всей страницы
+    PostView для анонимного пользователя при кэше ленты выключенном:
+      uncached - кэш карточек отключён, каждая карточка рендерится заново;
+      cold     - кэш пуст: рендер всех карточек и set_many;
+      warm     - все карточки читаются одним get_many.
+    '''
+    from .views import PostView
+
+    factory = RequestFactory()
+    results = {}
+    for size in page_sizes:
+        posts = list(Post.objects.filter(is_active=True).for_cards().order_by('-updated_at')[:size])
+        if len(posts) < size:
+            raise ValueError(f'Нужно не меньше {size} активных объявлений: сначала generate_data()')
+        keys = [post_card_cache_key(post) for post in posts]
+        view = PostView.as_view(paginate_by=size)
+
+        def page():
+            request = factory.get('/')
+            request.user = AnonymousUser()
+            response = view(request)
+            response.render()
+            return response
+
+        for mode in CARD_MODES:
+            timeout = 0 if mode == 'uncached' else 86400
+            with override_settings(MARKETPLACE_POST_CARD_CACHE_TIMEOUT=timeout,
+                                   MARKETPLACE_LISTING_CACHE_TIMEOUT=0):
+                page()
+                with CaptureQueriesContext(connection) as ctx:
+                    page()
+                timings = {'cards': [], 'page': []}
+                for _ in range(iterations):
+                    for kind, run in (('cards', lambda: render_post_cards(posts)), ('page', page)):
+                        if mode == 'cold':
+                            cache.delete_many(keys)
+                        started = time.perf_counter()
+                        run()
+                        timings[kind].append(time.perf_counter() - started)
+            results[f'{size}_{mode}'] = {
+                'cards': size, 'queries': len(ctx.captured_queries),
+                'cards_p50_ms': round(statistics.median(timings['cards']) * 1000, 3),
+                'page_p50_ms': round(statistics.median(timings['page']) * 1000, 3),
+            }
+        cache.delete_many(keys)
+    return results
+
+
+def run_search_benchmark(queries=200, page_size=12, words=2, seed=42):
+    '''
+    Первая страница поиска ленты: тот же запрос, что строит PostView
+    (активные объявления, for_cards(), get_search_backend().apply()),
+    плюс COUNT пагинатора. Запрос - несколько слов заголовка случайного
+    активного объявления, поэтому пустых выдач не бывает.
+    '''
+    rng = random.Random(seed)
+    titles = list(Post.objects.filter(is_active=True).values_list('title', flat=True)[:10_000])
+    if not titles:
+        raise ValueError('Нет активных объявлений: сначала generate_data()')
+    backend = get_search_backend()
+
+    def page(query):
+        queryset = backend.apply(Post.objects.filter(is_active=True).for_cards(), query)
+        return list(Paginator(queryset, page_size).page(1).object_list)
+
+    timings, found = [], []
+    for _ in range(queries):
+        title_words = rng.choice(titles).lower().split()
+        query = ' '.join(rng.sample(title_words, min(words, len(title_words))))
+        started = time.perf_counter()
+        posts = page(query)
+        timings.append(time.perf_counter() - started)
+        found.append(len(posts))
+    with CaptureQueriesContext(connection) as ctx:
+        page(query)
+    return {'backend': type(backend).__name__, 'queries': len(ctx.captured_queries),
+            'empty_pages': found.count(0), **_timings_summary(timings)}
+
+
+MEDIA_MODES = ('stream', 'sendfile', 'offload')
+
+
+class _FileWrapper:
+    '''wsgi.file_wrapper сервера-заменителя: тело-файл отдаётся через os.sendfile'''
+    def __init__(self, filelike, block_size=8192):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.block_size), b'')
+
+    def close(self):
+        self.filelike.close()
+
+
+class _MediaFrontHandler(socketserver.StreamRequestHandler):
+    '''
+    Упрощённый HTTP/1.1 с keep-alive: вызывает приложение как WSGI-сервер
+    и передаёт тело одним из способов (MEDIA_MODES):
+      stream   - итерация по телу ответа в Python (сервер без file_wrapper);
+      sendfile - os.sendfile для FileResponse (как gunicorn);
+      offload  - приложение отвечает X-Accel-Redirect, файл с диапазоном
+                 отдаёт сам "прокси" через os.sendfile (как nginx).
+    '''
+    def handle(self):
+        while True:
+            line = self.rfile.readline(65537)
+            if not line.strip():
+                return
+            method, target, _ = line.decode('latin-1').split()
+            headers = {}
+            while (line := self.rfile.readline(65537)) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            self.respond(method, target, headers)
+
+    def respond(self, method, target, headers):
+        server = self.server
+        environ = {
+            'REQUEST_METHOD': method, 'PATH_INFO': unquote(target.partition('?')[0]),
+            'QUERY_STRING': target.partition('?')[2], 'SERVER_NAME': '127.0.0.1',
+            'SERVER_PORT': str(server.server_address[1]), 'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr, 'wsgi.url_scheme': 'http',
+            'wsgi.version': (1, 0), 'wsgi.multithread': True, 'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            **{'HTTP_' + name.upper().replace('-', '_'): value for name, value in headers.items()},
+        }
+        if server.mode == 'sendfile':
+            environ['wsgi.file_wrapper'] = _FileWrapper
+        started = []
+        result = server.application(environ, lambda status, response_headers, exc_info=None:
+                                    started.extend([status, response_headers]))
+        status, response_headers = started
+        accel = dict((name.lower(), value) for name, value in response_headers) \
+            .get('x-accel-redirect')
+        try:
+            if server.mode == 'offload' and accel:
+                self.send_accel(accel, headers, response_headers)
+            elif isinstance(result, _FileWrapper):
+                self.send_head(status, response_headers)
+                fd = result.filelike.fileno()
+                length = int(dict(response_headers)['Content-Length'])
+                self.sendfile(fd, os.lseek(fd, 0, os.SEEK_CUR), length)
+            else:
+                self.send_head(status, response_headers)
+                for chunk in result:
+                    self.wfile.write(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    def send_head(self, status, response_headers):
+        lines = [f'HTTP/1.1 {status}'] + [f'{name}: {value}' for name, value in response_headers]
+        self.wfile.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    def sendfile(self, fd, offset, length):
+        while length > 0:
+            sent = os.sendfile(self.connection.fileno(), fd, offset, length)
+            if not sent:
+                break
+            offset += sent
+            length -= sent
+
+    def send_accel(self, accel, headers, response_headers):
+        prefix = settings.MARKETPLACE_MEDIA_ACCEL_PREFIX
+        path = os.path.join(settings.MEDIA_ROOT, unquote(accel[len(prefix):]))
+        with open(path, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            passed = [(name, value) for name, value in response_headers
+                      if name.lower() in ('content-type', 'cache-control')]
+            try:
+                byte_range = parse_range(headers['range'], size) if 'range' in headers else None
+            except RangeNotSatisfiable:
+                byte_range = None
+            start, end = byte_range or (0, size - 1)
+            status = '206 Partial Content' if byte_range else '200 OK'
+            if byte_range:
+                passed.append(('Content-Range', f'bytes {start}-{end}/{size}'))
+            self.send_head(status, passed + [('Content-Length', str(end - start + 1))])
+            self.sendfile(fh.fileno(), start, end - start + 1)
+
+
+class _MediaFrontServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mode):
+        super().__init__(('127.0.0.1', 0), _MediaFrontHandler)
+        self.mode = mode
+        self.application = WSGIHandler()
+
+
+def _read_response(sock, buffer):
+    '''Читает ответ целиком, тело - в общий буфер. Возвращает (статус, байт тела)'''
+    head = b''
+    while b'\r\n\r\n' not in head:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError('Соединение закрыто')
+        head += chunk
+    head, _, rest = head.partition(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    length = next(int(line.partition(':')[2]) for line in lines
+                  if line.lower().startswith('content-length:'))
+    remaining = length - len(rest)
+    view = memoryview(buffer)
+    while remaining > 0:
+        received = sock.recv_into(view, min(remaining, len(buffer)))
+        if not received:
+            raise ConnectionError('Соединение закрыто')
+        remaining -= received
+    return int(lines[0].split()[1]), length
+
+
+def run_media_benchmark(size_mb=50, clients=8, duration=5.0, range_kb=1024, modes=MEDIA_MODES):
+    '''
+    Пропускная способность отдачи медиафайла размером size_mb: клиенты
+    в потоках качают его целиком или случайными диапазонами по range_kb
+    (перемотка видео). Сервер-заменитель (_MediaFrontHandler) работает
+    в том же процессе, поэтому процессорное время на гигабайт сравнимо
+    между режимами: стоимость клиентов в них одинакова.
+    '''
+    media_root = tempfile.mkdtemp()
+    name = 'blobs/bench/video.mp4'
+    size = size_mb * 1024 * 1024
+    os.makedirs(os.path.join(media_root, 'blobs/bench'))
+    with open(os.path.join(media_root, name), 'wb') as fh:
+        for _ in range(size_mb):
+            fh.write(os.urandom(1024 * 1024))
+    path = settings.MEDIA_URL + name
+
+    def load(port, workload):
+        stats = {'requests': 0, 'bytes': 0, 'errors': 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + duration
+        span = range_kb * 1024
+
+        def client(seed):
+            rng = random.Random(seed)
+            buffer = bytearray(1024 * 1024)
+            sock = socket.create_connection(('127.0.0.1', port))
+            requests = received = errors = 0
+            try:
+                while time.perf_counter() < deadline:
+                    extra = ''
+                    if workload == 'range':
+                        start = rng.randrange(0, size - span)
+                        extra = f'Range: bytes={start}-{start + span - 1}\r\n'
+                    sock.sendall(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n{extra}\r\n'.encode())
+                    status, length = _read_response(sock, buffer)
+                    if status not in (200, 206):
+                        errors += 1
+                    requests += 1
+                    received += length
+            finally:
+                sock.close()
+                with lock:
+                    stats['requests'] += requests
+                    stats['bytes'] += received
+                    stats['errors'] += errors
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        cpu, started = time.process_time(), time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu
+        gigabytes = stats['bytes'] / 1024 ** 3
+        return {
+            'requests': stats['requests'], 'errors': stats['errors'],
+            'requests_per_s': round(stats['requests'] / elapsed, 1),
+            'mb_per_s': round(stats['bytes'] / 1024 ** 2 / elapsed, 1),
+            'cpu_s_per_gb': round(cpu / gigabytes, 3) if gigabytes else None,
+        }
+
+    results = {}
+    try:
+        with modify_settings(ALLOWED_HOSTS={'append': '127.0.0.1'}):
+            for mode in modes:
+                offload = 'x-accel-redirect' if mode == 'offload' else None
+                with override_settings(MEDIA_ROOT=media_root, MARKETPLACE_MEDIA_OFFLOAD=offload):
+                    server = _MediaFrontServer(mode)
+                    thread = threading.Thread(target=server.serve_forever, daemon=True)
+                    thread.start()
+                    try:
+                        for workload in ('full', 'range'):
+                            results[f'{mode}_{workload}'] = load(server.server_address[1],
+                                                                 workload)
+                    finally:
+                        server.shutdown()
+                        server.server_close()
+    finally:
+        shutil.rmtree(media_root)
+    return results
+
+
+STARTUP_PROFILES = ('uncached', 'development', 'production')
+STARTUP_PAGES = ('post_list', 'post_detail', 'create_post_form', 'response_list')
+
+
+def startup_profile_settings(profile, static_root):
+    '''
+    Настройки профиля для override_settings:
+      uncached    - шаблоны читаются и компилируются на каждый рендер;
+      development - текущие настройки с DEBUG (загрузчик по умолчанию кэширует);
+      production  - MARKETPLACE_PRODUCTION=1: без DEBUG, явный cached loader,
+                    статика с хэшами имён из static_root.
+    '''
+    templates = copy.deepcopy(settings.TEMPLATES)
+    if profile == 'development':
+        return {'DEBUG': True, 'TEMPLATES': templates}
+    templates[0]['APP_DIRS'] = False
+    if profile == 'uncached':
+        templates[0]['OPTIONS']['loaders'] = ['django.template.loaders.filesystem.Loader',
+                                              'django.template.loaders.app_directories.Loader']
+        return {'DEBUG': True, 'TEMPLATES': templates}
+    templates[0]['OPTIONS']['loaders'] = copy.deepcopy(settings.MARKETPLACE_CACHED_TEMPLATE_LOADERS)
+    return {'DEBUG': False, 'TEMPLATES': templates, 'STATIC_ROOT': static_root,
+            'STORAGES': {**settings.STORAGES,
+                         'staticfiles': settings.MARKETPLACE_PRODUCTION_STATICFILES}}
+
+
+def collect_static():
+    '''collectstatic в текущий STATIC_ROOT: время и размер CSS приложения до и после gzip'''
+    started = time.perf_counter()
+    call_command('collectstatic', interactive=False, verbosity=0)
+    elapsed = time.perf_counter() - started
+    css_bytes = gzip_bytes = 0
+    for name in staticfiles_storage.hashed_files.values():
+        if name.startswith('marketplace/') and name.endswith('.css'):
+            css_bytes += staticfiles_storage.size(name)
+            gzip_bytes += (staticfiles_storage.size(name + '.gz')
+                           if staticfiles_storage.exists(name + '.gz')
+                           else len(gzip.compress(staticfiles_storage.open(name).read())))
+    return {'collectstatic_s': round(elapsed, 2), 'css_bytes': css_bytes,
+            'css_gzip_bytes': gzip_bytes}
+
+
+def run_startup_profile(iterations=100):
+    '''
+    Первый ответ каждой страницы в свежем процессе (импорт URLconf и
+    представлений, компиляция шаблонов) и установившееся время ответа.
+    Профиль применяется заранее (startup_profile_settings).
+    '''
+    user, endpoints = default_endpoints()
+    anonymous, logged_in = Client(), Client()
+    logged_in.force_login(user)
+    pages = [(name, path, logged_in if login else anonymous)
+             for name, method, path, login, _ in endpoints if name in STARTUP_PAGES]
+    results = {}
+    for name, path, client in pages:
+        started = time.perf_counter()
+        response = client.get(path)
+        first = time.perf_counter() - started
+        if response.status_code >= 400:
+            raise RuntimeError(f'{name}: {path} вернул {response.status_code}')
+        results[name] = {'first_ms': round(first * 1000, 2), 'html_bytes': len(response.content)}
+    for name, path, client in pages:
+        timings = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            client.get(path)
+            timings.append(time.perf_counter() - started)
+        summary = _timings_summary(timings)
+        results[name].update(p50_ms=summary['p50_ms'], p95_ms=summary['p95_ms'])
+    return results
@@ -0,0 +1,282 @@
+'''
+Кэш ленты объявлений для анонимных пользователей.
+
+Ключ страницы строится из нормализованного набора фильтров и номера
+"поколения" ленты. Любое изменение Post, PostMedia или Category
+увеличивает поколение (сигналы в signals.py), и все старые страницы
+перестают использоваться без удаления по маске - они просто истекают
+по таймауту. Работает с любым бэкендом кэша, включая locmem и файловый.
+
+Карточки объявлений кэшируются по отдельности для всех пользователей
+(render_post_cards): ключ включает updated_at и detail_modified_at, так что
+изменённое объявление просто получает новый ключ. Страница читает все свои
+карточки одним get_many и дописывает недостающие одним set_many.
+
+Страница объявления кэшируется браузером и прокси: ConditionalPostDetailMixin
+отдаёт ETag и Last-Modified по Post.updated_at и Post.detail_modified_at
+и отвечает 304 на условный GET одним запросом, без рендера.
+'''
+import hashlib
+import time
+from calendar import timegm
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponse
+from django.template.loader import get_template
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.utils.safestring import mark_safe
+
+VERSION_KEY = 'marketplace:listing:version'
+HITS_KEY = 'marketplace:listing:hits'
+MISSES_KEY = 'marketplace:listing:misses'
+CATEGORIES_KEY = 'marketplace:categories'
+CARD_KEY = 'marketplace:card'
+CARD_TEMPLATE = 'marketplace/post_card.html'
+# Увеличивается при изменении разметки post_card.html: старые фрагменты
+# в постоянном кэше (Redis, файловый) перестают использоваться после выкладки
+CARD_VERSION = 1
+
+LISTING_PARAMS = ('q', 'category', 'type_post', 'price_min', 'price_max', 'page', 'cursor')
+
+
+def listing_cache_timeout():
+    return getattr(settings, 'MARKETPLACE_LISTING_CACHE_TIMEOUT', 300)
+
+
+def _incr(key, initial=0):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Ключа ещё нет (или он вытеснен) - начинаем заново
+        cache.add(key, initial, timeout=None)
+        return cache.incr(key)
+
+
+def _new_generation():
+    '''
+    Начальное поколение ленты - время в микросекундах. Кэш с ограниченным
+    размером (locmem, memcached) может вытеснить VERSION_KEY, и счёт с 1
+    повторил бы поколения, страницы которых ещё лежат в кэше. Новое
+    начало больше любого прежнего, пока лента не меняется чаще миллиона
+    раз в секунду.
+    '''
+    return time.time_ns() // 1000
+
+
+def listing_version():
+    return cache.get_or_set(VERSION_KEY, _new_generation, timeout=None)
+
+
+def bump_listing_version():
+    _incr(VERSION_KEY, _new_generation())
+
+
+def listing_cache_key(params):
+    '''Ключ страницы: поколение ленты + нормализованные параметры фильтра'''
+    normalized = {name: params.get(name, '').strip() for name in LISTING_PARAMS}
+    if normalized['page'] == '1':
+        normalized['page'] = ''
+    digest = hashlib.md5(repr(sorted(normalized.items())).encode()).hexdigest()
+    return f'marketplace:listing:{listing_version()}:{digest}'
+
+
+def cached_categories():
+    '''Список категорий для фильтра, кэшируется до следующего изменения ленты'''
+    from .models import Category
+
+    key = f'{CATEGORIES_KEY}:{listing_version()}'
+    categories = cache.get(key)
+    if categories is None:
+        categories = list(Category.objects.all())
+        cache.set(key, categories, listing_cache_timeout())
+    return categories
+
+
+def listing_cache_stats():
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {'hits': hits, 'misses': misses, 'ratio': hits / total if total else 0.0}
+
+
+def reset_listing_cache_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
+
+
+class AnonymousListingCacheMixin:
+    '''
+    Отдаёт готовую страницу из кэша анонимным пользователям.
+    Авторизованные всегда получают свежий рендер: в карточках
+    для них есть кнопки редактирования своих объявлений.
+    '''
+    def can_use_listing_cache(self, request):
+        return (listing_cache_timeout() and request.method == 'GET'
+                and not request.user.is_authenticated)
+
+    def cached_listing_response(self, request):
+        '''Готовая страница из кэша или None (промах учитывается в статистике)'''
+        cached = cache.get(listing_cache_key(request.GET))
+        if cached is None:
+            _incr(MISSES_KEY)
+            return None
+        _incr(HITS_KEY)
+        content, content_type = cached
+        return HttpResponse(content, content_type=content_type)
+
+    def store_listing_response(self, request, response):
+        key = listing_cache_key(request.GET)
+
+        def store(response):
+            if response.status_code == 200:
+                cache.set(key, (response.content, response['Content-Type']),
+                          listing_cache_timeout())
+
+        # Кэшируем после рендера, который выполнит обработчик запроса
+        if getattr(response, 'is_rendered', True):
+            store(response)
+        else:
+            response.add_post_render_callback(store)
+        return response
+
+    def get(self, request, *args, **kwargs):
+        if not self.can_use_listing_cache(request):
+            return super().get(request, *args, **kwargs)
+        cached = self.cached_listing_response(request)
+        if cached is not None:
+            return cached
+        return self.store_listing_response(request, super().get(request, *args, **kwargs))
+
+
+class AsyncAnonymousListingCacheMixin(AnonymousListingCacheMixin):
+    '''
+    То же для async-представлений: обращения к кэшу выполняются
+    в потоке, чтобы не блокировать цикл событий.
+    '''
+    async def get(self, request, *args, **kwargs):
+        if not self.can_use_listing_cache(request):
+            return await super().get(request, *args, **kwargs)
+        cached = await sync_to_async(self.cached_listing_response)(request)
+        if cached is not None:
+            return cached
+        response = await super().get(request, *args, **kwargs)
+        return await sync_to_async(self.store_listing_response)(request, response)
+
+
+def post_card_cache_timeout():
+    return getattr(settings, 'MARKETPLACE_POST_CARD_CACHE_TIMEOUT', 86400)
+
+
+def post_card_cache_key(post):
+    '''
+    Ключ фрагмента карточки. Категория и обложка меняют detail_modified_at
+    (signals.py, derivatives.py), имя автора в объявлении не отражается -
+    оно входит в ключ напрямую.
+    '''
+    raw = (f'{post.updated_at.isoformat()}:{post.detail_modified_at.isoformat()}:'
+           f'{post.author.username}')
+    return f'{CARD_KEY}:{CARD_VERSION}:{post.pk}:{hashlib.md5(raw.encode()).hexdigest()}'
+
+
+def render_post_cards(posts):
+    '''
+    Карточки страницы ленты: [{'post', 'html', 'detail_url'}] в порядке posts,
+    неактивные пропускаются. Объявления загружены for_cards(), поэтому рендер
+    недостающих карточек не делает запросов к БД. Ссылку "Подробнее" (у автора
+    она ведёт на редактирование) шаблон ленты добавляет сам.
+    '''
+    posts = [post for post in posts if post.is_active]
+    timeout = post_card_cache_timeout()
+    keys = {post.pk: post_card_cache_key(post) for post in posts} if timeout else {}
+    cached = cache.get_many(keys.values()) if keys else {}
+
+    template = None
+    missing = {}
+    cards = []
+    for post in posts:
+        fragment = cached.get(keys.get(post.pk))
+        if fragment is None:
+            if template is None:
+                template = get_template(CARD_TEMPLATE)
+            detail_url = reverse('post_detail', args=[post.slug])
+            html = template.render({'post': post, 'detail_url': detail_url})
+            fragment = (str(html), detail_url)
+            if timeout:
+                missing[keys[post.pk]] = fragment
+        html, detail_url = fragment
+        cards.append({'post': post, 'html': mark_safe(html), 'detail_url': detail_url})
+    if missing:
+        cache.set_many(missing, timeout)
+    return cards
+
+
+def post_detail_max_age():
+    return getattr(settings, 'MARKETPLACE_POST_DETAIL_MAX_AGE', 0)
+
+
+class ConditionalPostDetailMixin:
+    '''
+    Условные запросы к странице объявления. Состояние страницы -
+    (pk, updated_at, detail_modified_at) - читается одним запросом по
+    уникальному индексу slug. Совпал ETag или If-Modified-Since - ответ 304
+    без загрузки отзывов и медиафайлов и без рендера.
+
+    Страница зависит от пользователя (шапка, кнопка отзыва), поэтому ETag
+    включает его id, ответ помечается Vary: Cookie, авторизованным - private.
+    Last-Modified отдаётся только анонимным: дата не различает пользователей.
+    '''
+    state_fields = ('pk', 'updated_at', 'detail_modified_at')
+
+    def get_state_queryset(self):
+        slug = self.kwargs[self.slug_url_kwarg]
+        return self.model.objects.filter(**{self.slug_field: slug}).values_list(*self.state_fields)
+
+    def get_page_state(self):
+        state = self.get_state_queryset().first()
+        if state is None:
+            raise Http404('Объявление не найдено')
+        return state
+
+    def page_validators(self, request, state):
+        pk, updated_at, detail_modified_at = state
+        user_id = request.user.pk if request.user.is_authenticated else 'anonymous'
+        raw = f'{pk}:{updated_at.isoformat()}:{detail_modified_at.isoformat()}:{user_id}'
+        etag = quote_etag(hashlib.md5(raw.encode()).hexdigest())
+        if request.user.is_authenticated:
+            return etag, None
+        return etag, timegm(max(updated_at, detail_modified_at).utctimetuple())
+
+    def not_modified_response(self, request, state):
+        '''Ответ 304 (или 412) с заголовками кэширования либо None'''
+        etag, last_modified = self.page_validators(request, state)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            self.patch_cache_headers(request, state, response)
+        return response
+
+    def patch_cache_headers(self, request, state, response):
+        # Состояние прочитано до рендера: если объявление изменилось между
+        # запросами, ETag окажется старше страницы и следующий GET получит 200
+        if response.status_code not in (200, 304):
+            return response
+        etag, last_modified = self.page_validators(request, state)
+        response.headers.setdefault('ETag', etag)
+        if last_modified is not None:
+            response.headers.setdefault('Last-Modified', http_date(last_modified))
+        if request.user.is_authenticated:
+            patch_cache_control(response, private=True, no_cache=True)
+        else:
+            patch_cache_control(response, public=True, max_age=post_detail_max_age(),
+                                must_revalidate=True)
+        patch_vary_headers(response, ('Cookie',))
+        return response
+
+    def get(self, request, *args, **kwargs):
+        state = self.get_page_state()
+        response = self.not_modified_response(request, state)
+        if response is not None:
+            return response
+        return self.patch_cache_headers(request, state, super().get(request, *args, **kwargs))
@@ -0,0 +1,81 @@
+"""
+Денормализованные счётчики объявлений и профилей.
+
+Сигналы (signals.py) сдвигают счётчики на ±1 через F(), а reconcile()
+пересчитывает их целиком одним UPDATE на таблицу - чинит расхождения
+после bulk-операций, которые сигналы обходят.
+"""
+from django.apps import apps as global_apps
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def shift(model, pk_filter, **deltas):
+    """
+    Атомарный сдвиг счётчиков: UPDATE ... SET field = field + delta.
+    Выражения (например, Now()) присваиваются как есть в том же UPDATE.
+    """
+    changes = {}
+    for field, delta in deltas.items():
+        if hasattr(delta, 'resolve_expression'):
+            changes[field] = delta
+        elif delta:
+            changes[field] = F(field) + delta
+    if changes:
+        model.objects.filter(**pk_filter).update(**changes)
+
+
+def _count(queryset, group_field, outer='pk'):
+    """Коррелированный подзапрос COUNT(*) с группировкой по внешнему ключу"""
+    subquery = (
+        queryset.filter(**{group_field: OuterRef(outer)})
+        .order_by()
+        .values(group_field)
+        .annotate(total=Count('pk'))
+        .values('total')
+    )
+    return Coalesce(Subquery(subquery, output_field=IntegerField()), Value(0))
+
+
+def reconcile(apps=None):
+    """
+    Пересчёт всех счётчиков.
+    Создаёт недостающие профили и возвращает число исправленных строк.
+    """
+    apps = apps or global_apps
+    User = apps.get_model('auth', 'User')
+    Profile = apps.get_model('marketplace', 'Profile')
+    Post = apps.get_model('marketplace', 'Post')
+    PostMedia = apps.get_model('marketplace', 'PostMedia')
+    Response = apps.get_model('marketplace', 'Response')
+
+    missing = User.objects.filter(profile__isnull=True).values_list('pk', flat=True)
+    Profile.objects.bulk_create(
+        [Profile(user_id=pk) for pk in missing.iterator()],
+        ignore_conflicts=True,
+    )
+
+    media = _count(PostMedia.objects.all(), 'post')
+    responses = _count(Response.objects.all(), 'post')
+    accepted = _count(Response.objects.filter(is_accepted=True), 'post')
+    posts = _count(Post.objects.all(), 'author', outer='user')
+
+    # Обновляем только разошедшиеся строки
+    fixed = Post.objects.annotate(
+        real_media=media, real_responses=responses, real_accepted=accepted,
+    ).filter(
+        ~Q(media_count=F('real_media'))
+        | ~Q(response_count=F('real_responses'))
+        | ~Q(accepted_response_count=F('real_accepted'))
+    ).values('pk')
+    fixed_posts = Post.objects.filter(pk__in=Subquery(fixed)).update(
+        media_count=media,
+        response_count=responses,
+        accepted_response_count=accepted,
+    )
+
+    stale = Profile.objects.annotate(real_posts=posts).exclude(
+        post_count=F('real_posts'),
+    ).values('pk')
+    fixed_profiles = Profile.objects.filter(pk__in=Subquery(stale)).update(post_count=posts)
+    return {'posts': fixed_posts, 'profiles': fixed_profiles}
@@ -0,0 +1,179 @@
+'''
+Уменьшенные копии (derivatives) медиафайлов для карточек и галереи.
+
+Для изображений генерируются WebP и JPEG нескольких фиксированных ширин,
+для видео - заглушка-постер. Файлы кладутся рядом с оригиналом
+(<post_id>/post-<post_id>-001.w320.webp), их имена сохраняются в
+PostMedia.derivatives, поэтому шаблонам не нужно обращаться к хранилищу.
+Превью общего оригинала (blobs/..., storage.DeduplicatingStorage) у каждого
+медиафайла свои: derivatives/<media_id>/<sha256>.w320.webp.
+Генерация идёт в пуле процессов после коммита транзакции.
+'''
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.functions import Now
+
+from .storage import BLOB_PREFIX
+
+try:
+    from PIL import Image, ImageDraw, ImageOps
+except ImportError:  # Pillow не установлен - работаем с оригиналами
+    Image = None
+
+logger = logging.getLogger('marketplace')
+
+WIDTHS = (320, 640, 1280)
+FORMATS = {'webp': ('WEBP', {'quality': 80, 'method': 4}),
+           'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True})}
+POSTER_SIZE = (640, 360)
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        workers = getattr(settings, 'MARKETPLACE_DERIVATIVES_WORKERS', 2)
+        _executor = ProcessPoolExecutor(max_workers=workers)
+    return _executor
+
+
+def render_image(data, widths=WIDTHS):
+    '''
+    Выполняется в процессе пула: только Pillow, без Django.
+    Возвращает {(ширина, формат): байты}.
+    '''
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source).convert('RGB')
+    results = {}
+    for width in widths:
+        if width > image.width and width != widths[0]:
+            continue
+        resized = image.copy()
+        resized.thumbnail((width, width * 4), Image.LANCZOS)
+        for fmt, (pil_format, options) in FORMATS.items():
+            buffer = io.BytesIO()
+            resized.save(buffer, pil_format, **options)
+            results[(width, fmt)] = buffer.getvalue()
+    return results
+
+
+def render_poster():
+    '''Заглушка-постер для видео: тёмный кадр с кнопкой воспроизведения'''
+    image = Image.new('RGB', POSTER_SIZE, (20, 24, 40))
+    draw = ImageDraw.Draw(image)
+    w, h = POSTER_SIZE
+    draw.polygon([(w * 0.42, h * 0.32), (w * 0.42, h * 0.68), (w * 0.62, h * 0.5)],
+                 fill=(246, 185, 59))
+    results = {}
+    for fmt, (pil_format, options) in FORMATS.items():
+        buffer = io.BytesIO()
+        image.save(buffer, pil_format, **options)
+        results[('poster', fmt)] = buffer.getvalue()
+    return results
+
+
+def render(data, is_image):
+    return render_image(data) if is_image else render_poster()
+
+
+def derivative_name(media_id, original, key, fmt):
+    '''
+    Имя превью. Оригинал из BLOB_PREFIX может принадлежать нескольким
+    медиафайлам, поэтому его превью привязаны к PostMedia: удаление или
+    перегенерация превью одного объявления не трогает файлы другого.
+    '''
+    stem = os.path.splitext(original)[0]
+    if original.startswith(BLOB_PREFIX):
+        stem = f'derivatives/{media_id}/{os.path.basename(stem)}'
+    suffix = 'poster' if key == 'poster' else f'w{key}'
+    return f'{stem}.{suffix}.{fmt}'
+
+
+def store_derivatives(media_id, original, rendered):
+    '''Сохраняет результат рендера в хранилище и в PostMedia.derivatives'''
+    from .caching import bump_listing_version
+    from .models import Post, PostMedia
+
+    derivatives = {}
+    for (key, fmt), content in rendered.items():
+        name = derivative_name(media_id, original, key, fmt)
+        default_storage.delete(name)
+        # Хранилище может сохранить файл под другим именем (например, по хэшу)
+        name = default_storage.save(name, ContentFile(content))
+        derivatives.setdefault(str(key), {})[fmt] = name
+    updated = PostMedia.objects.filter(pk=media_id, file=original).update(derivatives=derivatives)
+    if not updated:
+        # Медиафайл успели удалить, пока шёл рендер
+        delete_derivatives(derivatives)
+        return {}
+    # Разметка галереи на странице объявления зависит от превью
+    Post.objects.filter(media__pk=media_id).update(detail_modified_at=Now())
+    bump_listing_version()
+    return derivatives
+
+
+def generate_derivatives(media):
+    '''Синхронная генерация (backfill, тесты, режим без пула)'''
+    if Image is None or not media.file:
+        return {}
+    data = media.file.read() if media.is_image else b''
+    media.file.close()
+    try:
+        rendered = render(data, media.is_image)
+    except Exception as e:
+        logger.error(f'Не удалось создать превью для {media.file.name}: {e}')
+        return {}
+    media.derivatives = store_derivatives(media.pk, media.file.name, rendered)
+    return media.derivatives
+
+
+def schedule_derivatives(media):
+    '''Ставит генерацию в пул процессов после коммита транзакции'''
+    if Image is None:
+        return
+    if not getattr(settings, 'MARKETPLACE_DERIVATIVES_ASYNC', True):
+        transaction.on_commit(lambda: generate_derivatives(media))
+        return
+
+    media_id, original, is_image = media.pk, media.file.name, media.is_image
+
+    def submit():
+        data = b''
+        if is_image:
+            with default_storage.open(original, 'rb') as f:
+                data = f.read()
+        future = get_executor().submit(render, data, is_image)
+        future.add_done_callback(lambda f: _on_rendered(f, media_id, original))
+
+    transaction.on_commit(submit)
+
+
+def _on_rendered(future, media_id, original):
+    from django.db import close_old_connections
+
+    try:
+        store_derivatives(media_id, original, future.result())
+    except Exception as e:
+        logger.error(f'Не удалось создать превью для {original}: {e}')
+    finally:
+        close_old_connections()
+
+
+def derivative_files(derivatives):
+    return [name for formats in derivatives.values() for name in formats.values()]
+
+
+def delete_derivatives(derivatives):
+    for name in derivative_files(derivatives):
+        try:
+            default_storage.delete(name)
+        except Exception as e:
+            logger.error(f'Ошибка при удалении {name}: {e}')
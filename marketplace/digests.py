@@ -0,0 +1,112 @@
+'''
+Сводки отзывов для авторов, включивших Profile.digest_notifications.
+
+CreateResponse для таких авторов не ставит письмо в очередь, а записывает
+PendingNotification. Команда send_digests раз в интервал собирает для
+каждого автора все накопившиеся отзывы в одно письмо (шаблон
+response_notif.html рендерится один раз на сводку) и пишет пачку сводок
+в outbox одним bulk_create в той же транзакции, что удаляет обработанные
+записи. Отправляет их send_outbox - по одному SMTP-соединению на поток.
+Интервал - MARKETPLACE_DIGEST_INTERVAL_SECONDS: автор получает не больше
+одной сводки за интервал, сколько бы отзывов ни пришло.
+'''
+import itertools
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.template.loader import get_template
+from django.utils import timezone
+
+from . import metrics
+from .models import OutgoingEmail, PendingNotification, Profile
+from .outbox import DEFAULT_FROM_EMAIL
+
+# Сколько id подставлять в один DELETE ... WHERE id IN (...)
+DELETE_CHUNK = 900
+
+
+def digest_interval():
+    return timedelta(seconds=getattr(settings, 'MARKETPLACE_DIGEST_INTERVAL_SECONDS', 3600))
+
+
+def site_url():
+    return getattr(settings, 'MARKETPLACE_SITE_URL', '').rstrip('/')
+
+
+def wants_digest(user_id):
+    return Profile.objects.filter(user_id=user_id, digest_notifications=True).exists()
+
+
+def due_recipients(now=None, limit=500):
+    '''Авторы с накопленными отзывами, которым уже можно отправить сводку'''
+    now = now or timezone.now()
+    return list(
+        PendingNotification.objects
+        .filter(Q(recipient__profile__digest_sent_at__isnull=True)
+                | Q(recipient__profile__digest_sent_at__lte=now - digest_interval()))
+        .order_by('recipient_id').values_list('recipient_id', flat=True).distinct()[:limit]
+    )
+
+
+def build_digest(recipient, responses, template):
+    '''Письмо-сводка (ещё не сохранённое) по отзывам, упорядоченным по объявлению'''
+    posts = {response.post_id: response.post for response in responses}
+    html_body = template.render({'responses': responses, 'site_url': site_url()})
+    lines = [f'{response.author.username} к "{response.post.title}": {response.content}'
+             for response in responses]
+    return OutgoingEmail(
+        subject=f'Новые отзывы к вашим объявлениям: {len(responses)}',
+        body=(f'Новые отзывы ({len(responses)}) к объявлениям ({len(posts)}):\n'
+              + '\n'.join(lines)),
+        html_body=html_body, from_email=DEFAULT_FROM_EMAIL, recipients=[recipient.email],
+    )
+
+
+def enqueue_digests(recipient_ids, now=None):
+    '''
+    Сводки для пачки авторов: один запрос за отзывами, bulk_create писем
+    и удаление обработанных записей в одной транзакции. Возвращает
+    (число сводок, число отзывов в них).
+    '''
+    now = now or timezone.now()
+    pending = list(
+        PendingNotification.objects.filter(recipient_id__in=recipient_ids)
+        .select_related('recipient', 'response__author', 'response__post')
+        # Только поля, нужные письму: без текста объявлений и данных пользователей
+        .only('recipient__email', 'response__content', 'response__created_at',
+              'response__post_id', 'response__author__username', 'response__post__title',
+              'response__post__slug', 'response__post__price', 'response__post__created_at')
+        .order_by('recipient_id', 'response__post_id', 'response__created_at', 'response_id')
+    )
+    template = get_template('marketplace/response_notif.html')
+    emails = []
+    for recipient_id, group in itertools.groupby(pending, key=lambda item: item.recipient_id):
+        group = list(group)
+        recipient = group[0].recipient
+        if recipient.email:
+            emails.append(build_digest(recipient, [item.response for item in group], template))
+
+    with transaction.atomic():
+        OutgoingEmail.objects.bulk_create(emails, batch_size=500)
+        # Только прочитанные записи: отзывы, пришедшие за это время, ждут следующей сводки
+        ids = [item.pk for item in pending]
+        for start in range(0, len(ids), DELETE_CHUNK):
+            PendingNotification.objects.filter(pk__in=ids[start:start + DELETE_CHUNK]).delete()
+        Profile.objects.filter(user_id__in=recipient_ids).update(digest_sent_at=now)
+    metrics.EMAILS_QUEUED.inc(len(emails))
+    return len(emails), len(pending)
+
+
+def process_digests(batch_size=500, now=None):
+    '''Все сводки, которые пора отправить. Возвращает (сводок, отзывов)'''
+    now = now or timezone.now()
+    digests = notifications = 0
+    while True:
+        recipient_ids = due_recipients(now, batch_size)
+        if not recipient_ids:
+            return digests, notifications
+        sent, included = enqueue_digests(recipient_ids, now)
+        digests += sent
+        notifications += included
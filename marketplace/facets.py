@@ -0,0 +1,135 @@
+'''
+Счётчики для панели фильтров ленты: число активных объявлений
+по категории, типу и ценовому диапазону.
+
+Таблица PostFacet хранит счётчик на каждую тройку (категория, тип,
+корзина цены). Сигналы Post (signals.py) переносят объявление из старой
+тройки в новую при создании, изменении и удалении, rebuild()
+пересчитывает таблицу целиком после bulk-операций. Лента читает все
+строки одним запросом (кэш до следующего изменения ленты) и сводит их
+для текущего фильтра в Python - строк немного: категории x 2 x корзины.
+'''
+from bisect import bisect_right
+
+from django.apps import apps as global_apps
+from django.core.cache import cache
+from django.db.models import Case, Count, F, Value, When
+
+from .caching import listing_cache_timeout, listing_version
+
+FACETS_KEY = 'marketplace:facets'
+
+# Верхние (не включительно) границы ценовых корзин; последняя корзина - без границы
+PRICE_BOUNDS = (100, 500, 1000, 5000, 10000, 50000, 100000)
+
+# Поля Post, от которых зависит тройка счётчика
+FACET_FIELDS = ('is_active', 'category_id', 'type_post', 'price')
+
+
+def price_bucket(price):
+    return bisect_right(PRICE_BOUNDS, price)
+
+
+def bucket_range(bucket):
+    '''Цены корзины включительно: (от, до), "до" - None у последней'''
+    low = PRICE_BOUNDS[bucket - 1] if bucket else 0
+    high = PRICE_BOUNDS[bucket] - 1 if bucket < len(PRICE_BOUNDS) else None
+    return low, high
+
+
+def facet_key(values):
+    '''Тройка счётчика по значениям FACET_FIELDS или None для неактивного объявления'''
+    if not values['is_active']:
+        return None
+    return values['category_id'], values['type_post'], price_bucket(values['price'])
+
+
+def shift(key, delta):
+    '''Сдвиг счётчика тройки через F(), строка создаётся при первом объявлении'''
+    from .models import PostFacet
+
+    if key is None or not delta:
+        return
+    category_id, type_post, bucket = key
+    lookup = {'category_id': category_id, 'type_post': type_post, 'price_bucket': bucket}
+    if PostFacet.objects.filter(**lookup).update(count=F('count') + delta):
+        return
+    PostFacet.objects.bulk_create([PostFacet(**lookup)], ignore_conflicts=True)
+    PostFacet.objects.filter(**lookup).update(count=F('count') + delta)
+
+
+def move(old_key, new_key):
+    if old_key != new_key:
+        shift(old_key, -1)
+        shift(new_key, 1)
+
+
+def _bucket_expression():
+    return Case(
+        *[When(price__lt=bound, then=Value(i)) for i, bound in enumerate(PRICE_BOUNDS)],
+        default=Value(len(PRICE_BOUNDS)),
+    )
+
+
+def rebuild(apps=None):
+    '''
+    Пересчёт таблицы одним GROUP BY по активным объявлениям.
+    Меняются только разошедшиеся строки, возвращается их число.
+    '''
+    apps = apps or global_apps
+    Post = apps.get_model('marketplace', 'Post')
+    PostFacet = apps.get_model('marketplace', 'PostFacet')
+
+    grouped = (Post.objects.filter(is_active=True).order_by()
+               .annotate(bucket=_bucket_expression())
+               .values_list('category_id', 'type_post', 'bucket')
+               .annotate(total=Count('pk')))
+    expected = {(category, type_post, bucket): total
+                for category, type_post, bucket, total in grouped}
+
+    stale = []
+    for facet in PostFacet.objects.all():
+        total = expected.pop((facet.category_id, facet.type_post, facet.price_bucket), 0)
+        if facet.count != total:
+            facet.count = total
+            stale.append(facet)
+    PostFacet.objects.bulk_update(stale, ['count'], batch_size=500)
+    PostFacet.objects.bulk_create([
+        PostFacet(category_id=category, type_post=type_post, price_bucket=bucket, count=total)
+        for (category, type_post, bucket), total in expected.items()
+    ], batch_size=500)
+    return len(stale) + len(expected)
+
+
+def cached_facet_rows():
+    '''Все ненулевые счётчики одним запросом, кэш до следующего изменения ленты'''
+    from .models import PostFacet
+
+    key = f'{FACETS_KEY}:{listing_version()}'
+    rows = cache.get(key)
+    if rows is None:
+        rows = list(PostFacet.objects.filter(count__gt=0).values_list(
+            'category_id', 'type_post', 'price_bucket', 'count'))
+        cache.set(key, rows, listing_cache_timeout())
+    return rows
+
+
+def facet_counts(rows, category_id=None, type_post=None):
+    '''
+    Счётчики для текущего фильтра. По каждому измерению учитывается выбор
+    в остальных: числа у категорий - с выбранным типом, у типов - с выбранной
+    категорией, гистограмма цен - с обоими. Цена и поисковый запрос
+    в счётчики не входят.
+    '''
+    categories, types = {}, {}
+    prices = [0] * (len(PRICE_BOUNDS) + 1)
+    for row_category, row_type, bucket, count in rows:
+        type_matches = type_post is None or row_type == type_post
+        category_matches = category_id is None or row_category == category_id
+        if type_matches:
+            categories[row_category] = categories.get(row_category, 0) + count
+        if category_matches:
+            types[row_type] = types.get(row_type, 0) + count
+        if type_matches and category_matches:
+            prices[bucket] += count
+    return {'categories': categories, 'types': types, 'prices': prices}
@@ -0,0 +1,253 @@
+'''
+Замеры по каждому запросу: число SQL-запросов, время в БД, время рендера
+шаблона и повторяющиеся запросы (N+1) по нормализованному "отпечатку" SQL.
+
+Запросы перехватывает execute_wrapper, который один раз ставится на каждое
+соединение с БД и пишет в сборщик текущего запроса из ContextVar - так
+замеры работают и для async-представлений, где ORM выполняется в другом
+потоке. Результат уходит в заголовок Server-Timing, медленные запросы
+пишутся в лог 'marketplace', сводные гистограммы по представлениям
+доступны персоналу (InstrumentationStatsView) и в /metrics.
+'''
+import logging
+import re
+import threading
+import time
+from contextvars import ContextVar
+from functools import lru_cache
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from .metrics import REQUEST_DURATION
+
+logger = logging.getLogger('marketplace')
+
+# Границы корзин гистограммы времени ответа, мс
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+TOP_QUERIES = 5
+
+_current = ContextVar('marketplace_request_metrics', default=None)
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+IN_LIST_RE = re.compile(r'\bIN \((?:\s*(?:%s|\?|NULL),?)+\s*\)', re.IGNORECASE)
+SPACE_RE = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=4096)
+def fingerprint(sql):
+    '''SQL без литералов и с IN-списками любой длины, сведёнными к одному виду'''
+    sql = STRING_RE.sub('?', sql)
+    sql = NUMBER_RE.sub('?', sql)
+    sql = IN_LIST_RE.sub('IN (...)', sql)
+    return SPACE_RE.sub(' ', sql).strip()
+
+
+class RequestMetrics:
+    '''Сборщик замеров одного HTTP-запроса'''
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.by_sql = {}
+
+    def record_query(self, sql, duration):
+        self.queries += 1
+        self.db_time += duration
+        stats = self.by_sql.get(sql)
+        if stats is None:
+            self.by_sql[sql] = [1, duration]
+        else:
+            stats[0] += 1
+            stats[1] += duration
+
+    def by_fingerprint(self):
+        # Нормализация - только при разборе, а не на каждый запрос
+        grouped = {}
+        for sql, (count, duration) in self.by_sql.items():
+            stats = grouped.setdefault(fingerprint(sql), [0, 0.0])
+            stats[0] += count
+            stats[1] += duration
+        return grouped
+
+    def duplicates(self):
+        return sum(count - 1 for count, _ in self.by_fingerprint().values() if count > 1)
+
+    def top_queries(self, limit=TOP_QUERIES):
+        return sorted(self.by_fingerprint().items(), key=lambda item: item[1][1],
+                      reverse=True)[:limit]
+
+    def server_timing(self, total):
+        return (f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries", '
+                f'tpl;dur={self.template_time * 1000:.1f}, '
+                f'total;dur={total * 1000:.1f}')
+
+
+def _execute_wrapper(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.record_query(sql, time.perf_counter() - started)
+
+
+def install(connection):
+    if _execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute_wrapper)
+
+
+def _install_on_new_connection(sender, connection, **kwargs):
+    install(connection)
+
+
+connection_created.connect(_install_on_new_connection,
+                           dispatch_uid='marketplace_instrumentation')
+
+
+class ViewStats:
+    '''Гистограммы времени ответа и суммы по представлениям (в памяти процесса)'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+
+    def record(self, view, total_ms, db_ms, queries, template_ms, duplicates):
+        with self._lock:
+            stats = self._views.get(view)
+            if stats is None:
+                stats = self._views[view] = {
+                    'count': 0, 'sum_ms': 0.0, 'max_ms': 0.0, 'db_ms': 0.0,
+                    'template_ms': 0.0, 'queries': 0, 'duplicates': 0,
+                    'buckets': [0] * len(BUCKETS),
+                }
+            stats['count'] += 1
+            stats['sum_ms'] += total_ms
+            stats['max_ms'] = max(stats['max_ms'], total_ms)
+            stats['db_ms'] += db_ms
+            stats['template_ms'] += template_ms
+            stats['queries'] += queries
+            stats['duplicates'] += duplicates
+            for i, bound in enumerate(BUCKETS):
+                if total_ms <= bound:
+                    stats['buckets'][i] += 1
+                    break
+
+    def snapshot(self):
+        with self._lock:
+            views = {name: dict(stats, buckets=list(stats['buckets']))
+                     for name, stats in self._views.items()}
+        bounds = [str(bound) if bound != float('inf') else '+Inf' for bound in BUCKETS]
+        for stats in views.values():
+            count = stats['count']
+            stats['buckets'] = dict(zip(bounds, stats['buckets']))
+            stats['mean_ms'] = round(stats['sum_ms'] / count, 2)
+            stats['mean_queries'] = round(stats['queries'] / count, 2)
+            for key in ('sum_ms', 'max_ms', 'db_ms', 'template_ms'):
+                stats[key] = round(stats[key], 2)
+        return views
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+
+
+view_stats = ViewStats()
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    return match.view_name or match._func_path
+
+
+class InstrumentationMiddleware:
+    '''
+    Подключается в MIDDLEWARE, отключается настройкой
+    MARKETPLACE_INSTRUMENTATION = False.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'MARKETPLACE_INSTRUMENTATION', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_ms = getattr(settings, 'MARKETPLACE_SLOW_REQUEST_MS', 500)
+        self.duplicate_threshold = getattr(settings, 'MARKETPLACE_NPLUSONE_THRESHOLD', 5)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        for connection in connections.all(initialized_only=True):
+            install(connection)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    def process_template_response(self, request, response):
+        metrics = _current.get()
+        if metrics is not None:
+            render = response.render
+
+            def timed_render():
+                started = time.perf_counter()
+                try:
+                    return render()
+                finally:
+                    metrics.template_time += time.perf_counter() - started
+
+            response.render = timed_render
+        return response
+
+    def finish(self, request, response, metrics):
+        total = time.perf_counter() - metrics.started
+        response['Server-Timing'] = metrics.server_timing(total)
+        name = view_name(request)
+        total_ms = total * 1000
+        duplicates = metrics.duplicates() if metrics.queries > 1 else 0
+        view_stats.record(name, total_ms, metrics.db_time * 1000, metrics.queries,
+                          metrics.template_time * 1000, duplicates)
+        REQUEST_DURATION.observe(total, view=name, method=request.method,
+                                 status=f'{response.status_code // 100}xx')
+
+        if total_ms >= self.slow_ms:
+            logger.warning(
+                'Медленный запрос %s %s (%s): %.0f мс, SQL: %d за %.0f мс, шаблон %.0f мс%s',
+                request.method, request.get_full_path(), name, total_ms, metrics.queries,
+                metrics.db_time * 1000, metrics.template_time * 1000,
+                ''.join(f'\n  {count}x {duration * 1000:.1f} мс: {sql}'
+                        for sql, (count, duration) in metrics.top_queries()),
+            )
+        if duplicates >= self.duplicate_threshold:
+            repeated = [(sql, count) for sql, (count, _) in metrics.by_fingerprint().items()
+                        if count > 1]
+            logger.warning(
+                'Возможная N+1 в %s %s (%s): %d повторных запросов%s',
+                request.method, request.get_full_path(), name, duplicates,
+                ''.join(f'\n  {count}x {sql}' for sql, count in repeated),
+            )
+        return response
@@ -0,0 +1,135 @@
+'''
+Простой нагрузочный HTTP-клиент на asyncio: много одновременных
+keep-alive соединений, замер задержек и кодов ответа.
+Используется командами load_test и bench.
+'''
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class Target:
+    def __init__(self, name, url, paths):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f'Некорректный адрес: {url}')
+        self.name = name
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = parts.scheme == 'https'
+        base = parts.path.rstrip('/')
+        self.paths = [base + path for path in paths] if paths else [parts.path or '/']
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+
+
+async def read_response(reader):
+    '''Читает один HTTP/1.1 ответ, возвращает (код, нужно ли закрыть соединение)'''
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('Соединение закрыто сервером')
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    close = headers.get('connection', '').lower() == 'close'
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.read()
+        close = True
+    return status, close
+
+
+async def request(reader, writer, target, path):
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: {target.host}\r\n'
+                 f'Connection: keep-alive\r\n\r\n'.encode())
+    await writer.drain()
+    return await read_response(reader)
+
+
+async def connection_loop(target, worker, deadline, record_after, timeout):
+    reader = writer = None
+    n = worker
+    while time.perf_counter() < deadline:
+        path = target.paths[n % len(target.paths)]
+        n += 1
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(target.host, target.port, ssl=target.ssl or None),
+                    timeout)
+            started = time.perf_counter()
+            status, close = await asyncio.wait_for(request(reader, writer, target, path), timeout)
+            finished = time.perf_counter()
+            if finished >= record_after:
+                target.latencies.append(finished - started)
+                target.statuses[status] = target.statuses.get(status, 0) + 1
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError,
+                IndexError):
+            if time.perf_counter() >= record_after:
+                target.errors += 1
+            close = True
+            await asyncio.sleep(0.05)
+        if close and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run_target(target, connections, duration, warmup, timeout):
+    started = time.perf_counter()
+    record_after = started + warmup
+    deadline = record_after + duration
+    await asyncio.gather(*(connection_loop(target, worker, deadline, record_after, timeout)
+                           for worker in range(connections)))
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def summarize(target, duration):
+    latencies = sorted(target.latencies)
+    ok = sum(count for status, count in target.statuses.items() if 200 <= status < 400)
+    return {
+        'target': target.name,
+        'requests': len(latencies),
+        'rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 1) if latencies else 0.0,
+        'non_2xx_3xx': len(latencies) - ok,
+        'errors': target.errors,
+    }
+
+
+def raise_file_limit(connections):
+    '''Поднимает мягкий лимит открытых файлов под нужное число соединений'''
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = connections + 100
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE,
+                           (min(wanted, hard) if hard != resource.RLIM_INFINITY else wanted, hard))
@@ -0,0 +1,106 @@
+import json
+import platform
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (override_settings, setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+from django.utils import timezone
+
+from marketplace import benchmarks
+from marketplace.management.commands.generate_bench_data import add_data_arguments, data_options
+
+# Страницы для замера пропускной способности по HTTP
+HTTP_ENDPOINTS = ('post_list', 'post_list_search', 'post_detail')
+
+
+class Command(BaseCommand):
+    help = ('Замеряет задержку, пропускную способность и число запросов страниц '
+            'на синтетических данных во временной тестовой базе и сравнивает '
+            'результат с базовым файлом (--baseline)')
+
+    def add_arguments(self, parser):
+        add_data_arguments(parser)
+        parser.set_defaults(users=100, posts=2000)
+        parser.add_argument('--existing', action='store_true',
+                            help='Замерять на текущей базе (данные из generate_bench_data)')
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--only', action='append', help='Замерять только эти страницы')
+        parser.add_argument('--http-duration', type=float, default=5.0,
+                            help='Секунды HTTP-нагрузки на страницу (0 - не замерять)')
+        parser.add_argument('--connections', type=int, default=32)
+        parser.add_argument('--listing-cache', action='store_true',
+                            help='Не отключать кэш ленты для анонимных пользователей')
+        parser.add_argument('--output', default='bench-results.json')
+        parser.add_argument('--baseline', help='Файл с результатами для сравнения')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Допустимое ухудшение задержки/rps, доля')
+
+    def handle(self, *args, **options):
+        setup_test_environment(debug=False)
+        old_config = None
+        settings_override = override_settings(
+            MARKETPLACE_DERIVATIVES_ASYNC=False,
+            **({} if options['listing_cache'] else {'MARKETPLACE_LISTING_CACHE_TIMEOUT': 0}),
+        )
+        settings_override.enable()
+        try:
+            if options['existing']:
+                data = {'existing': True}
+            else:
+                old_config = setup_databases(verbosity=0, interactive=False)
+                started = time.perf_counter()
+                data = benchmarks.generate_data(**data_options(options))
+                self.stdout.write(f'Данные: {data} за {time.perf_counter() - started:.1f} с')
+            results = self.measure(options, data)
+        finally:
+            if old_config is not None:
+                teardown_databases(old_config, verbosity=0)
+            settings_override.disable()
+            teardown_test_environment()
+
+        with open(options['output'], 'w') as fh:
+            json.dump(results, fh, indent=2, ensure_ascii=False)
+        self.stdout.write(f'Результаты сохранены в {options["output"]}')
+
+        if options['baseline']:
+            with open(options['baseline']) as fh:
+                baseline = json.load(fh)
+            problems = benchmarks.compare(results, baseline, options['threshold'])
+            if problems:
+                raise CommandError('Регрессии относительно базового файла:\n'
+                                   + '\n'.join(problems))
+            self.stdout.write(self.style.SUCCESS('Регрессий нет'))
+
+    def measure(self, options, data):
+        endpoints = benchmarks.run_endpoints(options['iterations'], options['warmup'],
+                                             options['only'])
+        self.stdout.write(f'{"страница":<22}{"p50":>9}{"p95":>9}{"rps":>9}{"запросов":>10}')
+        for name, row in endpoints.items():
+            self.stdout.write(f'{name:<22}{row["p50_ms"]:>9}{row["p95_ms"]:>9}{row["rps"]:>9}'
+                              f'{row["queries"]:>10}')
+
+        http = {}
+        if options['http_duration']:
+            paths = {name: endpoints[name]['path'] for name in HTTP_ENDPOINTS if name in endpoints}
+            http = benchmarks.run_http(paths, options['connections'], options['http_duration'])
+            for name, row in http.items():
+                self.stdout.write(f'HTTP {name}: {row["rps"]} rps, p95 {row["p95_ms"]} мс, '
+                                  f'ошибок {row["errors"]}, не 2xx/3xx {row["non_2xx_3xx"]}')
+
+        return {
+            'meta': {
+                'created_at': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'data': data,
+                'iterations': options['iterations'],
+                'listing_cache': options['listing_cache'],
+            },
+            'endpoints': endpoints,
+            'http': http,
+        }
@@ -0,0 +1,44 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import (override_settings, setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+
+from marketplace import benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Рендер карточек ленты во временной тестовой базе: без кэша карточек, '
+            'с пустым кэшем (set_many) и с заполненным (get_many)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=500)
+        parser.add_argument('--page-size', type=int, action='append', dest='page_sizes',
+                            help='Карточек на странице (по умолчанию 12 и 48)')
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--json', help='Сохранить результаты в файл')
+
+    def handle(self, *args, **options):
+        setup_test_environment(debug=False)
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(MARKETPLACE_DERIVATIVES_ASYNC=False):
+                started = time.perf_counter()
+                data = benchmarks.generate_data(users=50, categories=10, posts=options['posts'],
+                                                media_per_post=1, responses_per_post=0)
+                self.stdout.write(f'Данные: {data} за {time.perf_counter() - started:.1f} с')
+                results = benchmarks.run_card_benchmark(options['page_sizes'] or (12, 48),
+                                                        options['iterations'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f'{"замер":<14}{"карточек":>10}{"запросов":>10}'
+                          f'{"карточки, мс":>14}{"страница, мс":>14}')
+        for name, row in results.items():
+            self.stdout.write(f'{name:<14}{row["cards"]:>10}{row["queries"]:>10}'
+                              f'{row["cards_p50_ms"]:>14}{row["page_p50_ms"]:>14}')
+        if options['json']:
+            with open(options['json'], 'w') as fh:
+                json.dump(results, fh, indent=2)
@@ -0,0 +1,49 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import (setup_databases, setup_test_environment, teardown_databases,
+                               teardown_test_environment)
+
+from marketplace import benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Пропускная способность уведомлений об отзывах во временной тестовой базе: '
+            'письмо на каждый отзыв против сводок send_digests')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--posts', type=int, default=20_000)
+        parser.add_argument('--responses', type=int, default=5,
+                            help='Отзывов на объявление в среднем (всего ~ posts * responses)')
+        parser.add_argument('--sample', type=int, default=2000,
+                            help='Отзывов для замера режима "письмо на отзыв"')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--json', help='Сохранить результаты в файл')
+
+    def handle(self, *args, **options):
+        setup_test_environment(debug=False)
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            started = time.perf_counter()
+            data = benchmarks.generate_data(users=options['users'], categories=10,
+                                            posts=options['posts'], media_per_post=0,
+                                            responses_per_post=options['responses'])
+            self.stdout.write(f'Данные: {data} за {time.perf_counter() - started:.1f} с')
+            results = benchmarks.run_notification_benchmark(
+                options['sample'], options['batch_size'], options['threads'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f'{"режим":<14}{"отзывов":>9}{"писем":>8}{"в очередь, с":>14}'
+                          f'{"отправка, с":>13}{"отзывов/с":>11}')
+        for mode, row in results.items():
+            self.stdout.write(f'{mode:<14}{row["notifications"]:>9}{row["emails"]:>8}'
+                              f'{row["enqueue_s"]:>14}{row["send_s"]:>13}'
+                              f'{row["notifications_per_s"]:>11}')
+        if options['json']:
+            with open(options['json'], 'w') as fh:
+                json.dump(results, fh, indent=2, ensure_ascii=False)
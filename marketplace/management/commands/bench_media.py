@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from marketplace import benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Отдача медиафайла целиком и диапазонами: чтение в Python (stream), '
+            'sendfile через wsgi.file_wrapper и X-Accel-Redirect с передачей прокси (offload)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size-mb', type=int, default=50)
+        parser.add_argument('--clients', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=5.0, help='Секунды на каждый замер')
+        parser.add_argument('--range-kb', type=int, default=1024,
+                            help='Размер диапазона в режиме перемотки')
+        parser.add_argument('--mode', action='append', dest='modes',
+                            choices=benchmarks.MEDIA_MODES)
+        parser.add_argument('--json', help='Сохранить результаты в файл')
+
+    def handle(self, *args, **options):
+        results = benchmarks.run_media_benchmark(
+            options['size_mb'], options['clients'], options['duration'], options['range_kb'],
+            options['modes'] or benchmarks.MEDIA_MODES)
+
+        self.stdout.write(f'{"замер":<16}{"запросов":>10}{"запр/с":>10}{"МБ/с":>10}'
+                          f'{"CPU с/ГБ":>10}{"ошибок":>8}')
+        for name, row in results.items():
+            self.stdout.write(f'{name:<16}{row["requests"]:>10}{row["requests_per_s"]:>10}'
+                              f'{row["mb_per_s"]:>10}{str(row["cpu_s_per_gb"]):>10}'
+                              f'{row["errors"]:>8}')
+        if options['json']:
+            with open(options['json'], 'w') as fh:
+                json.dump(results, fh, indent=2)
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import (setup_databases, setup_test_environment, teardown_databases,
+                               teardown_test_environment)
+
+from marketplace import benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Замеряет первую страницу поиска ленты (запрос PostView и COUNT пагинатора) '
+            'во временной тестовой базе, рабочая база не затрагивается')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=100_000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--page-size', type=int, default=12)
+        parser.add_argument('--words', type=int, default=2, help='Слов в запросе')
+        parser.add_argument('--max-ms', type=float, default=10.0,
+                            help='Порог p95 в миллисекундах')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        setup_test_environment(debug=False)
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            started = time.perf_counter()
+            data = benchmarks.generate_data(users=100, categories=10, posts=options['posts'],
+                                            media_per_post=0, responses_per_post=0,
+                                            seed=options['seed'])
+            self.stdout.write(f'Данные: {data} за {time.perf_counter() - started:.1f} с')
+            result = benchmarks.run_search_benchmark(options['queries'], options['page_size'],
+                                                     options['words'], options['seed'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f'{result["backend"]}: запросов к БД на страницу {result["queries"]}, '
+                          f'p50 {result["p50_ms"]:.2f} мс, p95 {result["p95_ms"]:.2f} мс, '
+                          f'пустых страниц {result["empty_pages"]}')
+        if result['p95_ms'] > options['max_ms']:
+            raise CommandError(f'p95 {result["p95_ms"]:.2f} мс превышает порог {options["max_ms"]} мс')
@@ -0,0 +1,82 @@
+import json
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import (override_settings, setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+
+from marketplace import benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Первый ответ страниц после старта процесса и установившееся время ответа '
+            'в профилях настроек: без кэша шаблонов, разработка (DEBUG) и продакшен '
+            '(MARKETPLACE_PRODUCTION). Каждый профиль замеряется в отдельном процессе')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', action='append', dest='profiles',
+                            choices=benchmarks.STARTUP_PROFILES)
+        parser.add_argument('--iterations', type=int, default=100)
+        parser.add_argument('--posts', type=int, default=500)
+        parser.add_argument('--child', choices=benchmarks.STARTUP_PROFILES,
+                            help='Внутренний режим: замер одного профиля в этом процессе')
+        parser.add_argument('--json', help='Сохранить результаты в файл')
+
+    def handle(self, *args, **options):
+        if options['child']:
+            result = self.measure(options['child'], options)
+            self.stdout.write(json.dumps(result))
+            return
+
+        results = {}
+        for profile in options['profiles'] or benchmarks.STARTUP_PROFILES:
+            started = time.perf_counter()
+            child = subprocess.run(
+                [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'bench_startup',
+                 '--child', profile, '--iterations', str(options['iterations']),
+                 '--posts', str(options['posts'])],
+                cwd=settings.BASE_DIR, capture_output=True, text=True)
+            if child.returncode:
+                raise CommandError(f'{profile}: {child.stderr.strip()}')
+            results[profile] = json.loads(child.stdout.strip().splitlines()[-1])
+            results[profile]['process_s'] = round(time.perf_counter() - started, 2)
+
+        self.stdout.write(f'{"профиль":<13}{"страница":<18}{"первый, мс":>12}'
+                          f'{"p50, мс":>10}{"p95, мс":>10}{"HTML, байт":>12}')
+        for profile, result in results.items():
+            for name, row in result['pages'].items():
+                self.stdout.write(f'{profile:<13}{name:<18}{row["first_ms"]:>12}'
+                                  f'{row["p50_ms"]:>10}{row["p95_ms"]:>10}'
+                                  f'{row["html_bytes"]:>12}')
+            if 'static' in result:
+                static = result['static']
+                self.stdout.write(f'{profile:<13}collectstatic {static["collectstatic_s"]} с, '
+                                  f'CSS {static["css_bytes"]} байт, '
+                                  f'gzip {static["css_gzip_bytes"]} байт')
+        if options['json']:
+            with open(options['json'], 'w') as fh:
+                json.dump(results, fh, indent=2)
+
+    def measure(self, profile, options):
+        setup_test_environment(debug=False)
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            benchmarks.generate_data(users=50, categories=10, posts=options['posts'],
+                                     media_per_post=1, responses_per_post=2)
+            with tempfile.TemporaryDirectory() as static_root, \
+                    override_settings(MARKETPLACE_LISTING_CACHE_TIMEOUT=0,
+                                      MARKETPLACE_DERIVATIVES_ASYNC=False,
+                                      MARKETPLACE_INSTRUMENTATION=False,
+                                      **benchmarks.startup_profile_settings(profile, static_root)):
+                result = {}
+                if profile == 'production':
+                    result['static'] = benchmarks.collect_static()
+                result['pages'] = benchmarks.run_startup_profile(options['iterations'])
+                return result
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
@@ -0,0 +1,55 @@
+import re
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+
+from marketplace.views import PostView, MyPostList, ResponseListView
+
+# Полный проход по таблице в выводе EXPLAIN (SQLite / PostgreSQL)
+FULL_SCAN_RE = re.compile(r'\bSCAN (?!.*\bUSING\b)|\bSeq Scan\b')
+
+LISTING_FILTERS = [
+    {},
+    {'category': '1'},
+    {'type_post': 'wts'},
+    {'category': '1', 'type_post': 'wts'},
+    {'price_min': '10', 'price_max': '1000'},
+    {'category': '1', 'type_post': 'wtb', 'price_min': '10'},
+]
+
+
+class Command(BaseCommand):
+    help = 'Проверяет планы запросов списков объявлений и откликов на полный проход по таблице'
+
+    def query_shapes(self):
+        factory = RequestFactory()
+        user = User(pk=1)
+
+        for params in LISTING_FILTERS:
+            view = PostView(request=factory.get('/', params), kwargs={})
+            yield f'PostView {params}', view.get_queryset()
+
+        request = factory.get('/')
+        request.user = user
+        yield 'MyPostList', MyPostList(request=request, kwargs={}).get_queryset()
+        yield 'ResponseListView', ResponseListView(request=request, kwargs={}).get_queryset()
+
+        request = factory.get('/', {'post': 'slug'})
+        request.user = user
+        yield 'ResponseListView post=slug', ResponseListView(request=request, kwargs={}).get_queryset()
+
+    def handle(self, *args, **options):
+        failed = []
+        for name, queryset in self.query_shapes():
+            plan = queryset.explain()
+            if FULL_SCAN_RE.search(plan):
+                failed.append(name)
+                self.stdout.write(self.style.ERROR(f'{name}: полный проход по таблице'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'{name}: OK'))
+            if options['verbosity'] > 1:
+                self.stdout.write(plan)
+
+        if failed:
+            raise CommandError(f'Полный проход по таблице в {len(failed)} запросах: {", ".join(failed)}')
@@ -0,0 +1,54 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import default_storage, storages
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace.models import MediaBlob, PostMedia
+from marketplace.storage import BLOB_PREFIX, DeduplicatingStorage, hash_content
+
+
+def _hash_file(name):
+    with default_storage.open(name, 'rb') as f:
+        return hash_content(f)
+
+
+class Command(BaseCommand):
+    help = ('Переносит медиафайлы, сохранённые до включения дедупликации, '
+            'в хранилище по SHA-256 и схлопывает дубликаты')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Потоков для подсчёта хэшей')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только посчитать, сколько места освободится')
+
+    def handle(self, *args, **options):
+        storage = storages['default']
+        if not options['dry_run'] and not isinstance(storage, DeduplicatingStorage):
+            raise CommandError('Хранилище по умолчанию должно быть DeduplicatingStorage')
+
+        media_list = [media for media in PostMedia.objects.exclude(file='')
+                      .exclude(file__startswith=BLOB_PREFIX).only('id', 'file')
+                      if default_storage.exists(media.file.name)]
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            hashes = list(executor.map(_hash_file, [media.file.name for media in media_list]))
+
+        known = set(MediaBlob.objects.values_list('sha256', flat=True))
+        saved = 0
+        for media, (sha256, size) in zip(media_list, hashes):
+            if sha256 in known:
+                saved += size
+            known.add(sha256)
+            if options['dry_run']:
+                continue
+            old_name = media.file.name
+            with default_storage.open(old_name, 'rb') as f:
+                new_name = storage.save_blob(f, os.path.splitext(old_name)[1].lower(), sha256, size)
+            PostMedia.objects.filter(pk=media.pk).update(file=new_name)
+            storage.inner.delete(old_name)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Файлов: {len(media_list)}, освобождено: {saved / 1024 / 1024:.1f} МБ ({saved} байт)'
+            + (' (пробный запуск)' if options['dry_run'] else '')
+        ))
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from marketplace.benchmarks import generate_data
+
+
+def add_data_arguments(parser):
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--posts', type=int, default=100_000)
+    parser.add_argument('--media', type=int, default=1, help='Медиафайлов на объявление в среднем')
+    parser.add_argument('--responses', type=int, default=2, help='Отзывов на объявление в среднем')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch-size', type=int, default=5000)
+
+
+def data_options(options):
+    return {'users': options['users'], 'categories': options['categories'],
+            'posts': options['posts'], 'media_per_post': options['media'],
+            'responses_per_post': options['responses'], 'seed': options['seed'],
+            'batch_size': options['batch_size']}
+
+
+class Command(BaseCommand):
+    help = ('Наполняет текущую базу синтетическими данными для замеров '
+            '(пользователи bench*, пароль bench)')
+
+    def add_arguments(self, parser):
+        add_data_arguments(parser)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        totals = generate_data(log=self.stdout.write, **data_options(options))
+        self.stdout.write(self.style.SUCCESS(
+            ', '.join(f'{name}: {count}' for name, count in totals.items())
+            + f' за {time.perf_counter() - started:.1f} с'
+        ))
@@ -0,0 +1,48 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace import derivatives
+from marketplace.models import PostMedia
+
+
+def _render_file(path, is_image):
+    '''Выполняется в процессе пула: читает оригинал и рендерит превью'''
+    data = b''
+    if is_image:
+        with open(path, 'rb') as f:
+            data = f.read()
+    return derivatives.render(data, is_image)
+
+
+class Command(BaseCommand):
+    help = 'Создаёт превью для уже загруженных медиафайлов (параллельно, в пуле процессов)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--force', action='store_true',
+                            help='Пересоздать превью и для файлов, у которых они уже есть')
+
+    def handle(self, *args, **options):
+        if derivatives.Image is None:
+            raise CommandError('Для создания превью нужен Pillow')
+
+        queryset = PostMedia.objects.exclude(file='')
+        if not options['force']:
+            queryset = queryset.filter(derivatives={})
+
+        done = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {}
+            for media in queryset.iterator():
+                futures[executor.submit(_render_file, media.file.path, media.is_image)] = media
+            for future in as_completed(futures):
+                media = futures[future]
+                try:
+                    derivatives.store_derivatives(media.pk, media.file.name, future.result())
+                    done += 1
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{media.file.name}: {e}')
+
+        self.stdout.write(self.style.SUCCESS(f'Превью созданы: {done}, ошибок: {failed}'))
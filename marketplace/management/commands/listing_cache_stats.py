@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.caching import listing_cache_stats, reset_listing_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Показывает долю попаданий в кэш ленты объявлений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Обнулить счётчики')
+
+    def handle(self, *args, **options):
+        stats = listing_cache_stats()
+        self.stdout.write(f'Попаданий: {stats["hits"]}, промахов: {stats["misses"]}, '
+                          f'доля попаданий: {stats["ratio"]:.1%}')
+        if options['reset']:
+            reset_listing_cache_stats()
+            self.stdout.write('Счётчики обнулены')
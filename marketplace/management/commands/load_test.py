@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from marketplace.loaddriver import Target, raise_file_limit, run_target, summarize
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный тест: много одновременных keep-alive соединений к запущенным '
+            'серверам, например WSGI и ASGI:\n'
+            '  gunicorn mmo_marketplace.wsgi -w 4 --threads 8 -b :8000\n'
+            '  uvicorn mmo_marketplace.asgi:application --workers 4 --port 8001\n'
+            '  python manage.py load_test wsgi=http://127.0.0.1:8000 asgi=http://127.0.0.1:8001')
+
+    def add_arguments(self, parser):
+        parser.add_argument('targets', nargs='+', help='имя=URL сервера')
+        parser.add_argument('--path', action='append', dest='paths', default=[],
+                            help='Путь для запросов (можно несколько, по кругу)')
+        parser.add_argument('--connections', type=int, default=500)
+        parser.add_argument('--duration', type=float, default=10.0, help='Секунды замера')
+        parser.add_argument('--warmup', type=float, default=2.0, help='Секунды без учёта')
+        parser.add_argument('--timeout', type=float, default=10.0,
+                            help='Таймаут одного запроса, секунды (превышение - ошибка)')
+        parser.add_argument('--json', help='Сохранить результаты в файл')
+
+    def handle(self, *args, **options):
+        targets = []
+        for spec in options['targets']:
+            name, sep, url = spec.partition('=')
+            if not sep:
+                name, url = f'target{len(targets) + 1}', spec
+            try:
+                targets.append(Target(name, url, options['paths']))
+            except ValueError as e:
+                raise CommandError(e)
+        raise_file_limit(options['connections'])
+
+        results = []
+        for target in targets:
+            self.stdout.write(f'{target.name}: {options["connections"]} соединений, '
+                              f'{options["duration"]} с...')
+            asyncio.run(run_target(target, options['connections'], options['duration'],
+                                   options['warmup'], options['timeout']))
+            results.append(summarize(target, options['duration']))
+
+        self.stdout.write(f'{"цель":<10}{"запросов":>10}{"rps":>10}{"p50":>9}{"p95":>9}'
+                          f'{"p99":>9}{"ошибок":>8}{"не 2xx":>8}')
+        for row in results:
+            self.stdout.write(f'{row["target"]:<10}{row["requests"]:>10}{row["rps"]:>10}'
+                              f'{row["p50_ms"]:>9}{row["p95_ms"]:>9}{row["p99_ms"]:>9}'
+                              f'{row["errors"]:>8}{row["non_2xx_3xx"]:>8}')
+        base = results[0]
+        for row in results[1:]:
+            if base['rps']:
+                self.stdout.write(f'{row["target"]} / {base["target"]}: '
+                                  f'{row["rps"] / base["rps"]:.2f}x по пропускной способности')
+
+        if options['json']:
+            with open(options['json'], 'w') as fh:
+                json.dump({'connections': options['connections'],
+                           'duration': options['duration'], 'results': results}, fh, indent=2)
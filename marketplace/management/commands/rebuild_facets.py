@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from marketplace.caching import bump_listing_version
+from marketplace.facets import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счётчики панели фильтров (категории, типы, диапазоны цен)'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            fixed = rebuild()
+        if fixed:
+            bump_listing_version()
+        self.stdout.write(self.style.SUCCESS(f'Исправлено счётчиков: {fixed}'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.models import Post
+from marketplace.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает поисковый индекс объявлений'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        backend.rebuild(Post.objects.all())
+        self.stdout.write(self.style.SUCCESS(
+            f'Индекс перестроен ({type(backend).__name__}): {Post.objects.count()} объявлений'
+        ))
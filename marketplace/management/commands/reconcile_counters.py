@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from marketplace.counters import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает денормализованные счётчики объявлений и профилей'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            fixed = reconcile()
+        self.stdout.write(self.style.SUCCESS(
+            f'Исправлено объявлений: {fixed["posts"]}, профилей: {fixed["profiles"]}'
+        ))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from marketplace.media_gc import find_orphans, record_tombstones
+
+
+class Command(BaseCommand):
+    help = 'Ищет в MEDIA_ROOT файлы, на которые нет ссылок в базе'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=3600,
+                            help='Не трогать файлы моложе стольких секунд')
+        parser.add_argument('--delete', action='store_true',
+                            help='Поставить найденные файлы в очередь sweep_media')
+
+    def handle(self, *args, **options):
+        count = size = 0
+        batch = []
+        for name, file_size in find_orphans(options['grace']):
+            count += 1
+            size += file_size
+            if options['verbosity'] > 1:
+                self.stdout.write(name)
+            if options['delete']:
+                batch.append(name)
+                if len(batch) >= 1000:
+                    record_tombstones(batch)
+                    batch = []
+        if batch:
+            record_tombstones(batch)
+
+        action = 'поставлено в очередь на удаление' if options['delete'] else 'найдено'
+        self.stdout.write(self.style.SUCCESS(
+            f'Файлов без ссылок {action}: {count} ({size / 1024 / 1024:.1f} МБ)'))
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from marketplace.digests import process_digests
+
+
+class Command(BaseCommand):
+    help = ('Собирает накопившиеся отзывы в сводки для авторов с включёнными сводками '
+            'и ставит их в очередь писем (отправляет send_outbox)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Авторов в одной транзакции')
+        parser.add_argument('--loop', action='store_true',
+                            help='Работать постоянно, а не один проход')
+        parser.add_argument('--interval', type=float, default=60.0,
+                            help='Пауза между проходами в режиме --loop, секунды')
+
+    def handle(self, *args, **options):
+        while True:
+            digests, notifications = process_digests(options['batch_size'])
+            if digests or notifications:
+                self.stdout.write(f'Сводок: {digests}, отзывов в них: {notifications}')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from marketplace.outbox import process_outbox
+
+
+class Command(BaseCommand):
+    help = 'Отправляет письма из очереди OutgoingEmail'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--threads', type=int, default=4,
+                            help='Потоков отправки, у каждого своё SMTP-соединение')
+        parser.add_argument('--loop', action='store_true',
+                            help='Работать постоянно, а не до опустошения очереди')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='Пауза между проверками очереди в режиме --loop, секунды')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = process_outbox(options['batch_size'], options['threads'])
+            if sent or failed:
+                self.stdout.write(f'Отправлено: {sent}, с ошибкой: {failed}')
+                continue
+            # Очередь пуста (или в ней только письма, ждущие повтора)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
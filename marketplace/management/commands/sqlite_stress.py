@@ -0,0 +1,81 @@
+import copy
+import json
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import (override_settings, setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+
+from marketplace import benchmarks
+
+MODES = ('default', 'tuned')
+
+
+class Command(BaseCommand):
+    help = ('Конкурентные записи и чтения ленты из потоков на временной файловой базе '
+            'SQLite: с настройками по умолчанию и с профилем MARKETPLACE_SQLITE_PROFILE')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', action='append', choices=MODES,
+                            help='Какие настройки замерять (по умолчанию оба)')
+        parser.add_argument('--writers', type=int, default=8)
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=5.0)
+        parser.add_argument('--posts', type=int, default=1000, help='Объявлений в базе до замера')
+        parser.add_argument('--json', help='Сохранить результаты в файл')
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('Команда замеряет только SQLite')
+        results = {}
+        setup_test_environment(debug=False)
+        try:
+            # Под нагрузкой почти каждый запрос "медленный" - не засоряем вывод
+            with override_settings(MARKETPLACE_LISTING_CACHE_TIMEOUT=0,
+                                   MARKETPLACE_DERIVATIVES_ASYNC=False,
+                                   MARKETPLACE_SLOW_REQUEST_MS=60_000,
+                                   MARKETPLACE_NPLUSONE_THRESHOLD=10_000), \
+                    tempfile.TemporaryDirectory() as directory:
+                for mode in options['mode'] or MODES:
+                    self.stdout.write(f'{mode}: {options["writers"]} писателей, '
+                                      f'{options["readers"]} читателей, {options["duration"]} с...')
+                    results[mode] = self.measure(mode, os.path.join(directory, f'{mode}.sqlite3'),
+                                                 options)
+        finally:
+            teardown_test_environment()
+
+        self.stdout.write(f'{"режим":<10}{"записей/с":>11}{"p95 записи":>12}{"чтений/с":>10}'
+                          f'{"p95 чтения":>12}{"locked":>8}')
+        for mode, row in results.items():
+            self.stdout.write(f'{mode:<10}{row["writes_per_s"]:>11}{row["write_p95_ms"]:>12}'
+                              f'{row["reads_per_s"]:>10}{row["read_p95_ms"]:>12}{row["locked"]:>8}')
+            for error in row['errors']:
+                self.stderr.write(f'{mode}: {error}')
+        if options['json']:
+            with open(options['json'], 'w') as fh:
+                json.dump(results, fh, indent=2, ensure_ascii=False)
+
+    def measure(self, mode, name, options):
+        # Словарь настроек общий для соединений всех потоков
+        settings_dict = connections['default'].settings_dict
+        saved = copy.deepcopy(settings_dict)
+        connections['default'].close()
+        settings_dict['TEST'] = {**settings_dict.get('TEST', {}), 'NAME': name}
+        if mode == 'tuned':
+            settings_dict.update(copy.deepcopy(settings.MARKETPLACE_SQLITE_PROFILE))
+        else:
+            settings_dict.update(OPTIONS={}, CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False)
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            writers = options['writers']
+            benchmarks.generate_data(users=writers + 1, categories=5, posts=options['posts'],
+                                     media_per_post=0, responses_per_post=0)
+            return benchmarks.run_write_stress(writers, options['readers'], options['duration'])
+        finally:
+            connections.close_all()
+            teardown_databases(old_config, verbosity=0)
+            settings_dict.clear()
+            settings_dict.update(saved)
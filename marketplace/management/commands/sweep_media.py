@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from marketplace.media_gc import sweep
+
+
+class Command(BaseCommand):
+    help = 'Удаляет из хранилища файлы удалённых медиафайлов (MediaTombstone)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--max-attempts', type=int, default=5)
+        parser.add_argument('--loop', action='store_true',
+                            help='Работать постоянно, а не до опустошения очереди')
+        parser.add_argument('--interval', type=float, default=30.0)
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            deleted, failed = sweep(options['batch_size'], options['threads'],
+                                    options['max_attempts'])
+            total += deleted
+            if deleted or failed:
+                self.stdout.write(f'Удалено: {deleted}, с ошибкой: {failed}')
+                if deleted:
+                    continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(f'Всего удалено файлов: {total}'))
@@ -0,0 +1,114 @@
+'''
+Сборка мусора в хранилище медиафайлов.
+
+Удаление PostMedia (через delete(), QuerySet.delete() или каскадом от Post
+и User) только записывает имена файлов в MediaTombstone - в той же
+транзакции и без обращений к хранилищу. Сами файлы удаляет sweep():
+пачками, в пуле потоков. find_orphans() потоково обходит MEDIA_ROOT и
+находит файлы, на которые нет ссылок в базе.
+'''
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import storages
+from django.db.models import F
+
+from .derivatives import derivative_files
+from .models import MediaBlob, MediaTombstone, PostMedia, UploadSession
+
+logger = logging.getLogger('marketplace')
+
+
+def media_file_names(media):
+    '''Все файлы медиафайла в хранилище: оригинал и превью'''
+    names = [media.file.name] if media.file else []
+    return names + derivative_files(media.derivatives or {})
+
+
+def record_tombstones(names):
+    MediaTombstone.objects.bulk_create(MediaTombstone(name=name) for name in names)
+
+
+def _delete_files(storage, names, threads):
+    '''Удаляет файлы в пуле потоков. None в списке - пропустить. Возвращает ошибки'''
+    def delete(name):
+        if name is None:
+            return None
+        try:
+            storage.delete(name)
+            return None
+        except Exception as e:
+            return str(e) or e.__class__.__name__
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(delete, names))
+
+
+def sweep(batch_size=500, threads=8, max_attempts=5):
+    '''Удаляет из хранилища одну пачку файлов. Возвращает (удалено, с ошибкой)'''
+    tombstones = list(MediaTombstone.objects.filter(attempts__lt=max_attempts)
+                      .order_by('id')[:batch_size])
+    if not tombstones:
+        return 0, 0
+
+    storage = storages['default']
+    names = [tombstone.name for tombstone in tombstones]
+    if hasattr(storage, 'release'):
+        # Счётчики ссылок обновляем здесь, в потоки уходит только файловый ввод-вывод
+        physical = [name if storage.release(name) else None for name in names]
+        storage = storage.inner
+    else:
+        physical = names
+    errors = _delete_files(storage, physical, threads)
+
+    done = [tombstone.pk for tombstone, error in zip(tombstones, errors) if error is None]
+    MediaTombstone.objects.filter(pk__in=done).delete()
+    for tombstone, error in zip(tombstones, errors):
+        if error is not None:
+            logger.error(f'Ошибка при удалении {tombstone.name}: {error}')
+            MediaTombstone.objects.filter(pk=tombstone.pk).update(
+                attempts=F('attempts') + 1, last_error=error)
+    return len(done), len(tombstones) - len(done)
+
+
+def iter_files(root, relative=''):
+    '''Потоковый обход каталога (os.scandir), без построения полного списка'''
+    with os.scandir(os.path.join(root, relative)) as entries:
+        for entry in entries:
+            name = f'{relative}/{entry.name}' if relative else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(root, name)
+            elif entry.is_file(follow_symlinks=False):
+                yield name, entry.stat(follow_symlinks=False)
+
+
+def referenced_names():
+    names = set()
+    for media in PostMedia.objects.only('file', 'derivatives').iterator():
+        names.update(media_file_names(media))
+    names.update(MediaBlob.objects.values_list('name', flat=True).iterator())
+    names.update(MediaTombstone.objects.values_list('name', flat=True).iterator())
+    return names
+
+
+def find_orphans(grace_seconds=3600):
+    '''
+    Файлы в MEDIA_ROOT без ссылок из базы. Свежие файлы (моложе
+    grace_seconds) и части активных загрузок пропускаются - их могут
+    записывать прямо сейчас.
+    '''
+    root = str(settings.MEDIA_ROOT)
+    if not os.path.isdir(root):
+        return
+    referenced = referenced_names()
+    active_uploads = {f'uploads/{pk}/' for pk in UploadSession.objects.values_list('pk', flat=True)}
+    deadline = time.time() - grace_seconds
+    for name, stat in iter_files(root):
+        if name in referenced or stat.st_mtime > deadline:
+            continue
+        if any(name.startswith(prefix) for prefix in active_uploads):
+            continue
+        yield name, stat.st_size
@@ -0,0 +1,252 @@
+'''
+Отдача медиафайлов из MEDIA_ROOT по MEDIA_URL (MediaFileView).
+
+Поддерживаются условные запросы (сильный ETag из inode, размера и времени
+изменения файла) и запросы одного диапазона байт (Range, If-Range) - для
+перемотки видео. Тело отдаётся через FileResponse открытым файлом: серверы
+с wsgi.file_wrapper (gunicorn) передают его через sendfile без копирования
+в Python, ровно Content-Length байт с текущей позиции.
+
+С MARKETPLACE_MEDIA_OFFLOAD приложение только проверяет имя файла
+и отвечает заголовком X-Accel-Redirect (nginx) или X-Sendfile (Apache,
+lighttpd), а передачу, диапазоны и условные запросы выполняет прокси.
+
+serve_static отдаёт собранную collectstatic статику из STATIC_ROOT, когда
+перед приложением нет прокси: сжатую заранее копию .br/.gz по Accept-Encoding,
+а файлы с хэшем содержимого в имени - с кэшированием на год (immutable).
+'''
+import mimetypes
+import os
+import re
+import stat
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+# Части незавершённых поблочных загрузок (uploads.part_name) наружу не отдаются
+PRIVATE_PREFIXES = ('uploads/',)
+
+OFFLOAD_HEADERS = {'x-accel-redirect': 'X-Accel-Redirect', 'x-sendfile': 'X-Sendfile'}
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Имя, которое даёт ManifestStaticFilesStorage: name.<12 знаков md5>.ext
+HASHED_STATIC_RE = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def media_offload():
+    return getattr(settings, 'MARKETPLACE_MEDIA_OFFLOAD', None)
+
+
+def media_max_age():
+    return getattr(settings, 'MARKETPLACE_MEDIA_MAX_AGE', 86400)
+
+
+def static_max_age():
+    return getattr(settings, 'MARKETPLACE_STATIC_MAX_AGE', 365 * 24 * 3600)
+
+
+def safe_path(root, name):
+    if not root or not name or '\\' in name:
+        raise Http404('Файл не найден')
+    try:
+        return safe_join(root, name)
+    except (SuspiciousFileOperation, ValueError):
+        raise Http404('Файл не найден')
+
+
+def media_path(name):
+    '''Путь к файлу в MEDIA_ROOT или Http404 для недопустимого имени'''
+    if name.startswith(PRIVATE_PREFIXES):
+        raise Http404('Файл не найден')
+    return safe_path(settings.MEDIA_ROOT, name)
+
+
+def regular_file_stat(path):
+    try:
+        file_stat = os.stat(path)
+    except (OSError, ValueError):
+        raise Http404('Файл не найден')
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise Http404('Файл не найден')
+    return file_stat
+
+
+def file_etag(file_stat):
+    return quote_etag(f'{file_stat.st_ino:x}-{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}')
+
+
+def parse_range(header, size):
+    '''
+    Один диапазон из заголовка Range: (начало, конец включительно).
+    None - заголовок не разобран (несколько диапазонов, другие единицы)
+    и файл отдаётся целиком; RangeNotSatisfiable - диапазон за концом файла.
+    '''
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Суффикс: последние N байт
+        if int(last) == 0 or size == 0:
+            raise RangeNotSatisfiable
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def if_range_matches(request, etag, last_modified):
+    '''If-Range: диапазон отдаётся, только если файл не менялся'''
+    value = request.headers.get('If-Range')
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith('"'):
+        return value == etag
+    return parse_http_date_safe(value) == last_modified
+
+
+class FileRange:
+    '''
+    Часть открытого файла для FileResponse. read() не выходит за диапазон,
+    fileno() позволяет серверу передать её через sendfile.
+    '''
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def patch_media_headers(response, content_type):
+    response['Content-Type'] = content_type
+    patch_cache_control(response, public=True, max_age=media_max_age())
+    return response
+
+
+def offload_response(name, path, content_type):
+    header = OFFLOAD_HEADERS[media_offload()]
+    response = HttpResponse(content_type=content_type)
+    if header == 'X-Accel-Redirect':
+        prefix = getattr(settings, 'MARKETPLACE_MEDIA_ACCEL_PREFIX', '/protected-media/')
+        response[header] = prefix + quote(name)
+    else:
+        response[header] = path
+    return patch_media_headers(response, content_type)
+
+
+def serve_media(request, name):
+    path = media_path(name)
+    file_stat = regular_file_stat(path)
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if media_offload():
+        return offload_response(name, path, content_type)
+
+    etag = file_etag(file_stat)
+    last_modified = int(file_stat.st_mtime)
+    headers = {'ETag': etag, 'Last-Modified': http_date(last_modified), 'Accept-Ranges': 'bytes'}
+    conditional = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if conditional is not None:
+        if conditional.status_code == 304:
+            for header, value in headers.items():
+                conditional[header] = value
+            patch_media_headers(conditional, content_type)
+        return conditional
+
+    size = file_stat.st_size
+    byte_range = None
+    range_header = request.headers.get('Range')
+    if range_header and if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            return HttpResponse(status=416, headers={'Content-Range': f'bytes */{size}', **headers})
+
+    start, end = byte_range or (0, size - 1)
+    length = end - start + 1 if size else 0
+    if request.method == 'HEAD':
+        response = HttpResponse(headers=headers)
+    else:
+        file = open(path, 'rb')
+        body = FileRange(file, start, length) if byte_range else file
+        response = FileResponse(body, headers=headers)
+    if byte_range:
+        response.status_code = 206
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(length)
+    return patch_media_headers(response, content_type)
+
+
+def accepted_encodings(request):
+    '''Кодировки из Accept-Encoding без явно запрещённых (q=0)'''
+    accepted = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = item.strip().lower().partition(';')
+        if coding and params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(coding)
+    return accepted
+
+
+def serve_static(request, name):
+    path = safe_path(settings.STATIC_ROOT, name)
+    file_stat = regular_file_stat(path)
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type == 'application/javascript':
+        content_type += '; charset=utf-8'
+
+    encoding = None
+    accepted = accepted_encodings(request)
+    for coding, suffix in PRECOMPRESSED:
+        if coding in accepted and os.path.isfile(path + suffix):
+            path, encoding = path + suffix, coding
+            file_stat = os.stat(path)
+            break
+
+    etag = file_etag(file_stat)
+    last_modified = int(file_stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if request.method == 'HEAD':
+            response = HttpResponse(content_type=content_type)
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type,
+                                    filename=os.path.basename(name))
+        response['Content-Length'] = str(file_stat.st_size)
+        if encoding:
+            response['Content-Encoding'] = encoding
+    if response.status_code in (200, 304):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        if HASHED_STATIC_RE.search(name):
+            patch_cache_control(response, public=True, max_age=static_max_age(), immutable=True)
+        else:
+            patch_cache_control(response, public=True, no_cache=True)
+        patch_vary_headers(response, ('Accept-Encoding',))
+    return response
@@ -0,0 +1,300 @@
+'''
+Метрики в текстовом формате Prometheus (счётчики и гистограммы) без
+внешних зависимостей. Отдаются представлением MetricsView по /metrics.
+
+В одном процессе значения хранятся в памяти. Если задан каталог
+MARKETPLACE_METRICS_DIR (по умолчанию берётся PROMETHEUS_MULTIPROC_DIR),
+каждый процесс пишет свои значения в собственный mmap-файл
+metrics_<pid>.db, а /metrics суммирует все файлы каталога - так счётчики
+корректны под gunicorn с несколькими воркерами. Каталог нужно очищать
+при перезапуске сервиса целиком, но не при перезапуске отдельного воркера.
+'''
+import json
+import mmap
+import os
+import struct
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   float('inf'))
+
+_registry = {}
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return f'{value:.1f}'
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class MemoryStore:
+    '''Значения метрик текущего процесса в памяти'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class MmapFile:
+    '''
+    Файл значений одного процесса. Формат: 4 байта - занятый размер,
+    4 байта выравнивания, затем записи: длина ключа (4 байта), ключ,
+    пробелы до границы 8 байт, значение double. Запись делает только
+    процесс-владелец, читатели видят записи до занятого размера.
+    '''
+    INITIAL_SIZE = 1 << 16
+
+    def __init__(self, path):
+        self._file = open(path, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size == 0:
+            self._file.truncate(self.INITIAL_SIZE)
+            size = self.INITIAL_SIZE
+        self._capacity = size
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self._positions = {}
+        self._used = struct.unpack_from('i', self._mmap, 0)[0]
+        if self._used == 0:
+            self._used = 8
+            struct.pack_into('i', self._mmap, 0, self._used)
+        else:
+            for key, _, position in _read_entries(self._mmap, self._used):
+                self._positions[key] = position
+
+    def _grow(self, needed):
+        while self._used + needed > self._capacity:
+            self._capacity *= 2
+        self._file.truncate(self._capacity)
+        self._mmap.close()
+        self._mmap = mmap.mmap(self._file.fileno(), self._capacity)
+
+    def _add(self, key):
+        encoded = key.encode()
+        padding = b' ' * ((8 - (4 + len(encoded)) % 8) % 8)
+        entry = struct.pack('i', len(encoded)) + encoded + padding + struct.pack('d', 0.0)
+        if self._used + len(entry) > self._capacity:
+            self._grow(len(entry))
+        self._mmap[self._used:self._used + len(entry)] = entry
+        self._used += len(entry)
+        # Размер обновляется после записи - читатель не увидит неполную запись
+        struct.pack_into('i', self._mmap, 0, self._used)
+        position = self._used - 8
+        self._positions[key] = position
+        return position
+
+    def inc(self, key, amount):
+        position = self._positions.get(key)
+        if position is None:
+            position = self._add(key)
+        value = struct.unpack_from('d', self._mmap, position)[0]
+        struct.pack_into('d', self._mmap, position, value + amount)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+def _read_entries(data, used):
+    position = 8
+    while position < used:
+        length = struct.unpack_from('i', data, position)[0]
+        key = bytes(data[position + 4:position + 4 + length]).decode()
+        position += 4 + length
+        position += (8 - position % 8) % 8
+        yield key, struct.unpack_from('d', data, position)[0], position
+        position += 8
+
+
+class MultiprocessStore:
+    '''Свой mmap-файл на процесс, чтение - сумма по всем файлам каталога'''
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+
+    def _current_file(self):
+        # После fork (gunicorn --preload) воркер открывает собственный файл
+        pid = os.getpid()
+        if self._pid != pid:
+            self._file = MmapFile(os.path.join(self.directory, f'metrics_{pid}.db'))
+            self._pid = pid
+        return self._file
+
+    def inc(self, key, amount):
+        with self._lock:
+            self._current_file().inc(key, amount)
+
+    def collect(self):
+        values = {}
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith('metrics_') and name.endswith('.db')):
+                continue
+            with open(os.path.join(self.directory, name), 'rb') as fh:
+                data = fh.read()
+            if len(data) < 8:
+                continue
+            used = struct.unpack_from('i', data, 0)[0]
+            for key, value, _ in _read_entries(data, used):
+                values[key] = values.get(key, 0.0) + value
+        return values
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                directory = getattr(settings, 'MARKETPLACE_METRICS_DIR', None)
+                _store = MultiprocessStore(directory) if directory else MemoryStore()
+    return _store
+
+
+@receiver(setting_changed)
+def _reset_store(setting, **kwargs):
+    global _store
+    if setting == 'MARKETPLACE_METRICS_DIR':
+        _store = None
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._keys = {}
+        _registry[name] = self
+
+    def _key(self, suffix, labels):
+        # Ключ сэмпла кэшируется: json.dumps на каждый inc заметно дороже
+        cache_key = (suffix, tuple(sorted(labels.items())))
+        key = self._keys.get(cache_key)
+        if key is None:
+            if set(labels) - {'le'} != set(self.labelnames):
+                raise ValueError(f'{self.name}: ожидаются метки {self.labelnames}, '
+                                 f'получены {tuple(labels)}')
+            key = json.dumps([self.name + suffix, dict(cache_key[1])], ensure_ascii=False)
+            self._keys[cache_key] = key
+        return key
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        get_store().inc(self._key('_total', labels), amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        store = get_store()
+        for bound in self.buckets:
+            if value <= bound:
+                # Корзины хранятся без накопления, сумма - при выводе
+                store.inc(self._key('_bucket', dict(labels, le=_format_value(bound))), 1)
+                break
+        store.inc(self._key('_sum', labels), value)
+        store.inc(self._key('_count', labels), 1)
+
+
+def _samples_by_metric():
+    grouped = {}
+    for key, value in get_store().collect().items():
+        sample, labels = json.loads(key)
+        for suffix in ('_total', '_bucket', '_sum', '_count'):
+            if sample.endswith(suffix) and sample[:-len(suffix)] in _registry:
+                grouped.setdefault(sample[:-len(suffix)], []).append((suffix, labels, value))
+                break
+    return grouped
+
+
+def _render_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def exposition():
+    '''Все метрики в текстовом формате Prometheus 0.0.4'''
+    grouped = _samples_by_metric()
+    lines = []
+    for name in sorted(_registry):
+        metric = _registry[name]
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        samples = grouped.get(name, [])
+        if metric.kind == 'counter':
+            for _, labels, value in sorted(samples, key=lambda s: sorted(s[1].items())):
+                lines.append(f'{name}_total{_render_labels(labels)} {_format_value(value)}')
+            continue
+
+        series = {}
+        for suffix, labels, value in samples:
+            le = labels.pop('le', None)
+            entry = series.setdefault(tuple(sorted(labels.items())), {'buckets': {}})
+            if suffix == '_bucket':
+                entry['buckets'][le] = value
+            else:
+                entry[suffix] = value
+        for label_items, entry in sorted(series.items()):
+            labels = dict(label_items)
+            cumulative = 0.0
+            for bound in metric.buckets:
+                le = _format_value(bound)
+                cumulative += entry['buckets'].get(le, 0.0)
+                lines.append(f'{name}_bucket{_render_labels(dict(labels, le=le))} '
+                             f'{_format_value(cumulative)}')
+            lines.append(f'{name}_sum{_render_labels(labels)} {_format_value(entry.get("_sum", 0.0))}')
+            lines.append(f'{name}_count{_render_labels(labels)} '
+                         f'{_format_value(entry.get("_count", 0.0))}')
+    return '\n'.join(lines) + '\n'
+
+
+def get_sample_value(sample, **labels):
+    '''Текущее значение сэмпла (например, для тестов), None если его нет'''
+    key = json.dumps([sample, dict(sorted(labels.items()))], ensure_ascii=False)
+    return get_store().collect().get(key)
+
+
+POSTS_CREATED = Counter('marketplace_posts_created', 'Созданные объявления', ['type_post'])
+RESPONSES_CREATED = Counter('marketplace_responses_created', 'Оставленные отзывы')
+RESPONSES_MODERATED = Counter('marketplace_responses_moderated',
+                              'Принятые, отклонённые и удалённые отзывы', ['action'])
+EMAILS_QUEUED = Counter('marketplace_emails_queued', 'Письма, поставленные в очередь')
+EMAILS_PROCESSED = Counter('marketplace_emails_processed',
+                           'Попытки отправки писем по результату', ['result'])
+MEDIA_FILES = Counter('marketplace_media_files', 'Добавленные медиафайлы', ['kind'])
+UPLOAD_BYTES = Counter('marketplace_upload_bytes', 'Принятые байты медиафайлов', ['source'])
+REQUEST_DURATION = Histogram('marketplace_request_duration_seconds',
+                             'Время обработки запроса по представлениям',
+                             ['view', 'method', 'status'])
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.6 on 2026-10-17 11:57
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0002_alter_postmedia_options_remove_postmedia_file_type_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['is_active', 'category', 'type_post', '-updated_at'], name='post_listing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['-updated_at'], name='post_active_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['price'], name='post_active_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['author', '-updated_at'], name='post_author_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='response',
+            index=models.Index(fields=['post', 'is_accepted', '-created_at'], name='response_post_accepted_idx'),
+        ),
+    ]
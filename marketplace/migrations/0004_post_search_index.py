@@ -0,0 +1,28 @@
+from django.db import migrations
+
+from marketplace.search import SQLiteFTSBackend
+
+
+def create_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(SQLiteFTSBackend.create_sql)
+    Post = apps.get_model('marketplace', 'Post')
+    connection = schema_editor.connection
+    SQLiteFTSBackend(connection).rebuild(Post.objects.using(connection.alias))
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(SQLiteFTSBackend.drop_sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0003_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0006_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postmedia',
+            name='derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
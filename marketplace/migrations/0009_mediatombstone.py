@@ -0,0 +1,27 @@
+# Generated by Django 5.2.6 on 2026-10-17 12:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0008_mediablob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Файл на удаление',
+                'verbose_name_plural': 'Файлы на удаление',
+            },
+        ),
+    ]
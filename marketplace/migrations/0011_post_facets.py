@@ -0,0 +1,36 @@
+# Generated by Django 5.2.6 on 2026-10-17 12:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from marketplace.facets import rebuild
+
+
+def fill_facets(apps, schema_editor):
+    rebuild(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0010_denormalized_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type_post', models.CharField(choices=[('wts', 'Продажа'), ('wtb', 'Покупка')], max_length=3)),
+                ('price_bucket', models.PositiveSmallIntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='facets', to='marketplace.category')),
+            ],
+            options={
+                'verbose_name': 'Счётчик фильтра',
+                'verbose_name_plural': 'Счётчики фильтра',
+                'constraints': [models.UniqueConstraint(fields=('category', 'type_post', 'price_bucket'), name='postfacet_unique_key')],
+            },
+        ),
+        migrations.RunPython(fill_facets, migrations.RunPython.noop),
+    ]
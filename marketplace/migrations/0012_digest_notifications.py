@@ -0,0 +1,40 @@
+# Generated by Django 5.2.6 on 2026-10-17 12:56
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0011_post_facets'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='digest_notifications',
+            field=models.BooleanField(default=False, verbose_name='Сводка отзывов вместо писем'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='digest_sent_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='PendingNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_notifications', to=settings.AUTH_USER_MODEL)),
+                ('response', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_notifications', to='marketplace.response')),
+            ],
+            options={
+                'verbose_name': 'Отзыв для сводки',
+                'verbose_name_plural': 'Отзывы для сводки',
+                'indexes': [models.Index(fields=['recipient', 'id'], name='pendingnotif_recipient_idx')],
+            },
+        ),
+    ]
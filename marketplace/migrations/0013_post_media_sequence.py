@@ -0,0 +1,41 @@
+# Generated by Django 5.2.6 on 2026-10-17 13:05
+
+import re
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+NUMBERED_RE = re.compile(r'post-(\d+)-(\d+)\.\w+$')
+
+
+def fill_media_sequence(apps, schema_editor):
+    Post = apps.get_model('marketplace', 'Post')
+    PostMedia = apps.get_model('marketplace', 'PostMedia')
+    # Не меньше числа медиафайлов и самого большого номера в именах файлов
+    media_count = (PostMedia.objects.filter(post=OuterRef('pk')).order_by()
+                   .values('post').annotate(total=Count('pk')).values('total'))
+    Post.objects.update(media_sequence=Coalesce(Subquery(media_count), 0))
+    highest = {}
+    for post_id, name in PostMedia.objects.values_list('post_id', 'file').iterator():
+        match = NUMBERED_RE.search(name or '')
+        if match and int(match[1]) == post_id:
+            highest[post_id] = max(highest.get(post_id, 0), int(match[2]))
+    for post_id, number in highest.items():
+        Post.objects.filter(pk=post_id, media_sequence__lt=number).update(media_sequence=number)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0012_digest_notifications'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='media_sequence',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_media_sequence, migrations.RunPython.noop),
+    ]
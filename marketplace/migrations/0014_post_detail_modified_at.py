@@ -0,0 +1,19 @@
+# Generated by Django 5.2.6 on 2026-10-17 13:10
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0013_post_media_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='detail_modified_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
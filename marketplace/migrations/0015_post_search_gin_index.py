@@ -0,0 +1,26 @@
+from django.db import migrations
+
+from marketplace.search import PostgresSearchBackend
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Post = apps.get_model('marketplace', 'Post')
+    schema_editor.execute(PostgresSearchBackend.create_index_sql(Post._meta.db_table))
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(PostgresSearchBackend.drop_index_sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0014_post_detail_modified_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
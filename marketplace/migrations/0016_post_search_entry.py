@@ -0,0 +1,34 @@
+# Generated by Django 5.2.6 on 2026-10-17 13:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from marketplace.search import SQLiteFTSBackend
+
+
+def configure_rank(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(SQLiteFTSBackend.rank_sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('marketplace', '0015_post_search_gin_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostSearchEntry',
+            fields=[
+                ('post', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_entry', serialize=False, to='marketplace.post')),
+                ('document', models.TextField(db_column='marketplace_post_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'marketplace_post_fts',
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(configure_rank, migrations.RunPython.noop),
+    ]
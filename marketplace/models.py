@@ -1,12 +1,20 @@
 import os
 import logging
-from django.db import models
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import models, transaction, IntegrityError, connections, router
 from django.contrib.auth.models import User
-from django.core.files.storage import default_storage
 from django.core.validators import MinValueValidator
+from django.db.models.functions import Now
 from django.core.exceptions import ValidationError
-from django.utils.text import slugify
+from django.utils import timezone
 import uuid
+
+from . import counters, metrics
+from .caching import bump_listing_version
+from .derivatives import schedule_derivatives
+from .slugs import base_slug, next_free_slug
+
 logger=logging.getLogger('marketplace')
 
 
@@ -26,11 +34,48 @@ class Category(models.Model):
         verbose_name_plural = 'Категории'
 
 
+class PostQuerySet(models.QuerySet):
+    def for_cards(self):
+        '''
+        Выборка для карточек в списке объявлений: автор и категория
+        подтягиваются JOIN-ом, из медиафайлов - только первый (обложка),
+        одним запросом на всю страницу.
+        '''
+        cover_qs = PostMedia.objects.order_by('id')[:1]
+        return self.select_related('author', 'category').prefetch_related(
+            models.Prefetch('media', queryset=cover_qs, to_attr='_cover_media')
+        )
+
+
+class Profile(models.Model):
+    """
+    Профиль пользователя.
+    Поля: post_count - число объявлений (денормализованный счётчик),
+      digest_notifications - сводка отзывов раз в интервал вместо письма на каждый,
+      digest_sent_at - когда отправлена последняя сводка
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
+    post_count = models.PositiveIntegerField(default=0)
+    digest_notifications = models.BooleanField(default=False,
+                                               verbose_name='Сводка отзывов вместо писем')
+    digest_sent_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    def __str__(self):
+        return f'Профиль {self.user.username}'
+
+    class Meta:
+        verbose_name = 'Профиль'
+        verbose_name_plural = 'Профили'
+
+
 class Post(models.Model):
     '''
     Модель объявления.
     Поля: title, category, content, price, type_post,
-      author, is_active, updated_at, created_at, slug
+      author, is_active, updated_at, created_at, slug,
+      media_sequence - последний выданный номер медиафайла (allocate_media_numbers),
+      detail_modified_at - последнее изменение страницы объявления помимо самого
+      объявления: принятые отзывы, медиафайлы, категория (сигналы signals.py)
     '''
     WTS = 'wts'
     WTB = 'wtb'
@@ -47,6 +92,18 @@ class Post(models.Model):
     type_post = models.CharField(max_length=3, choices=POST, blank=False, verbose_name='Тип объявления')
     is_active = models.BooleanField(default=True, verbose_name='Активно')
     slug = models.SlugField(max_length=80, unique=True)
+    # Денормализованные счётчики, обновляются сигналами (signals.py)
+    media_count = models.PositiveIntegerField(default=0, editable=False)
+    response_count = models.PositiveIntegerField(default=0, editable=False)
+    accepted_response_count = models.PositiveIntegerField(default=0, editable=False)
+    media_sequence = models.PositiveIntegerField(default=0, editable=False)
+    detail_modified_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = PostQuerySet.as_manager()
+
+    SLUG_ATTEMPTS = 5
+    # Меняются только отдельными UPDATE, обычное сохранение их не пишет
+    SERVER_MANAGED_FIELDS = ('media_sequence', 'detail_modified_at')
 
     def __str__(self):
         name_type = dict(self.POST).get(self.type_post, 'Unknown')
@@ -56,50 +113,160 @@ class Post(models.Model):
         verbose_name = 'Объявление'
         verbose_name_plural = 'Объявления'
         ordering = ['-created_at']
+        indexes = [
+            # Лента с фильтрами PostView
+            models.Index(fields=['is_active', 'category', 'type_post', '-updated_at'],
+                         name='post_listing_idx'),
+            models.Index(fields=['-updated_at'], condition=models.Q(is_active=True),
+                         name='post_active_updated_idx'),
+            models.Index(fields=['price'], condition=models.Q(is_active=True),
+                         name='post_active_price_idx'),
+            # Мои объявления (MyPostList)
+            models.Index(fields=['author', '-updated_at'], name='post_author_updated_idx'),
+        ]
 
-    def delete(self, *args, **kwargs):
-        media_files = []
-        
-        for media in self.media.all():
-            if media.file:
-                media_files.append(media.file.name)
-        
-        super().delete(*args, **kwargs)
+    @property
+    def cover_media(self):
+        '''Первый медиафайл объявления (из prefetch, если он был)'''
+        if hasattr(self, '_cover_media'):
+            return self._cover_media[0] if self._cover_media else None
+        return self.media.order_by('id').first()
+
+    def allocate_media_numbers(self, count):
+        '''
+        Выделяет count номеров медиафайлов одним UPDATE ... RETURNING.
+        Параллельные загрузки получают непересекающиеся диапазоны, номера
+        неудавшихся загрузок не переиспользуются. Возвращает range номеров.
+        '''
+        using = router.db_for_write(Post, instance=self)
+        connection = connections[using]
+        if connection.vendor in ('sqlite', 'postgresql') and \
+                connection.features.can_return_columns_from_insert:
+            quote = connection.ops.quote_name
+            table, column = quote(self._meta.db_table), quote('media_sequence')
+            with connection.cursor() as cursor:
+                cursor.execute(f'UPDATE {table} SET {column} = {column} + %s '
+                               f'WHERE {quote(self._meta.pk.column)} = %s RETURNING {column}',
+                               [count, self.pk])
+                row = cursor.fetchone()
+        else:
+            # Без RETURNING: строка заблокирована UPDATE до конца транзакции
+            with transaction.atomic(using=using):
+                posts = Post.objects.using(using).filter(pk=self.pk)
+                posts.update(media_sequence=models.F('media_sequence') + count)
+                row = posts.values_list('media_sequence').first()
+        if row is None:
+            raise Post.DoesNotExist(f'Объявление {self.pk} удалено')
+        self.media_sequence = row[0]
+        return range(row[0] - count + 1, row[0] + 1)
 
-        for file_path in media_files:
-            try:
-                if default_storage.exists(file_path):
-                    default_storage.delete(file_path)
-                    logger.info(f'Файл удалён: {file_path}')
-            except Exception as e:
-                logger.error(f'Ошибка при удалении {file_path}: {e}')
-    
     def save(self, *args, **kwargs):
-        if not self.slug:
-            # Базовый slug из title
-            base_slug = slugify(self.title)
-            slug = base_slug
-            
-            # Проверяем уникальность, добавляем UUID если нужно
-            counter = 1
-            while Post.objects.filter(slug=slug).exclude(pk=self.pk).exists():
-                slug = f"{base_slug}-{counter}"
-                counter += 1
-                if counter > 10:
-                    # Используем UUID для гарантии уникальности
-                    slug = f"{base_slug}-{uuid.uuid4().hex[:8]}"
-                    break
-                    
-            self.slug = slug
-        if not self.slug:
-            self.slug = f'post-{uuid.uuid4().hex[:8]}'
-        super().save(*args, **kwargs)
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Сохранение устаревшего экземпляра не должно откатить назад
+            # номер медиафайлов и отметку изменения страницы
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.attname for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in deferred
+                and field.name not in self.SERVER_MANAGED_FIELDS
+            ]
+        if self.slug:
+            return super().save(*args, **kwargs)
+
+        base = base_slug(self.title, self._meta.get_field('slug').max_length)
+        for _ in range(self.SLUG_ATTEMPTS):
+            self.slug = next_free_slug(Post.objects.exclude(pk=self.pk), base)
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                # Slug заняло параллельное сохранение - выделяем заново
+                if not Post.objects.filter(slug=self.slug).exclude(pk=self.pk).exists():
+                    raise
+        self.slug = f'{base}-{uuid.uuid4().hex[:8]}'
+        return super().save(*args, **kwargs)
     
 
+class PostMediaManager(models.Manager):
+    def bulk_ingest(self, post, files, workers=None):
+        '''
+        Добавляет к объявлению пачку файлов: номера выделяются одним запросом
+        (если хранилище не называет файлы по содержимому, см.
+        PostMedia.is_content_addressed), файлы пишутся в хранилище пулом из MARKETPLACE_MEDIA_INGEST_WORKERS
+        потоков, строки вставляются одним bulk_create. Если запись или вставка
+        не удалась, уже записанные файлы удаляются. Все файлы проверяются
+        (PostMedia.clean) до записи. Возвращает созданные PostMedia.
+        '''
+        media = [self.model(post=post, file=file) for file in files]
+        for item in media:
+            item.clean()
+        if not media:
+            return []
+        numbered = [item for item in media if not item.is_content_addressed()]
+        if numbered:
+            for item, number in zip(numbered, post.allocate_media_numbers(len(numbered))):
+                item.file.name = item.numbered_name(number)
+
+        using = router.db_for_write(self.model, instance=post)
+        workers = workers or getattr(settings, 'MARKETPLACE_MEDIA_INGEST_WORKERS', 4)
+        if connections[using].in_atomic_block:
+            # Потоки пишут MediaBlob через свои соединения - вне транзакции
+            # вызывающего, а SQLite ещё и ждал бы её блокировку. Пишем сами.
+            workers = 1
+        chunks = [media[i::workers] for i in range(workers) if media[i::workers]]
+        if len(chunks) == 1:
+            errors = [self._write_files(chunks[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+                errors = list(executor.map(self._write_files, chunks, [True] * len(chunks)))
+        try:
+            for error in errors:
+                if error is not None:
+                    raise error
+            with transaction.atomic(using=using):
+                self.using(using).bulk_create(media)
+                # bulk_create не шлёт post_save - то же, что сигналы signals.py
+                counters.shift(Post, {'pk': post.pk}, media_count=len(media),
+                               detail_modified_at=Now())
+        except BaseException:
+            self._discard_files(media)
+            raise
+
+        for item in media:
+            metrics.MEDIA_FILES.inc(kind='image' if item.is_image else 'video')
+            schedule_derivatives(item)
+        bump_listing_version()
+        return media
+
+    @staticmethod
+    def _write_files(media, in_thread=False):
+        '''Запись файлов части пачки. Возвращает ошибку или None'''
+        try:
+            for item in media:
+                item.file.save(item.file.name, item.file.file, save=False)
+        except Exception as e:
+            return e
+        finally:
+            if in_thread:
+                connections.close_all()
+        return None
+
+    @staticmethod
+    def _discard_files(media):
+        for item in media:
+            if item.file._committed:
+                try:
+                    item.file.storage.delete(item.file.name)
+                except Exception as e:
+                    logger.error(f'Не удалось удалить файл {item.file.name}: {e}')
+
+
 class PostMedia(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='media')
     file = models.FileField(upload_to='post_media/')
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # Имена превью: {"320": {"webp": ..., "jpeg": ...}, "poster": {...}}
+    derivatives = models.JSONField(default=dict, blank=True, editable=False)
 
     # Разрешенные типы файлов
     ALLOWED_IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
@@ -111,18 +278,16 @@ class PostMedia(models.Model):
     
     MAX_SIZE_MB = 50
 
+    objects = PostMediaManager()
+
     class Meta:
         verbose_name = 'Медиафайл'
         verbose_name_plural = 'Медиафайлы'
 
-    def delete(self, *args, **kwargs):
-        if self.file:
-            try:
-                if default_storage.exists(self.file.name):
-                    default_storage.delete(self.file.name)
-            except Exception as e:
-                logger.info(f"Ошибка при удалении файла {self.file.name}: {e}")
-        super().delete(*args, **kwargs)
+    @property
+    def is_image(self):
+        ext = os.path.splitext(self.file.name)[1].lower()
+        return ext in self.ALLOWED_IMAGE_EXTENSIONS
 
     def clean(self):
         if self.file:
@@ -150,13 +315,26 @@ class PostMedia(models.Model):
     def save(self, *args, **kwargs):
         self.clean()
         
-        if self.file and not self.pk:
-            count = PostMedia.objects.filter(post=self.post).count()
-            ext = os.path.splitext(self.file.name)[1].lower()
-            new_filename = f"post-{self.post.id}-{count+1:03d}{ext}"
-            self.file.name = f'{self.post.id}/{new_filename}'
-        
+        is_new_file = bool(self.file) and not self.pk
+        if is_new_file and not self.is_content_addressed():
+            self.file.name = self.numbered_name(self.post.allocate_media_numbers(1)[0])
+
         super().save(*args, **kwargs)
+        if is_new_file:
+            schedule_derivatives(self)
+
+    def is_content_addressed(self):
+        '''
+        Хранилище само называет файл по содержимому (DeduplicatingStorage:
+        blobs/<sha256>) - номер post-<id>-NNN до него не дошёл бы, его не выделяем
+        '''
+        is_deduplicated = getattr(self.file.storage, 'is_deduplicated', None)
+        return is_deduplicated is not None and \
+            is_deduplicated(self.file.field.generate_filename(self, self.file.name))
+
+    def numbered_name(self, number):
+        ext = os.path.splitext(self.file.name)[1].lower()
+        return f'{self.post_id}/post-{self.post_id}-{number:03d}{ext}'
 
     def __str__(self):
         return f'Файл для {self.post.title}'
@@ -180,4 +358,170 @@ class Response(models.Model):
         verbose_name = 'Отклик'
         verbose_name_plural = 'Отклики'
         ordering = ['-created_at']
-        unique_together = ['author', 'post']
\ No newline at end of file
+        unique_together = ['author', 'post']
+        indexes = [
+            models.Index(fields=['post', 'is_accepted', '-created_at'],
+                         name='response_post_accepted_idx'),
+        ]
+
+class OutgoingEmail(models.Model):
+    """
+    Письмо в очереди на отправку (outbox).
+    Views только создают запись, отправляет её команда send_outbox.
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS = [(PENDING, 'В очереди'),
+              (SENDING, 'Отправляется'),
+              (SENT, 'Отправлено'),
+              (FAILED, 'Ошибка')]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=255)
+    recipients = models.JSONField(default=list)
+    status = models.CharField(max_length=10, choices=STATUS, default=PENDING, verbose_name='Статус')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.subject} -> {", ".join(self.recipients)}'
+
+    class Meta:
+        verbose_name = 'Исходящее письмо'
+        verbose_name_plural = 'Исходящие письма'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outgoingemail_queue_idx'),
+        ]
+
+
+class UploadSession(models.Model):
+    """
+    Незавершённая поблочная загрузка медиафайла.
+    Части лежат в хранилище в uploads/<id>/, PostMedia создаётся при завершении.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='uploads')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    parts = models.PositiveIntegerField(default=0)
+    media_type = models.CharField(max_length=10, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Загрузка'
+        verbose_name_plural = 'Загрузки'
+
+    def __str__(self):
+        return f'{self.filename} ({self.received}/{self.size})'
+
+
+class MediaBlob(models.Model):
+    """
+    Содержимое медиафайла, сохранённое один раз по SHA-256.
+    ref_count - сколько раз файл был сохранён и ещё не удалён.
+    """
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Blob медиафайла'
+        verbose_name_plural = 'Blob-ы медиафайлов'
+
+    def __str__(self):
+        return f'{self.name} (ссылок: {self.ref_count})'
+
+
+
+class MediaTombstone(models.Model):
+    """
+    Файл, который нужно удалить из хранилища.
+    Записывается сигналом post_delete (в том числе при каскадном и
+    массовом удалении), удаляется командой sweep_media.
+    """
+    name = models.CharField(max_length=255)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Файл на удаление'
+        verbose_name_plural = 'Файлы на удаление'
+
+    def __str__(self):
+        return self.name
+
+
+class PostFacet(models.Model):
+    """
+    Число активных объявлений в категории по типу и ценовому диапазону
+    (номер корзины - facets.PRICE_BOUNDS). Поддерживается сигналами,
+    пересчитывается командой rebuild_facets.
+    """
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='facets')
+    type_post = models.CharField(max_length=3, choices=Post.POST)
+    price_bucket = models.PositiveSmallIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'Счётчик фильтра'
+        verbose_name_plural = 'Счётчики фильтра'
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'type_post', 'price_bucket'],
+                                    name='postfacet_unique_key'),
+        ]
+
+    def __str__(self):
+        return f'{self.category_id}/{self.type_post}/{self.price_bucket}: {self.count}'
+
+
+class PostSearchEntry(models.Model):
+    """
+    Строка FTS5-таблицы поиска (только SQLite, search.SQLiteFTSBackend).
+    Таблицу создаёт миграция 0004, модель нужна лишь для JOIN с объявлениями:
+    document - скрытый столбец с именем таблицы (document = запрос означает
+    MATCH), rank - bm25() с весами столбцов, заданными в конфигурации таблицы.
+    """
+    post = models.OneToOneField(Post, on_delete=models.DO_NOTHING, primary_key=True,
+                                db_column='rowid', db_constraint=False,
+                                related_name='search_entry')
+    document = models.TextField(db_column='marketplace_post_fts')
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'marketplace_post_fts'
+
+
+class PendingNotification(models.Model):
+    """
+    Отзыв, ожидающий сводки для автора объявления (Profile.digest_notifications).
+    Удаляется командой send_digests, когда сводка поставлена в очередь писем.
+    """
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE,
+                                  related_name='pending_notifications')
+    response = models.ForeignKey(Response, on_delete=models.CASCADE,
+                                 related_name='pending_notifications')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Отзыв для сводки'
+        verbose_name_plural = 'Отзывы для сводки'
+        indexes = [
+            models.Index(fields=['recipient', 'id'], name='pendingnotif_recipient_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.recipient_id}: {self.response_id}'
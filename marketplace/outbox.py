@@ -0,0 +1,135 @@
+'''
+Очередь исходящих писем (transactional outbox).
+
+enqueue_email() пишет письмо в таблицу OutgoingEmail в той же транзакции,
+что и изменение данных, поэтому письмо уходит только если изменение
+сохранено. Отправкой занимается команда send_outbox: она забирает пачку
+писем, отправляет их в нескольких потоках - каждый поток через одно
+SMTP-соединение - и записывает результат с повторами по экспоненте.
+'''
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from . import metrics
+from .models import OutgoingEmail
+
+logger = logging.getLogger('marketplace')
+
+DEFAULT_FROM_EMAIL = 'mmo_marketplace@temp-mail.com'
+
+
+def enqueue_email(subject, body, recipients, html_body='', from_email=DEFAULT_FROM_EMAIL):
+    email = OutgoingEmail.objects.create(
+        subject=subject, body=body, html_body=html_body,
+        from_email=from_email, recipients=list(recipients),
+    )
+    metrics.EMAILS_QUEUED.inc()
+    return email
+
+
+def build_message(email, connection=None):
+    msg = EmailMultiAlternatives(
+        subject=email.subject,
+        body=email.body,
+        from_email=email.from_email,
+        to=email.recipients,
+        connection=connection,
+    )
+    if email.html_body:
+        msg.attach_alternative(email.html_body, 'text/html')
+    return msg
+
+
+def claim_batch(batch_size):
+    '''
+    Забирает пачку готовых к отправке писем: переводит их в статус
+    "отправляется" с арендой до lease_until. Если воркер упадёт, письма
+    снова станут доступны после окончания аренды.
+    '''
+    lease = getattr(settings, 'MARKETPLACE_OUTBOX_LEASE_SECONDS', 300)
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=lease)
+    available = OutgoingEmail.objects.filter(
+        status__in=[OutgoingEmail.PENDING, OutgoingEmail.SENDING], next_attempt_at__lte=now)
+    with transaction.atomic():
+        ids = list(available.order_by('next_attempt_at', 'id')
+                   .values_list('id', flat=True)[:batch_size])
+        # Повторная проверка условия в UPDATE не даст двум воркерам забрать одно письмо
+        available.filter(id__in=ids).update(status=OutgoingEmail.SENDING,
+                                            next_attempt_at=lease_until)
+    return list(OutgoingEmail.objects.filter(id__in=ids, status=OutgoingEmail.SENDING,
+                                             next_attempt_at=lease_until))
+
+
+def send_chunk(emails):
+    '''Отправляет письма через одно соединение. Возвращает [(id, ошибка или None)]'''
+    results = []
+    connection = get_connection()
+    try:
+        connection.open()
+        for email in emails:
+            try:
+                connection.send_messages([build_message(email, connection)])
+                results.append((email.id, None))
+            except Exception as e:
+                results.append((email.id, str(e) or e.__class__.__name__))
+    except Exception as e:
+        # Не удалось даже подключиться - ошибка у всех оставшихся писем
+        done = {email_id for email_id, _ in results}
+        results += [(email.id, str(e) or e.__class__.__name__)
+                    for email in emails if email.id not in done]
+    finally:
+        try:
+            connection.close()
+        except Exception:
+            pass
+    return results
+
+
+def record_results(emails, results):
+    max_attempts = getattr(settings, 'MARKETPLACE_OUTBOX_MAX_ATTEMPTS', 5)
+    backoff = getattr(settings, 'MARKETPLACE_OUTBOX_BACKOFF_SECONDS', 30)
+    by_id = {email.id: email for email in emails}
+    now = timezone.now()
+    sent_ids = [email_id for email_id, error in results if error is None]
+    OutgoingEmail.objects.filter(id__in=sent_ids).update(
+        status=OutgoingEmail.SENT, sent_at=now, last_error='')
+    if sent_ids:
+        metrics.EMAILS_PROCESSED.inc(len(sent_ids), result='sent')
+
+    for email_id, error in results:
+        if error is None:
+            continue
+        email = by_id[email_id]
+        email.attempts += 1
+        email.last_error = error
+        if email.attempts >= max_attempts:
+            email.status = OutgoingEmail.FAILED
+            metrics.EMAILS_PROCESSED.inc(result='failed')
+            logger.error(f'Письмо {email_id} не отправлено после {email.attempts} попыток: {error}')
+        else:
+            email.status = OutgoingEmail.PENDING
+            metrics.EMAILS_PROCESSED.inc(result='retry')
+            email.next_attempt_at = now + timedelta(seconds=backoff * 2 ** (email.attempts - 1))
+            logger.warning(f'Ошибка отправки письма {email_id}, повтор в {email.next_attempt_at}: {error}')
+        email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
+    return len(sent_ids), len(results) - len(sent_ids)
+
+
+def process_outbox(batch_size=100, threads=4):
+    '''Одна итерация воркера. Возвращает (отправлено, с ошибкой)'''
+    emails = claim_batch(batch_size)
+    if not emails:
+        return 0, 0
+    chunks = [emails[i::threads] for i in range(threads) if emails[i::threads]]
+    results = []
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        for chunk_results in executor.map(send_chunk, chunks):
+            results += chunk_results
+    return record_results(emails, results)
@@ -0,0 +1,154 @@
+import base64
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import Http404
+
+
+class CursorPage:
+    '''
+    Страница курсорной пагинации. Повторяет часть интерфейса
+    django.core.paginator.Page, нужную шаблонам.
+    '''
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    '''
+    Keyset-пагинация по (updated_at, id) в порядке убывания.
+    Каждая страница - один запрос по индексу без OFFSET и без COUNT(*),
+    поэтому глубокие страницы стоят столько же, сколько первая.
+    '''
+    def __init__(self, queryset, per_page, key_fields=('updated_at', 'id')):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.key_fields = key_fields
+
+    @staticmethod
+    def encode_cursor(values, direction):
+        raw = json.dumps({'k': values, 'd': direction}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            data = json.loads(raw)
+            updated_at, pk = data['k']
+            return (datetime.fromisoformat(updated_at), int(pk)), data['d']
+        except (ValueError, TypeError, KeyError):
+            raise Http404('Некорректный курсор')
+
+    def cursor_for(self, obj, direction):
+        updated_field, pk_field = self.key_fields
+        values = [getattr(obj, updated_field).isoformat(), getattr(obj, pk_field)]
+        return self.encode_cursor(values, direction)
+
+    def _page_queryset(self, cursor):
+        updated_field, pk_field = self.key_fields
+        queryset = self.queryset
+        direction = 'next'
+
+        if cursor:
+            (updated_at, pk), direction = self.decode_cursor(cursor)
+            lookup = 'lt' if direction == 'next' else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{updated_field}__{lookup}': updated_at})
+                | Q(**{updated_field: updated_at, f'{pk_field}__{lookup}': pk})
+            )
+
+        if direction == 'next':
+            queryset = queryset.order_by(f'-{updated_field}', f'-{pk_field}')
+        else:
+            queryset = queryset.order_by(updated_field, pk_field)
+        return queryset[:self.per_page + 1], direction
+
+    def _build_page(self, rows, cursor, direction):
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if direction == 'previous':
+            rows.reverse()
+
+        next_cursor = previous_cursor = None
+        if rows:
+            if has_more or direction == 'previous':
+                next_cursor = self.cursor_for(rows[-1], 'next')
+            if (cursor and direction == 'next') or (direction == 'previous' and has_more):
+                previous_cursor = self.cursor_for(rows[0], 'previous')
+        return CursorPage(rows, next_cursor, previous_cursor)
+
+    def page(self, cursor=None):
+        queryset, direction = self._page_queryset(cursor)
+        return self._build_page(list(queryset), cursor, direction)
+
+    async def apage(self, cursor=None):
+        queryset, direction = self._page_queryset(cursor)
+        return self._build_page([obj async for obj in queryset], cursor, direction)
+
+
+async def apaginate(paginator, number):
+    '''
+    async-вариант paginator.page(number) для обычного Paginator:
+    COUNT(*) (если число объектов не задано заранее) и выборка
+    страницы идут через async ORM, в шаблон попадает готовый список.
+    '''
+    if 'count' not in paginator.__dict__:
+        paginator.count = await paginator.object_list.acount()
+    page = paginator.page(number)
+    page.object_list = [obj async for obj in page.object_list]
+    return page
+
+
+class CursorPaginationMixin:
+    '''
+    Подключает курсорную пагинацию к ListView вместо стандартной
+    (OFFSET + COUNT). Включается атрибутом cursor_pagination или
+    настройкой MARKETPLACE_CURSOR_PAGINATION.
+    '''
+    cursor_pagination = None
+    cursor_kwarg = 'cursor'
+
+    def use_cursor_pagination(self):
+        if self.cursor_pagination is not None:
+            return self.cursor_pagination
+        return getattr(settings, 'MARKETPLACE_CURSOR_PAGINATION', False)
+
+    def get_cursor_paginator(self, queryset, page_size):
+        return CursorPaginator(queryset, page_size)
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.use_cursor_pagination():
+            return super().paginate_queryset(queryset, page_size)
+        paginator = self.get_cursor_paginator(queryset, page_size)
+        page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['cursor_pagination'] = self.use_cursor_pagination()
+        # Фильтры для ссылок пагинации, уже закодированные для URL
+        query = self.request.GET.copy()
+        for name in ('page', self.cursor_kwarg):
+            query.pop(name, None)
+        context['page_query'] = query.urlencode()
+        return context
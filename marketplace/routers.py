@@ -0,0 +1,127 @@
+'''
+Чтение с реплик (MARKETPLACE_READ_REPLICAS) с гарантией "читаю свои записи".
+
+ReplicaRoutingMiddleware разрешает реплику только безопасным запросам
+(GET/HEAD/OPTIONS) и выбирает её один раз на запрос. Всё остальное -
+изменяющие запросы, команды, чтения внутри transaction.atomic() и модели
+вне приложения marketplace (сессии, пользователи) - идёт в основную базу.
+После записи клиент получает cookie и следующие MARKETPLACE_PRIMARY_PIN_SECONDS
+секунд читает с основной базы, пока реплика догоняет.
+'''
+import random
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = 'marketplace_primary'
+REPLICATED_APPS = {'marketplace'}
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_routing = ContextVar('marketplace_db_routing', default=None)
+
+
+def read_replicas():
+    return getattr(settings, 'MARKETPLACE_READ_REPLICAS', [])
+
+
+def pin_seconds():
+    return getattr(settings, 'MARKETPLACE_PRIMARY_PIN_SECONDS', 10)
+
+
+class RequestRouting:
+    '''
+    Состояние одного запроса. Изменяемый объект, а не значения ContextVar:
+    запись из потока sync_to_async должна быть видна middleware.
+    '''
+    def __init__(self, replica):
+        self.replica = replica
+        self.wrote = False
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        routing = _routing.get()
+        if (routing is None or routing.replica is None
+                or model._meta.app_label not in REPLICATED_APPS
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return DEFAULT_DB_ALIAS
+        return routing.replica
+
+    def db_for_write(self, model, **hints):
+        routing = _routing.get()
+        if routing is not None and model._meta.app_label in REPLICATED_APPS:
+            # Остаток запроса и следующие запросы клиента читают свои изменения
+            routing.wrote = True
+            routing.replica = None
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *read_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        # Схему реплики приносит репликация
+        if db in read_replicas():
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    '''
+    Подключается в MIDDLEWARE, без настроенных реплик отключается сам.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not read_replicas():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def start(self, request):
+        replica = None
+        if request.method in SAFE_METHODS and not self.is_pinned(request):
+            replica = random.choice(read_replicas())
+        return RequestRouting(replica)
+
+    def is_pinned(self, request):
+        try:
+            return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        routing = self.start(request)
+        token = _routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+        return self.finish(routing, response)
+
+    async def __acall__(self, request):
+        routing = self.start(request)
+        token = _routing.set(routing)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _routing.reset(token)
+        return self.finish(routing, response)
+
+    def finish(self, routing, response):
+        if routing.wrote:
+            seconds = pin_seconds()
+            response.set_cookie(PIN_COOKIE, f'{time.time() + seconds:.0f}', max_age=seconds,
+                                httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,244 @@
+'''
+Полнотекстовый поиск по объявлениям (title, content).
+
+Текст перед индексацией приводится к основам слов (русский стеммер в духе
+Snowball), поэтому "мечи", "меча" и "меч" находятся одним запросом.
+Бэкенд выбирается настройкой MARKETPLACE_SEARCH_BACKEND, по умолчанию -
+по типу базы данных: FTS5 для SQLite, tsvector для PostgreSQL.
+'''
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection as default_connection
+from django.db.models import F, Q
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+CYRILLIC_RE = re.compile(r'[а-я]')
+
+# Служебные слова не индексируются: они есть почти в каждом объявлении
+STOP_WORDS = frozenset(
+    'и в во на с со к ко по за из у о об от до для не ни а но или же ли бы то это'.split()
+)
+
+RU_VOWELS = 'аеиоуыэюя'
+RU_PERFECTIVE_GERUND = (('ившись', 'ывшись', 'ивши', 'ывши', 'ив', 'ыв'),
+                        ('вшись', 'вши', 'в'))
+RU_REFLEXIVE = ('ся', 'сь')
+RU_ADJECTIVE = ('ими', 'ыми', 'его', 'ого', 'ему', 'ому', 'ее', 'ие', 'ые', 'ое',
+                'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом', 'их', 'ых', 'ую',
+                'юю', 'ая', 'яя', 'ою', 'ею')
+RU_PARTICIPLE = (('ивш', 'ывш', 'ующ'), ('ем', 'нн', 'вш', 'ющ', 'щ'))
+RU_VERB = (('уйте', 'ейте', 'ила', 'ыла', 'ена', 'ите', 'или', 'ыли', 'ило', 'ыло',
+            'ено', 'ует', 'уют', 'ены', 'ить', 'ыть', 'ишь', 'ей', 'уй', 'ил', 'ыл',
+            'им', 'ым', 'ен', 'ят', 'ит', 'ыт', 'ую', 'ю'),
+           ('ете', 'йте', 'ешь', 'нно', 'ла', 'на', 'ли', 'ем', 'ло', 'но', 'ет', 'ют',
+            'ны', 'ть', 'й', 'л', 'н'))
+RU_NOUN = ('иями', 'ями', 'ами', 'ией', 'иям', 'ием', 'иях', 'ев', 'ов', 'ие', 'ье',
+           'еи', 'ии', 'ей', 'ой', 'ий', 'ям', 'ем', 'ам', 'ом', 'ах', 'ях', 'ию',
+           'ью', 'ия', 'ья', 'а', 'е', 'и', 'й', 'о', 'у', 'ы', 'ь', 'ю', 'я')
+
+
+def _strip(word, endings, preceded_by=None):
+    '''Отрезает самое длинное окончание из endings (опционально после а/я)'''
+    for ending in sorted(endings, key=len, reverse=True):
+        if word.endswith(ending):
+            stem = word[:-len(ending)]
+            if preceded_by is None or stem.endswith(preceded_by):
+                return stem
+    return None
+
+
+def _strip_group(word, groups):
+    '''Первая группа окончаний - без условий, вторая - только после а/я'''
+    strong, weak = groups
+    for stem in (_strip(word, strong), _strip(word, weak, preceded_by=('а', 'я'))):
+        if stem is not None:
+            return stem
+    return None
+
+
+@lru_cache(maxsize=65536)
+def stem_russian(word):
+    '''Упрощённый стеммер Портера (Snowball) для русского языка'''
+    for i, char in enumerate(word):
+        if char in RU_VOWELS:
+            prefix, rv = word[:i + 1], word[i + 1:]
+            break
+    else:
+        return word
+
+    stem = _strip_group(rv, RU_PERFECTIVE_GERUND)
+    if stem is None:
+        rv = _strip(rv, RU_REFLEXIVE) or rv
+        stem = _strip(rv, RU_ADJECTIVE)
+        if stem is not None:
+            stem = _strip_group(stem, RU_PARTICIPLE) or stem
+        else:
+            stem = _strip_group(rv, RU_VERB)
+            if stem is None:
+                stem = _strip(rv, RU_NOUN)
+        if stem is None:
+            stem = rv
+    rv = stem
+
+    if rv.endswith('и'):
+        rv = rv[:-1]
+    for ending in ('ейше', 'ейш'):
+        if rv.endswith(ending):
+            rv = rv[:-len(ending)]
+            break
+    if rv.endswith('нн'):
+        rv = rv[:-1]
+    elif rv.endswith('ь'):
+        rv = rv[:-1]
+    return prefix + rv
+
+
+def tokenize(text):
+    '''Разбивает текст на слова и приводит их к основам'''
+    tokens = []
+    for word in WORD_RE.findall(text.lower().replace('ё', 'е')):
+        if word in STOP_WORDS:
+            continue
+        if CYRILLIC_RE.search(word):
+            word = stem_russian(word)
+        tokens.append(word)
+    return tokens
+
+
+class BaseSearchBackend:
+    '''
+    Интерфейс бэкенда поиска. По умолчанию - поиск через icontains
+    без отдельного индекса (годится для любой БД, но без ранжирования).
+    '''
+    # Поле для order_by по релевантности (None - бэкенд не ранжирует)
+    rank_ordering = None
+
+    def __init__(self, connection=None):
+        # Миграции передают соединение своей базы (migrate --database)
+        self.connection = connection or default_connection
+
+    def index(self, post):
+        pass
+
+    def remove(self, post_id):
+        pass
+
+    def rebuild(self, queryset):
+        for post in queryset.iterator():
+            self.index(post)
+
+    def apply(self, queryset, query):
+        '''Фильтрует queryset объявлений по запросу и сортирует по релевантности'''
+        condition = Q()
+        for word in WORD_RE.findall(query):
+            condition &= Q(title__icontains=word) | Q(content__icontains=word)
+        return queryset.filter(condition)
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    '''
+    Индекс во внешней FTS5-таблице, rowid которой совпадает с id объявления.
+    В таблице хранится уже стеммированный текст, ранжирование - bm25()
+    с повышенным весом заголовка (столбец rank, см. rank_sql).
+    '''
+    table = 'marketplace_post_fts'
+    create_sql = (f'CREATE VIRTUAL TABLE IF NOT EXISTS {table} '
+                  f'USING fts5(title, content, tokenize="unicode61 remove_diacritics 2")')
+    drop_sql = f'DROP TABLE IF EXISTS {table}'
+    title_weight = 10.0
+    content_weight = 1.0
+    # Веса хранятся в конфигурации таблицы, тогда скрытый столбец rank
+    # считается bm25() с ними и доступен при JOIN (миграция 0016)
+    rank_sql = (f"INSERT INTO {table}({table}, rank) "
+                f"VALUES ('rank', 'bm25({title_weight}, {content_weight})')")
+    rank_ordering = 'search_rank'
+
+    def index(self, post):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [post.pk])
+            cursor.execute(
+                f'INSERT INTO {self.table} (rowid, title, content) VALUES (%s, %s, %s)',
+                [post.pk, ' '.join(tokenize(post.title)), ' '.join(tokenize(post.content))]
+            )
+
+    def remove(self, post_id):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [post_id])
+
+    def rebuild(self, queryset):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+            rows = ((post.pk, ' '.join(tokenize(post.title)), ' '.join(tokenize(post.content)))
+                    for post in queryset.only('pk', 'title', 'content').iterator())
+            cursor.executemany(
+                f'INSERT INTO {self.table} (rowid, title, content) VALUES (%s, %s, %s)', rows
+            )
+
+    @staticmethod
+    def match_expression(query):
+        # Каждая основа - отдельная фраза в кавычках (без синтаксиса FTS5), все через AND.
+        # Префиксный поиск ("основа"*) не нужен - формы слова уже сведены стеммером
+        return ' '.join(f'"{token}"' for token in tokenize(query))
+
+    def apply(self, queryset, query):
+        match = self.match_expression(query)
+        if not match:
+            return queryset
+        # Один INNER JOIN с FTS5-таблицей (models.PostSearchEntry): SQLite
+        # начинает с MATCH по индексу и достаёт объявления по первичному ключу
+        return (queryset.filter(search_entry__document=match)
+                .annotate(search_rank=F('search_entry__rank'))
+                .order_by(self.rank_ordering))
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    '''
+    tsvector-поиск PostgreSQL со словарём 'russian'. Индекс поддерживает
+    сама БД: GIN-индекс по выражению vector_sql() (миграция 0015), поэтому
+    index/remove не нужны. Запрос использует то же выражение, иначе
+    планировщик не возьмёт индекс и посчитает to_tsvector для каждой строки.
+    '''
+    config = 'russian'
+    weights = (('title', 'A'), ('content', 'B'))
+    index_name = 'marketplace_post_search_gin'
+    rank_ordering = '-search_rank'
+    drop_index_sql = f'DROP INDEX IF EXISTS {index_name}'
+
+    @classmethod
+    def vector_sql(cls, table=None):
+        prefix = f'"{table}".' if table else ''
+        return ' || '.join(
+            f"setweight(to_tsvector('{cls.config}'::regconfig, "
+            f"COALESCE({prefix}\"{column}\", '')), '{weight}')"
+            for column, weight in cls.weights
+        )
+
+    @classmethod
+    def create_index_sql(cls, table='marketplace_post'):
+        return (f'CREATE INDEX IF NOT EXISTS {cls.index_name} ON "{table}" '
+                f'USING GIN (({cls.vector_sql()}))')
+
+    def apply(self, queryset, query):
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField
+
+        vector = RawSQL(self.vector_sql(queryset.model._meta.db_table), [],
+                        output_field=SearchVectorField())
+        search_query = SearchQuery(query, config=self.config, search_type='plain')
+        return (queryset.alias(search_vector=vector).filter(search_vector=search_query)
+                .annotate(search_rank=SearchRank(vector, search_query))
+                .order_by(self.rank_ordering))
+
+
+def get_search_backend():
+    path = getattr(settings, 'MARKETPLACE_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+    if default_connection.vendor == 'sqlite':
+        return SQLiteFTSBackend()
+    if default_connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return BaseSearchBackend()
@@ -0,0 +1,139 @@
+from django.contrib.auth.models import User
+from django.db.models.functions import Now
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from . import counters, facets, metrics
+
+from .caching import bump_listing_version
+from .media_gc import media_file_names, record_tombstones
+from .models import Category, Post, PostMedia, Profile, Response, UploadSession
+from .search import get_search_backend
+from .uploads import discard_parts
+
+
+@receiver(post_save, sender=Post)
+def index_post(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_search_backend().index(instance)
+
+
+@receiver(post_delete, sender=Post)
+def unindex_post(sender, instance, **kwargs):
+    get_search_backend().remove(instance.pk)
+
+
+@receiver(post_init, sender=Post)
+def remember_facet(sender, instance, **kwargs):
+    # Значения из БД, чтобы при сохранении перенести объявление между счётчиками
+    # (через __dict__, отложенные поля не подгружаются)
+    instance._facet_values = {field: instance.__dict__[field] for field in facets.FACET_FIELDS
+                              if field in instance.__dict__}
+
+
+def _facet_values(instance):
+    return {field: getattr(instance, field) for field in facets.FACET_FIELDS}
+
+
+# До сброса кэша ленты: счётчики кэшируются вместе с её поколением
+@receiver(post_save, sender=Post)
+def count_post_facets(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    values = _facet_values(instance)
+    old_key = None if created else facets.facet_key({**values, **instance._facet_values})
+    facets.move(old_key, facets.facet_key(values))
+    instance._facet_values = values
+
+
+@receiver(post_delete, sender=Post)
+def uncount_post_facets(sender, instance, **kwargs):
+    facets.shift(facets.facet_key({**_facet_values(instance), **instance._facet_values}), -1)
+
+
+@receiver([post_save, post_delete], sender=Post)
+@receiver([post_save, post_delete], sender=PostMedia)
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_listing_cache(sender, **kwargs):
+    bump_listing_version()
+
+
+@receiver(post_save, sender=Category)
+def touch_category_posts(sender, instance, created, raw=False, **kwargs):
+    # Название категории есть на странице каждого её объявления
+    if not created and not raw:
+        Post.objects.filter(category=instance).update(detail_modified_at=Now())
+
+
+@receiver(post_delete, sender=UploadSession)
+def discard_upload_parts(sender, instance, **kwargs):
+    discard_parts(instance)
+
+
+@receiver(post_delete, sender=PostMedia)
+def tombstone_media_files(sender, instance, **kwargs):
+    record_tombstones(media_file_names(instance))
+
+
+@receiver(post_save, sender=User)
+def create_profile(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        Profile.objects.get_or_create(user=instance)
+
+
+@receiver(post_save, sender=Post)
+def count_post_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        counters.shift(Profile, {'user_id': instance.author_id}, post_count=1)
+
+
+@receiver(post_delete, sender=Post)
+def count_post_deleted(sender, instance, **kwargs):
+    counters.shift(Profile, {'user_id': instance.author_id}, post_count=-1)
+
+
+@receiver(post_save, sender=PostMedia)
+def count_media_created(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    counters.shift(Post, {'pk': instance.post_id}, media_count=int(created),
+                   detail_modified_at=Now())
+    if created:
+        metrics.MEDIA_FILES.inc(kind='image' if instance.is_image else 'video')
+
+
+@receiver(post_delete, sender=PostMedia)
+def count_media_deleted(sender, instance, **kwargs):
+    counters.shift(Post, {'pk': instance.post_id}, media_count=-1, detail_modified_at=Now())
+
+
+@receiver(post_init, sender=Response)
+def remember_accepted(sender, instance, **kwargs):
+    # Исходное значение нужно, чтобы в post_save посчитать смену статуса
+    # (через __dict__, чтобы не подгружать отложенное поле)
+    instance._was_accepted = bool(instance.pk and instance.__dict__.get('is_accepted'))
+
+
+@receiver(post_save, sender=Response)
+def count_response_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    was_accepted = False if created else instance._was_accepted
+    counters.shift(
+        Post, {'pk': instance.post_id},
+        response_count=1 if created else 0,
+        accepted_response_count=int(instance.is_accepted) - int(was_accepted),
+        # Страница объявления показывает только принятые отзывы
+        detail_modified_at=Now() if instance.is_accepted or was_accepted else None,
+    )
+    instance._was_accepted = instance.is_accepted
+
+
+@receiver(post_delete, sender=Response)
+def count_response_deleted(sender, instance, **kwargs):
+    counters.shift(
+        Post, {'pk': instance.post_id},
+        response_count=-1,
+        accepted_response_count=-1 if instance._was_accepted else 0,
+        detail_modified_at=Now() if instance._was_accepted else None,
+    )
@@ -0,0 +1,48 @@
+'''
+Выделение уникальных slug-ов для объявлений.
+
+Заголовок транслитерируется (slugify сам по себе выбрасывает кириллицу),
+занятые варианты base, base-1, base-2... читаются одним запросом, а гонку
+двух одновременных сохранений разрешает уникальный индекс: при
+IntegrityError slug выделяется заново.
+'''
+import re
+
+from django.utils.text import slugify
+
+TRANSLIT = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e',
+    'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+    'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+}
+TRANSLIT_TABLE = str.maketrans(TRANSLIT | {k.upper(): v.capitalize() for k, v in TRANSLIT.items()})
+
+# Запас длины под суффикс "-12345"
+SUFFIX_RESERVE = 8
+
+
+def transliterate(text):
+    return text.translate(TRANSLIT_TABLE)
+
+
+def base_slug(title, max_length=80, default='post'):
+    slug = slugify(transliterate(title))[:max_length - SUFFIX_RESERVE].strip('-')
+    return slug or default
+
+
+def next_free_slug(queryset, base, field='slug'):
+    '''Первый свободный вариант base / base-N по одному запросу к БД'''
+    pattern = re.compile(rf'^{re.escape(base)}-(\d+)$')
+    taken = queryset.filter(**{f'{field}__startswith': base}).values_list(field, flat=True)
+    suffixes = set()
+    base_taken = False
+    for slug in taken:
+        if slug == base:
+            base_taken = True
+        elif match := pattern.match(slug):
+            suffixes.add(int(match.group(1)))
+    if not base_taken:
+        return base
+    return f'{base}-{max(suffixes, default=0) + 1}'
@@ -0,0 +1,214 @@
+'''
+Хранилище с дедупликацией по содержимому.
+
+Файлы с префиксом из DEDUP_PREFIXES (по умолчанию медиафайлы объявлений)
+сохраняются под именем blobs/<ab>/<cd>/<sha256><ext>. Одинаковое содержимое
+записывается один раз, а число сохранений учитывается в MediaBlob.ref_count:
+delete() уменьшает счётчик и удаляет файл только вместе с последней ссылкой.
+Остальные файлы (например, части поблочной загрузки) и файлы, сохранённые
+до включения дедупликации, проходят во внутреннее хранилище без изменений.
+
+CompressedManifestStaticFilesStorage - хранилище статики продакшен-профиля:
+имена с хэшем содержимого (ManifestStaticFilesStorage) и сжатые заранее
+копии .gz/.br текстовых файлов, которые прокси или serve_static отдают
+без сжатия на лету.
+'''
+import gzip
+import hashlib
+import os
+import threading
+import uuid
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+from django.db import transaction
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+from django.utils.module_loading import import_string
+
+try:
+    import brotli
+except ImportError:  # brotli не установлен - только gzip
+    brotli = None
+
+BLOB_PREFIX = 'blobs/'
+
+# Учёт ссылок из потоков одного процесса (PostMedia.objects.bulk_ingest) идёт
+# по очереди: короткие транзакции SQLite только мешали бы друг другу
+_refs_lock = threading.Lock()
+
+
+def blob_name(sha256, extension):
+    return f'{BLOB_PREFIX}{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}'
+
+
+def hash_content(content):
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in content.chunks():
+        sha256.update(chunk)
+        size += len(chunk)
+    return sha256.hexdigest(), size
+
+
+@deconstructible
+class DeduplicatingStorage(Storage):
+    def __init__(self, backend='django.core.files.storage.FileSystemStorage',
+                 options=None, prefixes=('post_media/',)):
+        self.backend = backend
+        self.options = options or {}
+        self.prefixes = tuple(prefixes)
+        self.inner = import_string(backend)(**self.options)
+
+    def is_deduplicated(self, name):
+        return name.startswith(self.prefixes)
+
+    def get_available_name(self, name, max_length=None):
+        if self.is_deduplicated(name):
+            # Итоговое имя определяется содержимым, см. _save()
+            return name
+        return self.inner.get_available_name(name, max_length)
+
+    def _save(self, name, content):
+        if not self.is_deduplicated(name):
+            return self.inner.save(name, content)
+        # Хэш, уже посчитанный при проверке (uploads.ChunkedFile), не считаем заново
+        sha256 = getattr(content, 'sha256', None)
+        return self.save_blob(content, os.path.splitext(name)[1].lower(), sha256,
+                              content.size if sha256 else None)
+
+    def save_blob(self, content, extension, sha256=None, size=None):
+        '''
+        Сохраняет содержимое как blob и добавляет ссылку на него. Файл пишется
+        внутри транзакции учёта ссылок: строка MediaBlob (новая - INSERT,
+        существующая - UPDATE) заблокирована до её конца, поэтому второй
+        процесс с тем же содержимым дождётся записи и не станет писать сам.
+        Если транзакцию вызывающего откатят, новый файл останется без строки
+        MediaBlob - такие файлы находит и удаляет scan_orphan_media.
+        '''
+        from .models import MediaBlob
+
+        if sha256 is None:
+            sha256, size = hash_content(content)
+        with _refs_lock, transaction.atomic():
+            blob, created = MediaBlob.objects.get_or_create(
+                sha256=sha256,
+                defaults={'name': blob_name(sha256, extension), 'size': size, 'ref_count': 1},
+            )
+            if not created:
+                MediaBlob.objects.filter(pk=sha256).update(ref_count=F('ref_count') + 1)
+            if created or not self.inner.exists(blob.name):
+                self.write_blob(blob.name, content)
+        return blob.name
+
+    def write_blob(self, name, content):
+        '''
+        Записывает файл blob-а целиком или не записывает вовсе. В локальной
+        файловой системе - во временный файл рядом и os.replace() на итоговое
+        имя (остаток прерванной записи перезаписывается). Объектные хранилища
+        (S3 и т.п.) создают объект атомарно сами. Если хранилище сохранило
+        файл под другим именем, запись считается неудавшейся.
+        '''
+        if isinstance(self.inner, FileSystemStorage):
+            temp = self.inner.save(f'{name}.{uuid.uuid4().hex}.tmp', content)
+            try:
+                os.replace(self.inner.path(temp), self.inner.path(name))
+            except BaseException:
+                self.inner.delete(temp)
+                raise
+            return
+        self.inner.delete(name)
+        saved = self.inner.save(name, content)
+        if saved != name:
+            self.inner.delete(saved)
+            raise OSError(f'Хранилище сохранило {name} под именем {saved}')
+
+    def release(self, name):
+        '''
+        Снимает одну ссылку на файл. Возвращает True, если ссылок не осталось
+        и файл нужно физически удалить из внутреннего хранилища. Файлы вне
+        BLOB_PREFIX (части загрузок, превью) ссылок не имеют - без запросов.
+        '''
+        from .models import MediaBlob
+
+        if not name.startswith(BLOB_PREFIX):
+            return True
+        with transaction.atomic():
+            updated = MediaBlob.objects.filter(name=name, ref_count__gt=1) \
+                .update(ref_count=F('ref_count') - 1)
+            if updated:
+                return False
+            MediaBlob.objects.filter(name=name).delete()
+        return True
+
+    def delete(self, name):
+        if self.release(name):
+            self.inner.delete(name)
+
+    def _open(self, name, mode='rb'):
+        return self.inner.open(name, mode)
+
+    def exists(self, name):
+        return self.inner.exists(name)
+
+    def listdir(self, path):
+        return self.inner.listdir(path)
+
+    def size(self, name):
+        return self.inner.size(name)
+
+    def url(self, name):
+        return self.inner.url(name)
+
+    def path(self, name):
+        return self.inner.path(name)
+
+    def get_accessed_time(self, name):
+        return self.inner.get_accessed_time(name)
+
+    def get_created_time(self, name):
+        return self.inner.get_created_time(name)
+
+    def get_modified_time(self, name):
+        return self.inner.get_modified_time(name)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    '''
+    После обработки collectstatic сохраняет рядом с текстовыми файлами
+    (исходными и с хэшем в имени) копии name.gz и name.br. Копия не
+    сохраняется, если сжатие экономит меньше 5%.
+    '''
+    compressible_extensions = ('.css', '.js', '.mjs', '.map', '.json', '.svg', '.txt', '.xml',
+                               '.html', '.ico')
+    min_compress_size = 256
+
+    def compressors(self):
+        yield '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+        if brotli is not None:
+            yield '.br', lambda data: brotli.compress(data, quality=11)
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        names = set(paths) | set(self.hashed_files.values())
+        for name in sorted(names):
+            if name.endswith(self.compressible_extensions) and self.exists(name):
+                for compressed in self.compress(name):
+                    yield name, compressed, True
+
+    def compress(self, name):
+        with self.open(name) as fh:
+            data = fh.read()
+        if len(data) < self.min_compress_size:
+            return
+        for suffix, compress in self.compressors():
+            compressed = compress(data)
+            target = name + suffix
+            if self.exists(target):
+                self.delete(target)
+            if len(compressed) < len(data) * 0.95:
+                self._save(target, ContentFile(compressed))
+                yield target
@@ -0,0 +1,44 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html
+
+register = template.Library()
+
+CARD_SIZES = '(max-width: 768px) 100vw, (max-width: 992px) 50vw, 33vw'
+
+
+def _widths(derivatives):
+    return sorted(int(key) for key in derivatives if key.isdigit())
+
+
+def _srcset(derivatives, fmt):
+    return ', '.join(f'{default_storage.url(derivatives[str(width)][fmt])} {width}w'
+                     for width in _widths(derivatives))
+
+
+@register.simple_tag
+def media_picture(media, alt='', css_class='', sizes=CARD_SIZES):
+    '''
+    <picture> с WebP/JPEG превью разных ширин (srcset).
+    Пока превью не готовы - обычный <img> с оригиналом.
+    '''
+    derivatives = media.derivatives or {}
+    widths = _widths(derivatives)
+    if not widths:
+        return format_html('<img src="{}" alt="{}" class="{}" loading="lazy">',
+                           media.file.url, alt, css_class)
+    fallback = default_storage.url(derivatives[str(widths[0])]['jpeg'])
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" alt="{}" class="{}" loading="lazy"></picture>',
+        _srcset(derivatives, 'webp'), sizes, fallback, _srcset(derivatives, 'jpeg'),
+        sizes, alt, css_class,
+    )
+
+
+@register.filter
+def poster_url(media):
+    '''URL заглушки-постера видео или пустая строка'''
+    poster = (media.derivatives or {}).get('poster', {})
+    name = poster.get('webp') or poster.get('jpeg')
+    return default_storage.url(name) if name else ''
@@ -1,3 +1,1828 @@
-from django.test import TestCase
+import gc
+import gzip
+import hashlib
+import html
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.exceptions import ValidationError
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
+from django.db import (IntegrityError, OperationalError, close_old_connections, connection,
+                       connections, transaction)
+from django.template import Context, Template
+from django.http import HttpResponse, QueryDict
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, reverse
+from django.utils import timezone
+
+from .models import (Category, Post, PostMedia, OutgoingEmail, UploadSession, MediaBlob,
+                     MediaTombstone, PendingNotification, PostFacet, Profile, Response)
+from .outbox import enqueue_email, process_outbox
+from . import (benchmarks, derivatives, facets, instrumentation, media_gc, media_serving, metrics,
+               routers, slugs, uploads)
+from .async_views import AsyncPostView, AsyncPostDetailView, AsyncResponseListView
+from .caching import VERSION_KEY, listing_cache_stats, listing_version, post_card_cache_key, render_post_cards
+from .counters import reconcile
+from .pagination import CursorPaginator
+from .search import get_search_backend
+from .storage import DeduplicatingStorage, blob_name
+
+
+class SellerPostFixtureMixin:
+    """Продавец, категория «Золото» и объявление продавца.
+
+    Классам, которым объявление не нужно, достаточно задать post_slug = None.
+    """
+    post_slug = 'gold'
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.seller = User.objects.create_user('seller', 'seller@example.com', 'pass')
+        cls.category = Category.objects.create(name='Золото', slug='gold')
+        if cls.post_slug:
+            cls.post = cls.create_seller_post(slug=cls.post_slug)
+
+    @classmethod
+    def create_seller_post(cls, **fields):
+        fields = {'author': cls.seller, 'category': cls.category, 'title': 'Золото',
+                  'content': '...', 'price': 10, 'type_post': Post.WTS, **fields}
+        return Post.objects.create(**fields)
+
+
+class TempMediaRootMixin:
+    """MEDIA_ROOT во временном каталоге на время теста, media_settings переопределяется вместе с ним"""
+    media_settings = {}
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, **self.media_settings)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class PostListQueriesTest(SellerPostFixtureMixin, TestCase):
+    post_slug = None
+
+    def setUp(self):
+        cache.clear()
+
+    def create_posts(self, count):
+        posts = [
+            self.create_seller_post(title=f'Лот {i}', slug=f'lot-{count}-{i}', price=i)
+            for i in range(count)
+        ]
+        PostMedia.objects.bulk_create(
+            PostMedia(post=post, file=f'{post.id}/post-{post.id}-{n:03d}.jpg')
+            for post in posts for n in range(1, 4)
+        )
+
+    def count_listing_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('post_list'))
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_constant_queries_regardless_of_page_size(self):
+        self.create_posts(2)
+        few = self.count_listing_queries()
+        self.create_posts(10)
+        self.assertEqual(self.count_listing_queries(), few)
+
+    def test_cover_media_is_first_file(self):
+        self.create_posts(1)
+        post = Post.objects.for_cards().get()
+        with self.assertNumQueries(0):
+            cover = post.cover_media
+            self.assertTrue(cover.is_image)
+        self.assertEqual(cover, post.media.order_by('id').first())
+
+
+class QueryPlansTest(TestCase):
+    def test_listing_queries_use_indexes(self):
+        out = StringIO()
+        call_command('check_query_plans', stdout=out)
+        self.assertNotIn('полный проход', out.getvalue())
+
+
+@override_settings(MARKETPLACE_CURSOR_PAGINATION=True)
+class CursorPaginationTest(SellerPostFixtureMixin, TestCase):
+    post_slug = None
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(30):
+            cls.create_seller_post(title=f'Лот {i}', slug=f'lot-{i}', price=i,
+                                   type_post=Post.WTS if i % 2 else Post.WTB)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_walks_all_posts_in_order_and_back(self):
+        expected = list(Post.objects.order_by('-updated_at', '-id'))
+        paginator = CursorPaginator(Post.objects.all(), 7)
+        seen, page, pages = [], paginator.page(), []
+        while True:
+            pages.append(page)
+            seen.extend(page)
+            if not page.has_next():
+                break
+            page = paginator.page(page.next_cursor)
+        self.assertEqual(seen, expected)
+        self.assertFalse(pages[0].has_previous())
+
+        back = paginator.page(pages[-1].previous_cursor)
+        self.assertEqual(list(back), list(pages[-2]))
+
+    def test_cursor_keeps_filters_and_skips_count(self):
+        response = self.client.get(reverse('post_list'), {'type_post': 'wts'})
+        page = response.context['page_obj']
+        self.assertIn('type_post=wts', response.content.decode())
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('post_list'),
+                                       {'type_post': 'wts', 'cursor': page.next_cursor})
+        self.assertFalse(any('COUNT(' in q['sql'] for q in ctx.captured_queries))
+        posts = response.context['posts']
+        self.assertTrue(all(post.type_post == Post.WTS for post in posts))
+        self.assertEqual(len(posts), 3)
+
+    def page_link_params(self, response, start):
+        hrefs = re.findall(rf'href="\?({start}[^"]*)"', response.content.decode())
+        self.assertTrue(hrefs)
+        return QueryDict(html.unescape(hrefs[0]))
+
+    def test_page_links_encode_filter_values(self):
+        # Поиск выключает курсор - ссылки с номерами страниц
+        query = 'Лот & #+'
+        response = self.client.get(reverse('post_list'), {'q': query})
+        self.assertEqual(self.page_link_params(response, 'page=2')['q'], query)
+
+        response = self.client.get(reverse('post_list'), {'type_post': 'wts', 'ref': 'a&b=c #d'})
+        params = self.page_link_params(response, 'cursor=')
+        self.assertEqual((params['type_post'], params['ref']), ('wts', 'a&b=c #d'))
+
+    def test_invalid_cursor_is_404(self):
+        response = self.client.get(reverse('post_list'), {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+
+class PostSearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('seller', 'seller@example.com', 'pass')
+        category = Category.objects.create(name='Оружие', slug='weapons')
+        cls.sword = Post.objects.create(author=author, category=category, slug='sword',
+                                        title='Легендарный меч', content='Почти новый',
+                                        price=100, type_post=Post.WTS)
+        cls.shield = Post.objects.create(author=author, category=category, slug='shield',
+                                         title='Щит', content='Отдам вместе с мечами',
+                                         price=50, type_post=Post.WTS)
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, query):
+        response = self.client.get(reverse('post_list'), {'q': query})
+        return list(response.context['posts'])
+
+    def test_stemmed_match_ranks_title_first(self):
+        self.assertEqual(self.search('мечи'), [self.sword, self.shield])
+        self.assertEqual(self.search('легендарные мечи'), [self.sword])
+
+    @override_settings(MARKETPLACE_CURSOR_PAGINATION=True)
+    def test_search_keeps_relevance_order_with_cursor_pagination(self):
+        # Щит изменён позже меча, но меч совпадает по заголовку
+        self.shield.save()
+        response = self.client.get(reverse('post_list'), {'q': 'мечи'})
+        self.assertFalse(response.context['cursor_pagination'])
+        self.assertEqual(list(response.context['posts']), [self.sword, self.shield])
+
+    def test_rank_is_annotated(self):
+        posts = list(get_search_backend().apply(Post.objects.all(), 'меч'))
+        self.assertEqual(posts, [self.sword, self.shield])
+        self.assertLess(posts[0].search_rank, posts[1].search_rank)
+
+    def test_search_joins_index_once(self):
+        sql = str(get_search_backend().apply(Post.objects.for_cards(), 'меч').query)
+        self.assertEqual(sql.count('JOIN "marketplace_post_fts"'), 1)
+        self.assertNotIn('bm25', sql)
+
+    def test_admin_search_orders_by_relevance_or_column(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        changelist = reverse('admin:marketplace_post_changelist')
+        # Без поиска админка сортирует по -created_at: щит создан позже
+        response = self.client.get(changelist)
+        self.assertEqual(list(response.context['cl'].result_list), [self.shield, self.sword])
+        response = self.client.get(changelist, {'q': 'мечи'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.sword, self.shield])
+        # Сортировка по столбцу цены заменяет релевантность
+        response = self.client.get(changelist, {'q': 'мечи', 'o': '4'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.shield, self.sword])
+
+    def test_index_follows_save_and_delete(self):
+        self.shield.title = 'Щит и кольцо'
+        self.shield.save()
+        self.assertEqual(self.search('кольца'), [self.shield])
+        self.shield.delete()
+        self.assertEqual(self.search('кольца'), [])
+
+    def test_admin_search_uses_index(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.force_login(admin)
+        response = self.client.get(reverse('admin:marketplace_post_changelist'), {'q': 'меча'})
+        self.assertEqual(set(response.context['cl'].result_list), {self.sword, self.shield})
+
+
+class ListingCacheTest(SellerPostFixtureMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_anonymous_page_is_cached_per_filter(self):
+        url = reverse('post_list')
+        self.client.get(url, {'type_post': 'wts'})
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'type_post': 'wts', 'page': '1'})
+        self.assertContains(response, 'Золото')
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url, {'type_post': 'wtb'})
+        self.assertTrue(ctx.captured_queries)
+        self.assertEqual(listing_cache_stats()['hits'], 1)
+
+    def test_post_change_invalidates(self):
+        url = reverse('post_list')
+        self.client.get(url)
+        self.post.title = 'Серебро'
+        self.post.save()
+        self.assertContains(self.client.get(url), 'Серебро')
+
+    def test_evicted_version_does_not_revive_old_pages(self):
+        url = reverse('post_list')
+        self.client.get(url)
+        self.post.title = 'Серебро'
+        self.post.save()
+        self.client.get(url)
+        # Ключ поколения вытеснен, а страницы прежних поколений ещё в кэше
+        cache.delete(VERSION_KEY)
+        self.post.title = 'Медь'
+        self.post.save()
+        self.assertContains(self.client.get(url), 'Медь')
+        cache.delete(VERSION_KEY)
+        self.assertContains(self.client.get(url), 'Медь')
+
+    def test_authenticated_user_sees_own_edit_link(self):
+        url = reverse('post_list')
+        self.client.get(url)
+        self.client.force_login(self.seller)
+        self.assertContains(self.client.get(url), reverse('edit_post', args=[self.post.slug]))
+
+
+@override_settings(MARKETPLACE_LISTING_CACHE_TIMEOUT=0)
+class PostCardCacheTest(SellerPostFixtureMixin, TestCase):
+    post_slug = None
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.buyer = User.objects.create_user('buyer', 'buyer@example.com', 'pass')
+        cls.posts = [cls.create_seller_post(slug=f'lot-{i}', title=f'Лот {i}', price=i)
+                     for i in range(3)]
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cards_are_read_with_one_get_many(self):
+        posts = list(Post.objects.for_cards())
+        with mock.patch('marketplace.caching.cache.set_many', wraps=cache.set_many) as set_many:
+            cold = render_post_cards(posts)
+        self.assertEqual(len(set_many.call_args.args[0]), 3)
+        with mock.patch('marketplace.caching.cache.get_many', wraps=cache.get_many) as get_many, \
+                mock.patch('marketplace.caching.get_template') as get_template:
+            warm = render_post_cards(posts)
+        get_many.assert_called_once()
+        get_template.assert_not_called()
+        self.assertEqual([card['html'] for card in warm], [card['html'] for card in cold])
+        self.assertIn(reverse('post_detail', args=['lot-0']), warm[-1]['html'])
+
+        with override_settings(MARKETPLACE_POST_CARD_CACHE_TIMEOUT=0), \
+                mock.patch('marketplace.caching.cache.get_many') as get_many:
+            self.assertEqual(len(render_post_cards(posts)), 3)
+        get_many.assert_not_called()
+
+    def test_changes_produce_new_keys(self):
+        post = self.posts[0]
+        self.client.get(reverse('post_list'))
+        key = post_card_cache_key(Post.objects.select_related('author').get(pk=post.pk))
+        self.assertIsNotNone(cache.get(key))
+
+        post.title = 'Серебро'
+        post.save()
+        self.assertContains(self.client.get(reverse('post_list')), 'Серебро')
+        self.category.name = 'Серебро и золото'
+        self.category.save()
+        self.assertContains(self.client.get(reverse('post_list')),
+                            '<span class="category-badge mb-2">Серебро и золото</span>', count=3)
+        self.seller.username = 'merchant'
+        self.seller.save()
+        self.assertContains(self.client.get(reverse('post_list')), '👤 merchant', count=3)
+
+    def test_link_depends_on_user_not_on_cached_card(self):
+        url = reverse('post_list')
+        edit_url = reverse('edit_post', args=['lot-0'])
+        self.assertNotContains(self.client.get(url), edit_url)
+        self.client.force_login(self.seller)
+        self.assertContains(self.client.get(url), edit_url)
+        self.client.force_login(self.buyer)
+        self.assertNotContains(self.client.get(url), edit_url)
+
+    @override_settings(ROOT_URLCONF='marketplace.tests')
+    def test_async_view_renders_same_cards(self):
+        self.client.force_login(self.seller)
+        sync_response = self.client.get('/')
+        cache.clear()
+        async_response = self.client.get('/async/')
+        self.assertEqual(async_response.context['post_cards'], sync_response.context['post_cards'])
+        self.assertContains(async_response, reverse('edit_post', args=['lot-0']))
+
+    def test_benchmark(self):
+        benchmarks.generate_data(users=3, categories=2, posts=6, media_per_post=1,
+                                 responses_per_post=0)
+        results = benchmarks.run_card_benchmark(page_sizes=(2, 4), iterations=2)
+        self.assertEqual(set(results), {f'{size}_{mode}' for size in (2, 4)
+                                        for mode in benchmarks.CARD_MODES})
+        self.assertEqual(results['4_warm']['queries'], results['4_uncached']['queries'])
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise ConnectionError('SMTP недоступен')
+
+
+class OutboxTest(SellerPostFixtureMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.buyer = User.objects.create_user('buyer', 'buyer@example.com', 'pass')
+
+    def test_response_enqueues_instead_of_sending(self):
+        self.client.force_login(self.buyer)
+        self.client.post(reverse('add_response', args=[self.post.slug]), {'content': 'Беру'})
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.recipients, ['seller@example.com'])
+
+        call_command('send_outbox', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['seller@example.com'])
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutgoingEmail.SENT)
+
+    def test_batch_is_sent_by_threads(self):
+        for i in range(10):
+            enqueue_email(f'Письмо {i}', '...', [f'user{i}@example.com'])
+        self.assertEqual(process_outbox(batch_size=100, threads=3), (10, 0))
+        self.assertEqual(len(mail.outbox), 10)
+        self.assertEqual(process_outbox(), (0, 0))
+
+    @override_settings(EMAIL_BACKEND='marketplace.tests.FailingEmailBackend',
+                       MARKETPLACE_OUTBOX_MAX_ATTEMPTS=2)
+    def test_retries_with_backoff_then_fails(self):
+        email = enqueue_email('Тема', '...', ['user@example.com'])
+        self.assertEqual(process_outbox(), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutgoingEmail.PENDING, 1))
+        self.assertEqual(process_outbox(), (0, 0))  # ещё не время повтора
+
+        OutgoingEmail.objects.update(next_attempt_at=email.created_at)
+        process_outbox()
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutgoingEmail.FAILED)
+        self.assertIn('SMTP', email.last_error)
+
+
+class ChunkedUploadTest(SellerPostFixtureMixin, TempMediaRootMixin, TestCase):
+    chunk_size = 256 * 1024
+    media_settings = {'MARKETPLACE_UPLOAD_CHUNK_SIZE': chunk_size}
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.seller)
+
+    def upload(self, data, filename='screen.png', complete=True):
+        response = self.client.post(reverse('upload_init', args=[self.post.slug]),
+                                    {'filename': filename, 'size': len(data)})
+        self.assertEqual(response.status_code, 201)
+        upload_id = response.json()['upload_id']
+        url = reverse('upload_chunk', args=[upload_id])
+        for offset in range(0, len(data), self.chunk_size):
+            response = self.client.post(f'{url}?offset={offset}',
+                                        data[offset:offset + self.chunk_size],
+                                        content_type='application/octet-stream')
+            if response.status_code != 200:
+                return response
+            # Тело запроса живёт в циклических ссылках тестового клиента до сборки мусора
+            gc.collect()
+        if not complete:
+            return upload_id
+        return self.client.post(reverse('upload_complete', args=[upload_id]),
+                                {'sha256': hashlib.sha256(data).hexdigest()})
+
+    def test_completion_queries_do_not_depend_on_parts(self):
+        for parts in (1, 8):
+            data = b'\x89PNG\r\n\x1a\n' + os.urandom(self.chunk_size * parts - 8)
+            upload_id = self.upload(data, complete=False)
+            # Части загрузки не учитываются в MediaBlob: их удаление без запросов к БД
+            with self.assertNumQueries(13):
+                response = self.client.post(reverse('upload_complete', args=[upload_id]))
+            self.assertEqual(response.status_code, 201)
+
+    def test_upload_creates_media_with_hash(self):
+        data = b'\x89PNG\r\n\x1a\n' + os.urandom(self.chunk_size * 3)
+        response = self.upload(data)
+        self.assertEqual(response.status_code, 201)
+        media = PostMedia.objects.get(pk=response.json()['id'])
+        with media.file.open('rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertFalse(UploadSession.objects.exists())
+        for _, _, files in os.walk(os.path.join(settings.MEDIA_ROOT, 'uploads')):
+            self.assertEqual(files, [])
+
+    def test_checksum_mismatch_creates_nothing(self):
+        data = b'\x89PNG\r\n\x1a\n' + os.urandom(self.chunk_size * 2)
+        upload_id = self.upload(data, complete=False)
+        version = listing_version()
+        with mock.patch('marketplace.models.schedule_derivatives') as schedule:
+            response = self.client.post(reverse('upload_complete', args=[upload_id]),
+                                        {'sha256': hashlib.sha256(b'other').hexdigest()})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PostMedia.objects.exists())
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertFalse(schedule.called)
+        self.assertEqual(listing_version(), version)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.media_count, 0)
+
+    def test_losing_chunk_request_keeps_winner_part(self):
+        data = b'GIF89a' + os.urandom(self.chunk_size * 2 - 6)
+        upload_id = self.client.post(reverse('upload_init', args=[self.post.slug]),
+                                     {'filename': 'a.gif', 'size': len(data)}).json()['upload_id']
+        url = reverse('upload_chunk', args=[upload_id])
+        stale = UploadSession.objects.get(pk=upload_id)
+        self.client.post(f'{url}?offset=0', data[:self.chunk_size],
+                         content_type='application/octet-stream')
+        # Параллельный запрос прочитал сессию до UPDATE первого и проиграл его
+        with mock.patch('marketplace.views.get_object_or_404', return_value=stale):
+            response = self.client.post(f'{url}?offset=0', b'GIF89a' + bytes(self.chunk_size - 6),
+                                        content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 409)
+        part = uploads.part_name(stale, 0)
+        with default_storage.open(part) as fh:
+            self.assertEqual(fh.read(), data[:self.chunk_size])
+        self.assertEqual(os.listdir(os.path.dirname(default_storage.path(part))),
+                         [os.path.basename(part)])
+
+    def test_magic_bytes_must_match_extension(self):
+        response = self.upload(b'MZ' + os.urandom(1024), filename='cheat.png')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PostMedia.objects.exists())
+
+    def test_resume_reports_received_offset(self):
+        data = b'GIF89a' + os.urandom(self.chunk_size)
+        upload_id = self.client.post(reverse('upload_init', args=[self.post.slug]),
+                                     {'filename': 'a.gif', 'size': len(data)}).json()['upload_id']
+        url = reverse('upload_chunk', args=[upload_id])
+        self.client.post(f'{url}?offset=0', data[:self.chunk_size],
+                         content_type='application/octet-stream')
+        response = self.client.post(f'{url}?offset=0', data[:self.chunk_size],
+                                    content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.get(url).json()['received'], self.chunk_size)
+
+    def test_memory_stays_below_file_size(self):
+        data = b'\xff\xd8\xff' + os.urandom(self.chunk_size * 32)
+        tracemalloc.start()
+        try:
+            response = self.upload(data, filename='big.jpg')
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(response.status_code, 201)
+        # Файл 8 МБ, в памяти одновременно - единицы частей по 256 КБ
+        self.assertLess(peak, len(data) // 4)
+
+
+def make_png(width=800, height=600):
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), (200, 50, 50)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@override_settings(MARKETPLACE_DERIVATIVES_ASYNC=False)
+class DerivativesTest(SellerPostFixtureMixin, TempMediaRootMixin, TestCase):
+    def create_media(self, name, content):
+        with self.captureOnCommitCallbacks(execute=True):
+            return PostMedia.objects.create(post=self.post, file=SimpleUploadedFile(name, content))
+
+    def test_image_thumbnails_and_srcset(self):
+        media = self.create_media('shot.png', make_png())
+        media.refresh_from_db()
+        self.assertEqual(set(media.derivatives), {'320', '640'})
+        for name in derivatives.derivative_files(media.derivatives):
+            self.assertTrue(os.path.exists(os.path.join(self.media_root, name)))
+
+        html = Template('{% load media_tags %}{% media_picture media "alt" %}').render(
+            Context({'media': media}))
+        self.assertIn('type="image/webp"', html)
+        self.assertIn('320w', html)
+
+    def test_video_gets_poster_and_cleanup_removes_files(self):
+        media = self.create_media('clip.mp4', b'\x00\x00\x00\x18ftypmp42' + b'\x00' * 64)
+        media.refresh_from_db()
+        files = derivatives.derivative_files(media.derivatives)
+        self.assertTrue(files and all('.poster.' in name for name in files))
+        media.delete()
+        media_gc.sweep()
+        for name in files:
+            self.assertFalse(os.path.exists(os.path.join(self.media_root, name)))
+
+    def test_backfill_command(self):
+        media = self.create_media('shot.png', make_png(400, 300))
+        PostMedia.objects.filter(pk=media.pk).update(derivatives={})
+        call_command('generate_derivatives', workers=2, stdout=StringIO())
+        media.refresh_from_db()
+        self.assertIn('320', media.derivatives)
+
+
+class DeduplicatingStorageTest(SellerPostFixtureMixin, TempMediaRootMixin, TestCase):
+    post_slug = None
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.posts = [cls.create_seller_post(slug=f'gold-{i}') for i in range(2)]
+
+    def test_identical_uploads_share_one_blob(self):
+        content = b'GIF89a' + os.urandom(2048)
+        first, second = (PostMedia.objects.create(post=post, file=SimpleUploadedFile('a.gif', content))
+                         for post in self.posts)
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(MediaBlob.objects.get().ref_count, 2)
+
+        path = default_storage.path(first.file.name)
+        first.delete()
+        media_gc.sweep()
+        self.assertTrue(os.path.exists(path))
+        self.posts[1].delete()
+        media_gc.sweep()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(MediaBlob.objects.exists())
+
+    def test_blob_replaces_leftover_of_interrupted_write(self):
+        content = b'GIF89a' + os.urandom(2048)
+        sha256 = hashlib.sha256(content).hexdigest()
+        name = blob_name(sha256, '.gif')
+        default_storage.inner.save(name, ContentFile(b'GIF89a'))
+        media = PostMedia.objects.create(post=self.posts[0], file=SimpleUploadedFile('a.gif', content))
+        self.assertEqual(media.file.name, name)
+        with default_storage.open(name) as fh:
+            self.assertEqual(fh.read(), content)
+        # Ни временного файла, ни копии с суффиксом рядом
+        self.assertEqual(os.listdir(os.path.dirname(default_storage.path(name))),
+                         [os.path.basename(name)])
+
+    def test_blob_saved_under_other_name_is_rejected(self):
+        # Нелокальное хранилище (как S3) вернуло не то имя - например, его занял
+        # параллельный процесс: файл не остаётся без учёта, ссылка не создаётся
+        storage = DeduplicatingStorage(backend='django.core.files.storage.InMemoryStorage')
+        save = storage.inner.save
+        content = b'GIF89a' + os.urandom(64)
+        name = blob_name(hashlib.sha256(content).hexdigest(), '.gif')
+        with mock.patch.object(storage.inner, 'save',
+                               side_effect=lambda name, content: save(f'{name}_x', content)):
+            with self.assertRaises(OSError):
+                storage.save('post_media/a.gif', ContentFile(content))
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertFalse(storage.inner.exists(f'{name}_x'))
+        # Без подмены тот же файл сохраняется под своим именем
+        self.assertEqual(storage.save('post_media/a.gif', ContentFile(content)), name)
+        self.assertEqual(MediaBlob.objects.get().name, name)
+        self.assertTrue(storage.inner.exists(name))
+
+    @override_settings(MARKETPLACE_DERIVATIVES_ASYNC=False)
+    def test_shared_blob_keeps_thumbnails_of_other_post(self):
+        content = make_png(700, 500)
+        with self.captureOnCommitCallbacks(execute=True):
+            first, second = (PostMedia.objects.create(post=post,
+                                                      file=SimpleUploadedFile('a.png', content))
+                             for post in self.posts)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.file.name, second.file.name)
+        first_files = derivatives.derivative_files(first.derivatives)
+        second_files = derivatives.derivative_files(second.derivatives)
+        self.assertTrue(second_files)
+        self.assertFalse(set(first_files) & set(second_files))
+
+        # Перегенерация превью одного объявления не трогает превью другого
+        derivatives.generate_derivatives(second)
+        self.assertTrue(all(default_storage.exists(name) for name in first_files))
+
+        self.posts[0].delete()
+        media_gc.sweep()
+        self.assertTrue(default_storage.exists(second.file.name))
+        for name in second_files:
+            self.assertTrue(default_storage.exists(name), name)
+        self.assertFalse(any(default_storage.exists(name) for name in first_files))
+
+    def test_dedupe_command_collapses_existing_files(self):
+        content = b'GIF89a' + os.urandom(4096)
+        inner = default_storage.inner
+        names = [inner.save(f'post_media/{post.id}/post-{post.id}-001.gif', ContentFile(content))
+                 for post in self.posts]
+        PostMedia.objects.bulk_create(PostMedia(post=post, file=name)
+                                      for post, name in zip(self.posts, names))
+
+        out = StringIO()
+        call_command('dedupe_media', stdout=out)
+        self.assertIn(f'({len(content)} байт)', out.getvalue())
+        blob = MediaBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(set(PostMedia.objects.values_list('file', flat=True)), {blob.name})
+        self.assertFalse(any(inner.exists(name) for name in names))
+
+
+class SlugAllocatorTest(SellerPostFixtureMixin, TestCase):
+    post_slug = None
+
+    def create(self, title='Продам золото'):
+        return self.create_seller_post(title=title)
+
+    def test_cyrillic_is_transliterated(self):
+        self.assertEqual(self.create().slug, 'prodam-zoloto')
+        self.assertEqual(self.create().slug, 'prodam-zoloto-1')
+        self.assertEqual(self.create('Щит Ёжика').slug, 'shchit-ezhika')
+        self.assertEqual(self.create('!!!').slug, 'post')
+
+    def test_queries_do_not_grow_with_duplicates(self):
+        self.create()
+        with CaptureQueriesContext(connection) as few:
+            self.create()
+        for _ in range(20):
+            self.create()
+        with CaptureQueriesContext(connection) as many:
+            post = self.create()
+        self.assertEqual(len(many), len(few))
+        self.assertEqual(post.slug, 'prodam-zoloto-22')
+
+    def test_retries_when_slug_is_taken_concurrently(self):
+        self.create()
+        real = slugs.next_free_slug
+        # Первый раз отдаём уже занятый slug, как будто его заняли между запросом и INSERT
+        with mock.patch('marketplace.models.next_free_slug', side_effect=_first_taken(real)):
+            post = self.create()
+        self.assertEqual(post.slug, 'prodam-zoloto-1')
+
+
+def _first_taken(real):
+    calls = []
+
+    def allocate(queryset, base, **kwargs):
+        calls.append(base)
+        return base if len(calls) == 1 else real(queryset, base, **kwargs)
+    return allocate
+
+
+class ConcurrentSlugTest(TransactionTestCase):
+    threads = 8
+    posts_per_thread = 5
+
+    def test_parallel_creates_get_unique_slugs(self):
+        author = User.objects.create_user('seller', 'seller@example.com', 'pass')
+        category = Category.objects.create(name='Золото', slug='gold')
+        errors = []
+        barrier = threading.Barrier(self.threads)
+
+        def worker():
+            try:
+                barrier.wait()
+                created = 0
+                while created < self.posts_per_thread:
+                    try:
+                        Post.objects.create(author=author, category=category, title='Продам золото',
+                                            content='...', price=10, type_post=Post.WTS)
+                        created += 1
+                    except OperationalError as e:
+                        # Тестовая БД SQLite в памяти с общим кэшем не ждёт блокировку,
+                        # а сразу возвращает ошибку - это не про выделение slug
+                        if 'locked' not in str(e):
+                            raise
+            except Exception as e:
+                errors.append(e)
+            finally:
+                close_old_connections()
+
+        workers = [threading.Thread(target=worker) for _ in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        slugs_created = list(Post.objects.values_list('slug', flat=True))
+        self.assertEqual(len(slugs_created), self.threads * self.posts_per_thread)
+        self.assertEqual(len(set(slugs_created)), len(slugs_created))
+
+
+def gif(name='a.gif'):
+    return SimpleUploadedFile(name, b'GIF89a' + os.urandom(256), content_type='image/gif')
+
+
+class MediaIngestTest(SellerPostFixtureMixin, TempMediaRootMixin, TestCase):
+
+    def stored_files(self):
+        return [name for name, _ in media_gc.iter_files(self.media_root)]
+
+    def test_numbers_allocated_in_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.post.allocate_media_numbers(5), range(1, 6))
+        # Устаревший экземпляр не откатывает счётчик при сохранении
+        stale = Post.objects.get(pk=self.post.pk)
+        stale.media_sequence = 0
+        stale.save()
+        self.assertEqual(self.post.allocate_media_numbers(1), range(6, 7))
+
+    def test_bulk_ingest(self):
+        media = PostMedia.objects.bulk_ingest(self.post, [gif() for _ in range(5)])
+        self.assertEqual(PostMedia.objects.filter(post=self.post).count(), 5)
+        self.assertEqual(len(set(item.file.name for item in media)), 5)
+        self.assertEqual(len(self.stored_files()), 5)
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.media_count, self.post.media_sequence), (5, 0))
+        self.assertEqual(reconcile(), {'posts': 0, 'profiles': 0})
+
+        with override_settings(STORAGES={'default': {
+                'BACKEND': 'django.core.files.storage.FileSystemStorage'}}):
+            media = PostMedia.objects.bulk_ingest(self.post, [gif('b.GIF'), gif()])
+        self.assertEqual([item.file.name for item in media],
+                         [f'post_media/{self.post.pk}/post-{self.post.pk}-001.gif',
+                          f'post_media/{self.post.pk}/post-{self.post.pk}-002.gif'])
+
+    def test_content_addressed_storage_skips_numbering(self):
+        # DeduplicatingStorage называет файлы по SHA-256 - номер не выделяется
+        content = b'GIF89a' + os.urandom(256)
+        media = PostMedia.objects.bulk_ingest(
+            self.post, [SimpleUploadedFile('a.gif', content, content_type='image/gif')])
+        single = PostMedia(post=self.post, file=gif())
+        single.save()
+        sha256 = hashlib.sha256(content).hexdigest()
+        self.assertEqual(PostMedia.objects.get(pk=media[0].pk).file.name,
+                         f'blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}.gif')
+        self.assertTrue(single.file.name.startswith('blobs/'))
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.media_sequence, 0)
+
+    def test_failed_insert_removes_written_files(self):
+        # Ошибка уже после вставки строк - откатываются и строки, и файлы
+        with mock.patch('marketplace.models.counters.shift', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                PostMedia.objects.bulk_ingest(self.post, [gif() for _ in range(4)])
+        self.assertEqual(self.stored_files(), [])
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertFalse(PostMedia.objects.exists())
+
+        with self.assertRaises(ValidationError):
+            PostMedia.objects.bulk_ingest(self.post, [gif(), gif('evil.exe')])
+        self.assertEqual(self.stored_files(), [])
+
+    def test_edit_form_skips_invalid_files(self):
+        self.client.force_login(self.seller)
+        self.client.post(reverse('edit_post', args=[self.post.slug]), {
+            'title': 'Золото', 'content': '...', 'price': 10, 'type_post': Post.WTS,
+            'category': self.post.category_id, 'media_files': [gif(), gif('evil.exe'), gif()],
+        })
+        self.assertEqual(PostMedia.objects.filter(post=self.post).count(), 2)
+
+
+@override_settings(STORAGES={'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+                             'staticfiles': settings.STORAGES['staticfiles']})
+class ConcurrentMediaIngestTest(TransactionTestCase):
+    threads = 8
+    batches = 3
+    files_per_batch = 3
+
+    def test_parallel_uploads_to_one_post(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        seller = User.objects.create_user('seller', 'seller@example.com', 'pass')
+        category = Category.objects.create(name='Золото', slug='gold')
+        post = Post.objects.create(author=seller, category=category, slug='gold', title='Золото',
+                                   content='...', price=10, type_post=Post.WTS)
+        errors = []
+        barrier = threading.Barrier(self.threads)
+
+        def worker():
+            try:
+                barrier.wait()
+                done = 0
+                while done < self.batches:
+                    try:
+                        PostMedia.objects.bulk_ingest(
+                            post, [gif() for _ in range(self.files_per_batch)], workers=2)
+                        done += 1
+                    except OperationalError as e:
+                        # Тестовая БД SQLite в памяти с общим кэшем не ждёт блокировку
+                        if 'locked' not in str(e):
+                            raise
+            except Exception as e:
+                errors.append(e)
+            finally:
+                close_old_connections()
+
+        # Превью здесь не нужны: их файлы появились бы в MEDIA_ROOT уже после теста
+        with override_settings(MEDIA_ROOT=media_root), \
+                mock.patch('marketplace.models.schedule_derivatives'):
+            workers = [threading.Thread(target=worker) for _ in range(self.threads)]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            stored = sorted(name for name, _ in media_gc.iter_files(media_root))
+
+        self.assertEqual(errors, [])
+        names = sorted(PostMedia.objects.values_list('file', flat=True))
+        self.assertEqual(len(names), self.threads * self.batches * self.files_per_batch)
+        # Без совпадений номеров хранилищу не пришлось переименовывать файлы,
+        # а файлы неудавшихся попыток удалены
+        pattern = re.compile(rf'post_media/{post.pk}/post-{post.pk}-\d{{3}}\.gif$')
+        self.assertTrue(all(pattern.match(name) for name in names), names)
+        self.assertEqual(stored, names)
+        post.refresh_from_db()
+        self.assertEqual(post.media_count, len(names))
+
+
+class MediaGarbageCollectionTest(SellerPostFixtureMixin, TempMediaRootMixin, TestCase):
+    post_slug = None
+
+    def create_post_with_media(self, files=3):
+        post = self.create_seller_post()
+        paths = []
+        for _ in range(files):
+            media = PostMedia.objects.create(
+                post=post, file=SimpleUploadedFile('a.gif', b'GIF89a' + os.urandom(64)))
+            paths.append(default_storage.path(media.file.name))
+        return post, paths
+
+    def test_bulk_and_cascade_deletes_leave_tombstones(self):
+        post, paths = self.create_post_with_media()
+        other, other_paths = self.create_post_with_media(2)
+        PostMedia.objects.filter(post=post).delete()
+        self.seller.posts.all().delete()
+        self.assertEqual(MediaTombstone.objects.count(), 5)
+        self.assertTrue(all(os.path.exists(path) for path in paths + other_paths))
+
+        self.assertEqual(media_gc.sweep(threads=4), (5, 0))
+        self.assertFalse(any(os.path.exists(path) for path in paths + other_paths))
+        self.assertFalse(MediaTombstone.objects.exists())
+
+    def test_orphan_scan_finds_unreferenced_files(self):
+        post, paths = self.create_post_with_media(1)
+        default_storage.inner.save('post_media/lost.gif', ContentFile(b'GIF89a'))
+        self.assertEqual([name for name, _ in media_gc.find_orphans(grace_seconds=0)],
+                         ['post_media/lost.gif'])
+
+        call_command('scan_orphan_media', grace=0, delete=True, stdout=StringIO())
+        media_gc.sweep()
+        self.assertFalse(default_storage.exists('post_media/lost.gif'))
+        self.assertTrue(os.path.exists(paths[0]))
+
+
+class DenormalizedCountersTest(SellerPostFixtureMixin, TempMediaRootMixin, TestCase):
+    post_slug = None
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.buyer = User.objects.create_user('buyer', 'buyer@example.com', 'pass')
+        cls.other = User.objects.create_user('other', 'other@example.com', 'pass')
+
+    def create_post(self, title='Золото'):
+        return self.create_seller_post(title=title)
+
+    def test_signals_keep_counters_in_sync(self):
+        post = self.create_post()
+        for _ in range(2):
+            PostMedia.objects.create(
+                post=post, file=SimpleUploadedFile('a.gif', b'GIF89a' + os.urandom(16)))
+        first = Response.objects.create(post=post, author=self.buyer, content='Беру')
+        Response.objects.create(post=post, author=self.other, content='И я')
+        first.is_accepted = True
+        first.save()
+        first.save()
+
+        post.refresh_from_db()
+        self.assertEqual((post.media_count, post.response_count, post.accepted_response_count),
+                         (2, 2, 1))
+        self.assertEqual(Profile.objects.get(user=self.seller).post_count, 1)
+
+        Response.objects.get(pk=first.pk).delete()
+        post.media.first().delete()
+        post.refresh_from_db()
+        self.assertEqual((post.media_count, post.response_count, post.accepted_response_count),
+                         (1, 1, 0))
+
+        post.delete()
+        self.assertEqual(Profile.objects.get(user=self.seller).post_count, 0)
+
+    def test_reconcile_repairs_drift(self):
+        post = self.create_post()
+        Response.objects.bulk_create([
+            Response(post=post, author=self.buyer, content='Беру', is_accepted=True),
+            Response(post=post, author=self.other, content='И я'),
+        ])
+        Profile.objects.filter(user=self.seller).update(post_count=7)
+        Profile.objects.filter(user=self.buyer).delete()
+
+        out = StringIO()
+        call_command('reconcile_counters', stdout=out)
+        self.assertIn('Исправлено объявлений: 1, профилей: 1', out.getvalue())
+        post.refresh_from_db()
+        self.assertEqual((post.response_count, post.accepted_response_count), (2, 1))
+        self.assertEqual(Profile.objects.get(user=self.seller).post_count, 1)
+        self.assertEqual(Profile.objects.get(user=self.buyer).post_count, 0)
+
+    def assertNoAggregates(self, queries):
+        aggregates = [q['sql'] for q in queries if 'COUNT(' in q['sql'].upper()]
+        self.assertEqual(aggregates, [])
+
+    def test_pages_do_not_run_count_queries(self):
+        posts = [self.create_post(f'Лот {i}') for i in range(3)]
+        for post in posts:
+            PostMedia.objects.create(
+                post=post, file=SimpleUploadedFile('a.gif', b'GIF89a' + os.urandom(16)))
+            Response.objects.create(post=post, author=self.buyer, content='Беру',
+                                    is_accepted=True)
+        self.client.force_login(self.seller)
+
+        for url in (reverse('my_posts'), reverse('response_list'),
+                    reverse('response_list') + f'?post={posts[0].slug}',
+                    reverse('post_detail', kwargs={'slug': posts[0].slug})):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertNoAggregates(ctx.captured_queries)
+
+        response = self.client.get(reverse('response_list'))
+        self.assertEqual((response.context['total_responses'], response.context['accepted_count'],
+                          response.context['pending_count']), (3, 3, 0))
+        response = self.client.get(reverse('my_posts'))
+        self.assertEqual(response.context['total_posts'], 3)
+
+
+@override_settings(ROOT_URLCONF='marketplace.tests')
+class AsyncViewsTest(SellerPostFixtureMixin, TestCase):
+    post_slug = None
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.buyer = User.objects.create_user('buyer', 'buyer@example.com', 'pass')
+        cls.posts = [cls.create_seller_post(title=f'Лот {i}', slug=f'lot-{i}', price=i)
+                     for i in range(15)]
+        Response.objects.create(post=cls.posts[0], author=cls.buyer, content='Беру',
+                                is_accepted=True)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_views_are_async(self):
+        for view in (AsyncPostView, AsyncPostDetailView, AsyncResponseListView):
+            self.assertTrue(view.view_is_async, view)
+
+    def assertSameContext(self, sync_url, async_url, *names):
+        sync_response = self.client.get(sync_url)
+        cache.clear()
+        async_response = self.client.get(async_url)
+        self.assertEqual(async_response.status_code, 200, async_url)
+        for name in names:
+            self.assertEqual(list(async_response.context[name]), list(sync_response.context[name]),
+                             name)
+        return async_response
+
+    def test_pages_match_sync_variants(self):
+        self.assertSameContext('/?page=2', '/async/?page=2', 'posts', 'categories')
+        self.assertSameContext('/post/lot-0/', '/async/post/lot-0/', 'responses')
+        self.client.force_login(self.seller)
+        response = self.assertSameContext('/my-responses/', '/async/my-responses/',
+                                          'responses', 'user_posts')
+        self.assertEqual(response.context['accepted_count'], 1)
+
+    def test_pagination_errors_and_login(self):
+        self.assertEqual(self.client.get('/async/?page=last').context['page_obj'].number, 2)
+        self.assertEqual(self.client.get('/async/?page=9').status_code, 404)
+        self.assertEqual(self.client.get('/async/post/missing/').status_code, 404)
+        response = self.client.get('/async/my-responses/')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(settings.LOGIN_URL, response['Location'])
+
+    @override_settings(MARKETPLACE_CURSOR_PAGINATION=True)
+    def test_cursor_pagination(self):
+        page = self.client.get('/async/').context['page_obj']
+        self.assertEqual(len(page), 12)
+        page = self.client.get('/async/', {'cursor': page.next_cursor}).context['page_obj']
+        self.assertEqual([post.slug for post in page], ['lot-2', 'lot-1', 'lot-0'])
+
+    async def test_async_client_uses_listing_cache(self):
+        response = await self.async_client.get('/async/')
+        self.assertContains(response, 'Лот 14')
+        response = await self.async_client.get('/async/', {'page': '1'})
+        self.assertContains(response, 'Лот 14')
+        stats = await sync_to_async(listing_cache_stats)()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+
+# Маршруты для AsyncViewsTest: async-варианты рядом с обычными
+urlpatterns = [
+    path('async/', AsyncPostView.as_view()),
+    path('async/post/<slug:slug>/', AsyncPostDetailView.as_view()),
+    path('async/my-responses/', AsyncResponseListView.as_view()),
+    path('', include('mmo_marketplace.urls')),
+]
+
+
+class BenchmarkSuiteTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_generated_data_is_consistent(self):
+        totals = benchmarks.generate_data(users=6, categories=2, posts=40, media_per_post=1,
+                                          responses_per_post=2, batch_size=15)
+        self.assertEqual(Post.objects.count(), 40)
+        self.assertEqual(PostMedia.objects.count(), totals['media'])
+        self.assertEqual(Response.objects.count(), totals['responses'])
+        # Счётчики и профили заполнены сразу - сверка ничего не исправляет
+        self.assertEqual(reconcile(), {'posts': 0, 'profiles': 0})
+
+    @override_settings(MARKETPLACE_LISTING_CACHE_TIMEOUT=0)
+    def test_endpoints_report_latency_and_queries(self):
+        benchmarks.generate_data(users=4, categories=2, posts=30, batch_size=10)
+        results = benchmarks.run_endpoints(iterations=2, warmup=0)
+        self.assertEqual(set(results), {name for name, *_ in benchmarks.default_endpoints()[1]})
+        for name, row in results.items():
+            self.assertLess(row['status'], 400, name)
+            self.assertGreater(row['queries'], 0, name)
+            self.assertGreater(row['rps'], 0, name)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'endpoints': {'post_list': {'p95_ms': 10.0, 'queries': 4},
+                                  'post_detail': {'p95_ms': 5.0, 'queries': 3}},
+                    'http': {'post_list': {'rps': 100.0}}}
+        current = {'endpoints': {'post_list': {'p95_ms': 11.0, 'queries': 5}},
+                   'http': {'post_list': {'rps': 70.0}}}
+        self.assertEqual(benchmarks.compare(current, baseline, threshold=0.2), [
+            'post_list: запросов 5, было 4',
+            'post_detail: нет в текущих результатах',
+            'post_list (HTTP): 70.0 rps, было 100.0',
+        ])
+
+
+@override_settings(ROOT_URLCONF='marketplace.tests')
+class InstrumentationTest(SellerPostFixtureMixin, TestCase):
+    post_slug = None
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.staff = User.objects.create_user('admin', 'admin@example.com', 'pass', is_staff=True)
+        for i in range(3):
+            cls.create_seller_post(title=f'Лот {i}', slug=f'lot-{i}', price=i)
+
+    def setUp(self):
+        cache.clear()
+        instrumentation.view_stats.reset()
+
+    def server_timing(self, response):
+        return dict(re.findall(r'(\w+);dur=([\d.]+)', response['Server-Timing'])), \
+            int(re.search(r'"(\d+) queries"', response['Server-Timing']).group(1))
+
+    def test_server_timing_counts_queries_and_template(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('post_list'))
+        timings, queries = self.server_timing(response)
+        self.assertEqual(queries, len(ctx.captured_queries))
+        self.assertGreater(float(timings['tpl']), 0)
+        self.assertGreaterEqual(float(timings['total']), float(timings['tpl']))
+
+    async def test_async_views_are_measured(self):
+        response = await self.async_client.get('/async/post/lot-0/')
+        _, queries = self.server_timing(response)
+        self.assertGreater(queries, 0)
+
+    def test_fingerprint_collapses_literals_and_in_lists(self):
+        self.assertEqual(
+            instrumentation.fingerprint("SELECT * FROM t WHERE a = 'x' AND id IN (%s, %s, %s)"),
+            instrumentation.fingerprint("SELECT * FROM t WHERE a = 'yy' AND id IN (%s)"),
+        )
+
+    @override_settings(MARKETPLACE_SLOW_REQUEST_MS=0, MARKETPLACE_NPLUSONE_THRESHOLD=2)
+    def test_slow_and_repeated_queries_are_logged(self):
+        def view(request):
+            for post in Post.objects.all():
+                Category.objects.get(pk=post.category_id)
+            return HttpResponse('ok')
+
+        middleware = instrumentation.InstrumentationMiddleware(view)
+        with self.assertLogs('marketplace', 'WARNING') as logs:
+            middleware(RequestFactory().get('/n-plus-one/'))
+        slow, repeated = logs.output
+        self.assertIn('Медленный запрос GET /n-plus-one/', slow)
+        self.assertIn('3x', slow)
+        self.assertIn('Возможная N+1', repeated)
+        self.assertIn('2 повторных запросов', repeated)
+
+    def test_stats_endpoint_is_staff_only(self):
+        self.client.get(reverse('post_list'))
+        self.client.get(reverse('post_list'))
+        url = reverse('instrumentation_stats')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(self.seller)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_login(self.staff)
+        stats = self.client.get(url).json()['views']['post_list']
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(sum(stats['buckets'].values()), 2)
+        self.client.post(url)
+        self.assertNotIn('post_list', self.client.get(url).json()['views'])
+
+
+class MetricsTest(SellerPostFixtureMixin, TestCase):
+    post_slug = None
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.buyer = User.objects.create_user('buyer', 'buyer@example.com', 'pass')
+
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir, ignore_errors=True)
+        # Отдельный каталог на тест - значения не копятся между тестами
+        settings_override = override_settings(MARKETPLACE_METRICS_DIR=self.metrics_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_exposition_format(self):
+        counter = metrics.Counter('test_events', 'Тестовые события', ['kind'])
+        histogram = metrics.Histogram('test_latency_seconds', 'Тестовая задержка',
+                                      buckets=(0.1, 1.0, float('inf')))
+        self.addCleanup(metrics._registry.pop, 'test_events')
+        self.addCleanup(metrics._registry.pop, 'test_latency_seconds')
+        counter.inc(kind='a"b')
+        counter.inc(2, kind='a"b')
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+        with self.assertRaises(ValueError):
+            counter.inc(other='x')
+
+        text = metrics.exposition()
+        self.assertIn('# TYPE test_events counter\n', text)
+        self.assertIn('test_events_total{kind="a\\"b"} 3.0\n', text)
+        self.assertIn('# TYPE test_latency_seconds histogram\n', text)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 1.0\n', text)
+        self.assertIn('test_latency_seconds_bucket{le="1.0"} 2.0\n', text)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 3.0\n', text)
+        self.assertIn('test_latency_seconds_sum 5.55\n', text)
+        self.assertIn('test_latency_seconds_count 3.0\n', text)
+
+    def test_values_from_all_processes_are_summed(self):
+        metrics.EMAILS_QUEUED.inc()
+        for _ in range(2):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    # Много ключей - файл дочернего процесса растёт
+                    for i in range(2000):
+                        metrics.MEDIA_FILES.inc(kind=f'k{i}')
+                    metrics.EMAILS_QUEUED.inc(5)
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+        self.assertEqual(len(os.listdir(self.metrics_dir)), 3)
+        self.assertEqual(metrics.get_sample_value('marketplace_emails_queued_total'), 11)
+        self.assertEqual(metrics.get_sample_value('marketplace_media_files_total', kind='k1999'), 2)
+
+    def test_views_update_metrics(self):
+        self.client.force_login(self.seller)
+        self.client.post(reverse('create_post'), {
+            'title': 'Продам золото', 'type_post': Post.WTS, 'content': '...',
+            'price': 100, 'category': self.category.pk,
+        })
+        post = Post.objects.get()
+        self.client.force_login(self.buyer)
+        self.client.post(reverse('add_response', args=[post.slug]), {'content': 'Беру'})
+        self.client.force_login(self.seller)
+        self.client.post(reverse('response_update', args=[Response.objects.get().pk]),
+                         {'action': 'accept'})
+
+        self.assertEqual(metrics.get_sample_value('marketplace_posts_created_total',
+                                                  type_post=Post.WTS), 1)
+        self.assertEqual(metrics.get_sample_value('marketplace_responses_created_total'), 1)
+        self.assertEqual(metrics.get_sample_value('marketplace_responses_moderated_total',
+                                                  action='accept'), 1)
+        self.assertEqual(metrics.get_sample_value('marketplace_emails_queued_total'), 2)
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertIn('marketplace_request_duration_seconds_count'
+                      '{method="POST",status="3xx",view="create_post"} 1.0',
+                      response.content.decode())
+
+    @override_settings(MARKETPLACE_METRICS_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+
+class FacetsTest(SellerPostFixtureMixin, TestCase):
+    post_slug = None
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.gold = cls.category
+        cls.other = User.objects.create_user('other', 'other@example.com', 'pass')
+        cls.items = Category.objects.create(name='Предметы', slug='items')
+        cls.empty = Category.objects.create(name='Аккаунты', slug='accounts')
+
+    def setUp(self):
+        cache.clear()
+
+    def create_post(self, author=None, category=None, **kwargs):
+        return self.create_seller_post(author=author or self.seller,
+                                       category=category or self.gold, title='Лот', **kwargs)
+
+    def facet_table(self):
+        return {(facet.category_id, facet.type_post, facet.price_bucket): facet.count
+                for facet in PostFacet.objects.exclude(count=0)}
+
+    def assertConsistent(self):
+        table = self.facet_table()
+        self.assertEqual(facets.rebuild(), 0)
+        self.assertEqual(self.facet_table(), table)
+
+    def test_signals_match_rebuild(self):
+        rng = random.Random(7)
+        posts = [self.create_post(author=rng.choice([self.seller, self.other]),
+                                  category=rng.choice([self.gold, self.items]),
+                                  price=rng.choice([0, 99, 100, 4999, 10 ** 6]),
+                                  type_post=rng.choice([Post.WTS, Post.WTB]),
+                                  is_active=rng.random() > 0.2)
+                 for _ in range(30)]
+        self.assertConsistent()
+
+        for post in posts[:20]:
+            post.price = rng.choice([5, 700, 60000])
+            post.is_active = rng.random() > 0.3
+            post.category = rng.choice([self.gold, self.items])
+            post.save()
+        # Объявление, загруженное с отложенными полями
+        deferred = Post.objects.only('title').get(pk=posts[20].pk)
+        deferred.title = 'Новое название'
+        deferred.save()
+        posts[21].delete()
+        self.assertConsistent()
+
+        # Каскадное удаление объявлений вместе с автором
+        self.other.delete()
+        self.assertConsistent()
+
+    def test_rebuild_fixes_bulk_changes(self):
+        self.create_post(price=50)
+        self.create_post(price=50)
+        Post.objects.update(price=200000)
+        self.assertEqual(self.facet_table(), {(self.gold.pk, Post.WTS, 0): 2})
+        out = StringIO()
+        call_command('rebuild_facets', stdout=out)
+        self.assertIn('Исправлено счётчиков: 2', out.getvalue())
+        self.assertEqual(self.facet_table(),
+                         {(self.gold.pk, Post.WTS, len(facets.PRICE_BOUNDS)): 2})
+
+    def test_listing_shows_counts_for_current_filter(self):
+        self.create_post(price=50)
+        self.create_post(price=700, type_post=Post.WTB)
+        self.create_post(category=self.items, price=700)
+        self.create_post(category=self.items, is_active=False)
+
+        context = self.client.get(reverse('post_list')).context
+        self.assertEqual([(category.slug, count) for category, count in context['category_options']],
+                         [('gold', 2), ('items', 1), ('accounts', 0)])
+        self.assertEqual(context['type_options'],
+                         [(Post.WTS, 'Продажа', 2), (Post.WTB, 'Покупка', 1)])
+
+        response = self.client.get(reverse('post_list'),
+                                   {'category': self.gold.pk, 'type_post': Post.WTS, 'page': 1})
+        context = response.context
+        self.assertEqual([count for _, count in context['category_options']], [1, 1, 0])
+        self.assertEqual([count for _, _, count in context['type_options']], [1, 1])
+        prices = {(r['low'], r['high']): r['count'] for r in context['price_ranges'] if r['count']}
+        self.assertEqual(prices, {(0, 99): 1})
+        self.assertContains(response, 'Аккаунты (0)')
+        self.assertContains(response, f'href="?category={self.gold.pk}&amp;type_post=wts'
+                                      '&amp;price_min=0&amp;price_max=99"')
+
+    def test_facets_cost_one_cached_query(self):
+        self.create_post()
+        self.client.get(reverse('post_list'))
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('post_list'), {'type_post': Post.WTB})
+        self.assertFalse(any('marketplace_postfacet' in q['sql'] for q in ctx.captured_queries))
+
+
+@override_settings(MARKETPLACE_READ_REPLICAS=['replica'])
+class ReadReplicaTest(TransactionTestCase):
+    """
+    Основная база - тестовая БД, реплика - отдельный файл SQLite, который
+    "догоняет" основную только при вызове replicate() (задержка репликации).
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.replica_dir = tempfile.mkdtemp()
+        primary = connections['default']
+        settings_dict = dict(primary.settings_dict,
+                             NAME=os.path.join(cls.replica_dir, 'replica.sqlite3'))
+        connections['replica'] = primary.__class__(settings_dict, alias='replica')
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        shutil.rmtree(cls.replica_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.seller = User.objects.create_user('seller', 'seller@example.com', 'pass')
+        self.category = Category.objects.create(name='Золото', slug='gold')
+        self.replicate()
+        self.client.force_login(self.seller)
+        self.anonymous = self.client_class()
+
+    def replicate(self):
+        for alias in ('default', 'replica'):
+            connections[alias].ensure_connection()
+        connections['default'].connection.backup(connections['replica'].connection)
+
+    def create_post(self, title):
+        response = self.client.post(reverse('create_post'), {
+            'title': title, 'type_post': Post.WTS, 'content': '...', 'price': 10,
+            'category': self.category.pk,
+        })
+        self.assertEqual(response.status_code, 302)
+        return Post.objects.get(title=title)
+
+    def test_safe_reads_go_to_replica(self):
+        Post.objects.create(author=self.seller, category=self.category, title='Лот',
+                            content='...', price=10, type_post=Post.WTS)
+        self.replicate()
+        with CaptureQueriesContext(connections['replica']) as replica_queries, \
+                CaptureQueriesContext(connection) as primary_queries:
+            self.assertEqual(self.client.get(reverse('my_posts')).status_code, 200)
+        self.assertTrue(any('marketplace_post' in q['sql'] for q in replica_queries))
+        # Сессия и пользователь читаются с основной базы
+        self.assertTrue(any('django_session' in q['sql'] for q in primary_queries))
+        self.assertFalse(any('marketplace_post"' in q['sql'] for q in primary_queries
+                             if q['sql'].startswith('SELECT')))
+
+        # Вне запроса (команды, фоновые задачи) - только основная база
+        self.assertEqual(Post.objects.all().db, 'default')
+
+    def test_read_your_writes(self):
+        post = self.create_post('Продам золото')
+        self.assertIn(routers.PIN_COOKIE, self.client.cookies)
+        detail = reverse('post_detail', args=[post.slug])
+
+        # Автор сразу видит своё объявление, остальные - после репликации
+        self.assertEqual(self.client.get(detail).status_code, 200)
+        self.assertEqual(self.anonymous.get(detail).status_code, 404)
+        self.replicate()
+        self.assertEqual(self.anonymous.get(detail).status_code, 200)
+
+        # Когда закрепление истекло, автор снова читает с реплики
+        post = self.create_post('Продам меч')
+        self.client.cookies[routers.PIN_COOKIE] = '0'
+        self.assertEqual(self.client.get(reverse('post_detail', args=[post.slug])).status_code,
+                         404)
+
+    def test_reads_without_writes_do_not_pin(self):
+        response = self.client.get(reverse('post_list'))
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+
+class SQLiteProfileTest(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        primary = connections['default']
+        settings_dict = dict(primary.settings_dict, NAME=os.path.join(directory, 'tuned.sqlite3'),
+                             **settings.MARKETPLACE_SQLITE_PROFILE)
+        connections['tuned'] = primary.__class__(settings_dict, alias='tuned')
+        self.addCleanup(connections.__delitem__, 'tuned')
+        self.addCleanup(connections['tuned'].close)
+
+    def test_profile_applied_on_connect(self):
+        tuned = connections['tuned']
+        with tuned.cursor() as cursor:
+            pragmas = {name: cursor.execute(f'PRAGMA {name}').fetchone()[0]
+                       for name in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size',
+                                    'cache_size', 'temp_store')}
+        self.assertEqual(pragmas, {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000,
+                                   'mmap_size': 268435456, 'cache_size': -65536, 'temp_store': 2})
+        with CaptureQueriesContext(tuned) as ctx, transaction.atomic(using='tuned'):
+            pass
+        self.assertEqual(ctx.captured_queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+    def test_concurrent_writes_do_not_lock(self):
+        output = os.path.join(tempfile.mkdtemp(), 'stress.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(output))
+        subprocess.run([sys.executable, 'manage.py', 'sqlite_stress', '--mode', 'tuned',
+                        '--writers', '4', '--readers', '4', '--duration', '1', '--posts', '50',
+                        '--json', output], cwd=settings.BASE_DIR, check=True, capture_output=True)
+        with open(output) as fh:
+            result = json.load(fh)['tuned']
+        self.assertEqual(result['errors'], [])
+        self.assertEqual(result['locked'], 0)
+        self.assertGreater(result['writes'], 0)
+        self.assertGreater(result['reads'], 0)
+
+
+class DigestNotificationsTest(SellerPostFixtureMixin, TestCase):
+    post_slug = None
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other_seller = User.objects.create_user('other', 'other@example.com', 'pass')
+        cls.buyers = [User.objects.create_user(f'buyer{i}', f'buyer{i}@example.com', 'pass')
+                      for i in range(3)]
+        cls.posts = [cls.create_seller_post(slug=f'gold-{i}', title=f'Золото {i}')
+                     for i in range(2)]
+        cls.other_post = cls.create_seller_post(author=cls.other_seller, slug='sword',
+                                                title='Меч')
+
+    def respond(self, buyer, post, content='Беру'):
+        self.client.force_login(buyer)
+        self.client.post(reverse('add_response', args=[post.slug]), {'content': content})
+
+    def test_opt_in_collects_responses_into_one_digest(self):
+        self.client.force_login(self.seller)
+        self.client.post(reverse('notification_settings'), {'digest_notifications': 'on'})
+        self.assertTrue(Profile.objects.get(user=self.seller).digest_notifications)
+
+        self.respond(self.buyers[0], self.posts[0], 'Беру всё')
+        self.respond(self.buyers[1], self.posts[0], 'Беру половину')
+        self.respond(self.buyers[0], self.posts[1], 'И это тоже')
+        self.respond(self.buyers[0], self.other_post)
+        # Автор без сводок по-прежнему получает письмо на каждый отзыв
+        self.assertEqual(list(OutgoingEmail.objects.values_list('recipients', flat=True)),
+                         [['other@example.com']])
+        self.assertEqual(PendingNotification.objects.count(), 3)
+
+        # Поиск авторов, отзывы, вставка, удаление, отметка, пустой повторный поиск
+        with self.assertNumQueries(8):
+            call_command('send_digests', stdout=StringIO())
+        digest = OutgoingEmail.objects.get(recipients=['seller@example.com'])
+        self.assertEqual(digest.subject, 'Новые отзывы к вашим объявлениям: 3')
+        for text in ('Беру всё', 'Беру половину', 'И это тоже', 'buyer1',
+                     f'{settings.MARKETPLACE_SITE_URL}/post/gold-1/'):
+            self.assertIn(text, digest.html_body)
+        self.assertEqual(PendingNotification.objects.count(), 0)
+
+        call_command('send_outbox', stdout=StringIO())
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['other@example.com', 'seller@example.com'])
+
+    def test_one_digest_per_interval(self):
+        Profile.objects.filter(user=self.seller).update(digest_notifications=True)
+        self.respond(self.buyers[0], self.posts[0])
+        call_command('send_digests', stdout=StringIO())
+        self.respond(self.buyers[1], self.posts[0])
+        self.respond(self.buyers[2], self.posts[0])
+        call_command('send_digests', stdout=StringIO())
+        self.assertEqual(OutgoingEmail.objects.count(), 1)
+        self.assertEqual(PendingNotification.objects.count(), 2)
+
+        Profile.objects.filter(user=self.seller).update(
+            digest_sent_at=timezone.now() - timedelta(seconds=settings.MARKETPLACE_DIGEST_INTERVAL_SECONDS))
+        call_command('send_digests', stdout=StringIO())
+        self.assertEqual(OutgoingEmail.objects.latest('id').subject,
+                         'Новые отзывы к вашим объявлениям: 2')
+        self.assertEqual(PendingNotification.objects.count(), 0)
+
+    def test_notification_benchmark(self):
+        for buyer in self.buyers:
+            Response.objects.create(post=self.posts[0], author=buyer, content='Беру')
+        Response.objects.create(post=self.other_post, author=self.buyers[0], content='Беру')
+        result = benchmarks.run_notification_benchmark(sample=2, threads=2)
+        self.assertEqual(result['per_response']['emails'], 2)
+        self.assertEqual(result['digest']['notifications'], 4)
+        self.assertEqual(result['digest']['emails'], 2)
+        self.assertEqual(PendingNotification.objects.count(), 0)
+
+
+@override_settings(ROOT_URLCONF='marketplace.tests')
+class PostDetailConditionalGetTest(SellerPostFixtureMixin, TempMediaRootMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.buyer = User.objects.create_user('buyer', 'buyer@example.com', 'pass')
+        cls.response = Response.objects.create(post=cls.post, author=cls.buyer,
+                                               content='Беру всё')
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('post_detail', args=[self.post.slug])
+
+    def revalidate(self, response, url=None):
+        return self.client.get(url or self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def moderate(self, action):
+        self.client.force_login(self.seller)
+        self.client.post(reverse('response_update', args=[self.response.pk]), {'action': action})
+        self.client.logout()
+
+    def test_anonymous_revalidation_without_rendering(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('public', first['Cache-Control'])
+        self.assertIn('must-revalidate', first['Cache-Control'])
+        self.assertIn('Cookie', first['Vary'])
+        self.assertTrue(first.has_header('Last-Modified'))
+
+        with self.assertNumQueries(1):
+            second = self.revalidate(first)
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(second.content, b'')
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+                         .status_code, 304)
+        self.assertEqual(self.client.get('/post/missing/', HTTP_IF_NONE_MATCH='*').status_code,
+                         404)
+
+    def test_accepting_response_invalidates_page(self):
+        first = self.client.get(self.url)
+        self.assertNotContains(first, 'Беру всё')
+        # Новый, ещё не принятый отзыв страницу не меняет
+        Response.objects.create(post=self.post, author=self.seller, content='Беру половину')
+        self.assertEqual(self.revalidate(first).status_code, 304)
+
+        self.moderate('accept')
+        accepted = self.revalidate(first)
+        self.assertEqual(accepted.status_code, 200)
+        self.assertContains(accepted, 'Беру всё')
+        self.assertNotEqual(accepted['ETag'], first['ETag'])
+        self.assertEqual(self.revalidate(accepted).status_code, 304)
+
+        self.moderate('reject')
+        rejected = self.revalidate(accepted)
+        self.assertEqual(rejected.status_code, 200)
+        self.assertNotContains(rejected, 'Беру всё')
+
+    def test_post_media_and_category_changes_invalidate_page(self):
+        etag = self.client.get(self.url)['ETag']
+        changes = [
+            lambda: Post.objects.get(pk=self.post.pk).save(),
+            lambda: PostMedia.objects.create(
+                post=self.post, file=SimpleUploadedFile('a.gif', b'GIF89a', 'image/gif')),
+            lambda: PostMedia.objects.filter(post=self.post).get().delete(),
+            lambda: Category.objects.filter(pk=self.category.pk).get().save(),
+        ]
+        for change in changes:
+            with self.captureOnCommitCallbacks(execute=False):
+                change()
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+
+    def test_authenticated_pages_are_private_and_per_user(self):
+        anonymous = self.client.get(self.url)
+        self.client.force_login(self.buyer)
+        buyer = self.revalidate(anonymous)
+        self.assertEqual(buyer.status_code, 200)
+        self.assertContains(buyer, 'Оставить отзыв')
+        self.assertIn('private', buyer['Cache-Control'])
+        self.assertFalse(buyer.has_header('Last-Modified'))
+        self.assertEqual(self.revalidate(buyer).status_code, 304)
+
+        self.client.force_login(self.seller)
+        self.assertEqual(self.revalidate(buyer).status_code, 200)
+
+    def test_async_view(self):
+        url = f'/async/post/{self.post.slug}/'
+        first = self.client.get(url)
+        self.assertEqual(first['ETag'], self.client.get(self.url)['ETag'])
+        self.assertEqual(self.revalidate(first, url).status_code, 304)
+        self.moderate('accept')
+        self.assertContains(self.revalidate(first, url), 'Беру всё')
+
+
+class MediaServingTest(TempMediaRootMixin, TestCase):
+    content = bytes(range(256)) * 40
+
+    def setUp(self):
+        super().setUp()
+        for name in ('blobs/ab/cd/video.mp4', 'uploads/1/000000'):
+            os.makedirs(os.path.join(self.media_root, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(self.media_root, name), 'wb') as fh:
+                fh.write(self.content)
+        self.url = settings.MEDIA_URL + 'blobs/ab/cd/video.mp4'
+
+    def get(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_full_file(self):
+        response, body = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+        self.assertEqual(response['Content-Type'], 'video/mp4')
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('max-age', response['Cache-Control'])
+
+        response = self.client.get(self.url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+        head = self.client.head(self.url)
+        self.assertEqual((head.status_code, head['Content-Length'], head.content),
+                         (200, str(len(self.content)), b''))
+
+    def test_ranges(self):
+        size = len(self.content)
+        cases = [('bytes=10-19', 10, 19), ('bytes=10000-', 10000, size - 1),
+                 ('bytes=-5', size - 5, size - 1), ('bytes=100-999999', 100, size - 1)]
+        for header, start, end in cases:
+            response, body = self.get(Range=header)
+            self.assertEqual(response.status_code, 206, header)
+            self.assertEqual(body, self.content[start:end + 1], header)
+            self.assertEqual(response['Content-Range'], f'bytes {start}-{end}/{size}')
+            self.assertEqual(response['Content-Length'], str(end - start + 1))
+
+        # Несколько диапазонов и некорректный заголовок - файл целиком
+        for header in ('bytes=0-1,5-6', 'bytes=9-3', 'items=0-1'):
+            response, body = self.get(Range=header)
+            self.assertEqual((response.status_code, len(body)), (200, size), header)
+        for header in (f'bytes={size}-', 'bytes=-0'):
+            response, _ = self.get(Range=header)
+            self.assertEqual(response.status_code, 416, header)
+            self.assertEqual(response['Content-Range'], f'bytes */{size}')
+
+    def test_if_range(self):
+        response, _ = self.get()
+        for validator in (response['ETag'], response['Last-Modified']):
+            response, body = self.get(Range='bytes=0-9', **{'If-Range': validator})
+            self.assertEqual((response.status_code, body), (206, self.content[:10]))
+        response, body = self.get(Range='bytes=0-9', **{'If-Range': '"stale"'})
+        self.assertEqual((response.status_code, len(body)), (200, len(self.content)))
+
+    def test_file_range_limits_reads(self):
+        with open(os.path.join(self.media_root, 'blobs/ab/cd/video.mp4'), 'rb') as fh:
+            part = media_serving.FileRange(fh, 100, 300)
+            self.assertEqual(fh.tell(), 100)
+            self.assertEqual(part.read(256) + part.read(256) + part.read(), self.content[100:400])
+
+    def test_private_and_missing_names(self):
+        for name in ('uploads/1/000000', '../manage.py', 'blobs/ab/cd', 'blobs/missing.mp4',
+                     'blobs/ab/cd/video.mp4/..', 'blobs\\ab\\cd\\video.mp4'):
+            response = self.client.get(settings.MEDIA_URL + name)
+            self.assertEqual(response.status_code, 404, name)
+
+    def test_offload(self):
+        with override_settings(MARKETPLACE_MEDIA_OFFLOAD='x-accel-redirect'):
+            response = self.client.get(self.url, headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/blobs/ab/cd/video.mp4')
+        self.assertEqual((response['Content-Type'], response.content), ('video/mp4', b''))
+
+        with override_settings(MARKETPLACE_MEDIA_OFFLOAD='x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'],
+                         os.path.join(self.media_root, 'blobs/ab/cd/video.mp4'))
+        with override_settings(MARKETPLACE_MEDIA_OFFLOAD='x-sendfile'):
+            self.assertEqual(self.client.get(settings.MEDIA_URL + 'uploads/1/000000').status_code,
+                             404)
+
+    def test_benchmark(self):
+        results = benchmarks.run_media_benchmark(size_mb=1, clients=2, duration=0.2, range_kb=64)
+        self.assertEqual(set(results), {f'{mode}_{workload}' for mode in benchmarks.MEDIA_MODES
+                                        for workload in ('full', 'range')})
+        for name, row in results.items():
+            self.assertGreater(row['requests'], 0, name)
+            self.assertEqual(row['errors'], 0, name)
+
+
+class StaticFilesTest(TestCase):
+    def setUp(self):
+        self.static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static_root)
+        settings_override = override_settings(STATIC_ROOT=self.static_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write(self, name, content):
+        os.makedirs(os.path.join(self.static_root, os.path.dirname(name)), exist_ok=True)
+        with open(os.path.join(self.static_root, name), 'wb') as fh:
+            fh.write(content)
+
+    def test_serves_precompressed_copies(self):
+        css = b'.mmo-card { color: white; }\n' * 50
+        self.write('app.0123456789ab.css', css)
+        self.write('app.0123456789ab.css.gz', gzip.compress(css))
+        url = settings.STATIC_URL + 'app.0123456789ab.css'
+
+        response = self.client.get(url, headers={'Accept-Encoding': 'br, gzip'})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), css)
+        self.assertEqual(response['Content-Type'], 'text/css; charset=utf-8')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertIn('Accept-Encoding', response['Vary'])
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip',
+                                                 'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        for accept in ('', 'gzip;q=0, identity'):
+            response = self.client.get(url, headers={'Accept-Encoding': accept})
+            self.assertFalse(response.has_header('Content-Encoding'), accept)
+            self.assertEqual(b''.join(response.streaming_content), css)
+
+    def test_unhashed_names_revalidate_and_bad_names_404(self):
+        self.write('app.css', b'body {}')
+        url = settings.STATIC_URL
+        response = self.client.get(url + 'app.css')
+        self.assertIn('no-cache', response['Cache-Control'])
+        for name in ('../manage.py', 'missing.css', 'app.css/..'):
+            self.assertEqual(self.client.get(url + name).status_code, 404, name)
+
+    def test_collectstatic_writes_hashed_and_compressed_files(self):
+        production = {**settings.STORAGES,
+                      'staticfiles': settings.MARKETPLACE_PRODUCTION_STATICFILES}
+        with override_settings(STORAGES=production):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            hashed = staticfiles_storage.stored_name('marketplace/css/posts_list.css')
+            self.assertRegex(hashed, media_serving.HASHED_STATIC_RE)
+            with open(os.path.join(self.static_root, hashed), 'rb') as fh, \
+                    gzip.open(os.path.join(self.static_root, hashed + '.gz')) as compressed:
+                self.assertEqual(compressed.read(), fh.read())
+            rendered = Template("{% load static %}{% static 'marketplace/css/posts_list.css' %}") \
+                .render(Context())
+        self.assertEqual(rendered, settings.STATIC_URL + hashed)
+        # Маленькие файлы сжимать невыгодно
+        small = [name for name in os.listdir(os.path.join(self.static_root, 'marketplace/css'))
+                 if name.startswith('add_response')]
+        self.assertFalse([name for name in small if name.endswith('.gz')], small)
+
+    def test_production_profile(self):
+        benchmarks.generate_data(users=3, categories=2, posts=5, media_per_post=1,
+                                 responses_per_post=1)
+        profile = benchmarks.startup_profile_settings('production', self.static_root)
+        self.assertEqual(profile['TEMPLATES'][0]['OPTIONS']['loaders'][0][0],
+                         'django.template.loaders.cached.Loader')
+        with override_settings(MARKETPLACE_LISTING_CACHE_TIMEOUT=0, **profile):
+            static = benchmarks.collect_static()
+            pages = benchmarks.run_startup_profile(iterations=1)
+            html = self.client.get(reverse('post_list')).content.decode()
+            css_url = settings.STATIC_URL + staticfiles_storage.stored_name(
+                'marketplace/css/posts_list.css')
+        self.assertGreater(static['css_bytes'], static['css_gzip_bytes'])
+        self.assertEqual(set(pages), set(benchmarks.STARTUP_PAGES))
+        self.assertIn(css_url, html)
+        self.assertNotIn('<style>', html)
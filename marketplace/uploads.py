@@ -0,0 +1,129 @@
+'''
+Поблочная (chunked) загрузка медиафайлов.
+
+Клиент создаёт сессию загрузки, отправляет файл частями не больше
+UPLOAD_CHUNK_SIZE и завершает загрузку. Части сразу пишутся в
+default_storage, поэтому в памяти процесса никогда не больше одной части.
+При завершении части склеиваются потоково, попутно считается SHA-256,
+и только тогда создаётся PostMedia.
+'''
+import hashlib
+import os
+import uuid
+
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import default_storage
+
+IMAGE = 'image'
+VIDEO = 'video'
+
+# Сигнатуры (magic bytes) разрешённых форматов: (смещение, байты, тип)
+SIGNATURES = [
+    (0, b'\xff\xd8\xff', IMAGE),                  # JPEG
+    (0, b'\x89PNG\r\n\x1a\n', IMAGE),             # PNG
+    (0, b'GIF87a', IMAGE),
+    (0, b'GIF89a', IMAGE),
+    (0, b'BM', IMAGE),                            # BMP
+    (8, b'WEBP', IMAGE),                          # RIFF....WEBP
+    (8, b'AVI ', VIDEO),                          # RIFF....AVI
+    (4, b'ftyp', VIDEO),                          # MP4 / MOV
+    (0, b'\x1a\x45\xdf\xa3', VIDEO),              # Matroska / WebM
+]
+SIGNATURE_BYTES = 16
+
+
+def upload_chunk_size():
+    return getattr(settings, 'MARKETPLACE_UPLOAD_CHUNK_SIZE', 1024 * 1024)
+
+
+def sniff_media_type(header):
+    '''Определяет тип файла по первым байтам, а не по расширению'''
+    for offset, signature, media_type in SIGNATURES:
+        if header[offset:offset + len(signature)] == signature:
+            if offset == 8 and not header.startswith(b'RIFF'):
+                continue
+            return media_type
+    return None
+
+
+def extension_media_type(filename):
+    from .models import PostMedia
+
+    extension = os.path.splitext(filename.lower())[1]
+    if extension in PostMedia.ALLOWED_IMAGE_EXTENSIONS:
+        return IMAGE
+    if extension in PostMedia.ALLOWED_VIDEO_EXTENSIONS:
+        return VIDEO
+    return None
+
+
+def part_name(session, index):
+    return f'uploads/{session.pk}/{index:06d}'
+
+
+class ChunkedFile(File):
+    '''
+    Файл, собранный из частей в хранилище. Читается потоково,
+    SHA-256 считается по мере чтения.
+    '''
+    def __init__(self, parts, size, name):
+        super().__init__(None, name)
+        self.parts = parts
+        self.size = size
+        self.hash = hashlib.sha256()
+        self.sha256 = None
+
+    def digest(self):
+        '''
+        Читает части один раз и возвращает SHA-256. Хранилище с дедупликацией
+        берёт готовый self.sha256 и при записи файл больше не хэширует.
+        '''
+        for _ in self.chunks():
+            pass
+        self.sha256 = self.hash.hexdigest()
+        return self.sha256
+
+    def chunks(self, chunk_size=None):
+        # Хранилище может прочитать файл дважды (хэш + запись) - считаем заново
+        self.hash = hashlib.sha256()
+        for part in self.parts:
+            with default_storage.open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size or self.DEFAULT_CHUNK_SIZE), b''):
+                    self.hash.update(chunk)
+                    yield chunk
+
+    def open(self, mode=None):
+        return self
+
+    def close(self):
+        pass
+
+
+def save_part(session, index, chunk):
+    '''
+    Пишет часть под уникальным временным именем. На место part_name()
+    её ставит commit_part() - только после того, как UPDATE сессии выбрал
+    этот запрос: параллельный запрос с тем же offset не перезапишет часть.
+    '''
+    return default_storage.save(f'{part_name(session, index)}.{uuid.uuid4().hex}.tmp',
+                                ContentFile(chunk))
+
+
+def commit_part(temp, session, index):
+    name = part_name(session, index)
+    try:
+        source, target = default_storage.path(temp), default_storage.path(name)
+    except NotImplementedError:
+        # Хранилище без локальных путей: копия (итоговое имя пишет только этот запрос)
+        default_storage.delete(name)
+        with default_storage.open(temp, 'rb') as f:
+            default_storage.save(name, f)
+        default_storage.delete(temp)
+    else:
+        os.replace(source, target)
+
+
+def discard_parts(session):
+    for index in range(session.parts):
+        default_storage.delete(part_name(session, index))
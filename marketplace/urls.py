@@ -1,18 +1,35 @@
+from django.conf import settings
 from django.urls import path
+from .async_views import AsyncPostView, AsyncPostDetailView, AsyncResponseListView
 from .views import (PostView, PostDetailView, CreateResponse, CreatePostView,
                     MyPostList, PostEdit, DeleteMediaView, ResponseListView,
-                    ResponseUpdateView, ResponseDeleteView)
+                    ResponseUpdateView, ResponseDeleteView, UploadInitView,
+                    UploadChunkView, UploadCompleteView, InstrumentationStatsView,
+                    MetricsView, NotificationSettingsView)
 
 
+# Под ASGI страницы чтения работают через async ORM
+ASYNC_VIEWS = getattr(settings, 'MARKETPLACE_ASYNC_VIEWS', False)
+post_list_view = AsyncPostView if ASYNC_VIEWS else PostView
+post_detail_view = AsyncPostDetailView if ASYNC_VIEWS else PostDetailView
+response_list_view = AsyncResponseListView if ASYNC_VIEWS else ResponseListView
+
 urlpatterns = [
-    path('', PostView.as_view(), name='post_list'),
+    path('', post_list_view.as_view(), name='post_list'),
     path('my-posts', MyPostList.as_view(), name='my_posts'),
+    path('my-posts/notifications/', NotificationSettingsView.as_view(),
+         name='notification_settings'),
     path('post/create/', CreatePostView.as_view(), name='create_post'),
-    path('post/<slug:slug>/', PostDetailView.as_view(), name='post_detail'),
+    path('post/<slug:slug>/', post_detail_view.as_view(), name='post_detail'),
     path('post/<slug:slug>/response/', CreateResponse.as_view(), name='add_response'),
     path('post/<slug:slug>/edit', PostEdit.as_view(), name='edit_post'),
     path('media/<int:int>/delete/', DeleteMediaView.as_view(), name='delete_media'),
-    path('my-responses/', ResponseListView.as_view(), name='response_list'),
+    path('post/<slug:slug>/uploads/', UploadInitView.as_view(), name='upload_init'),
+    path('uploads/<uuid:pk>/', UploadChunkView.as_view(), name='upload_chunk'),
+    path('uploads/<uuid:pk>/complete/', UploadCompleteView.as_view(), name='upload_complete'),
+    path('my-responses/', response_list_view.as_view(), name='response_list'),
     path('response/<int:pk>/update/', ResponseUpdateView.as_view(), name='response_update'),
     path('response/<int:pk>/delete/', ResponseDeleteView.as_view(), name='response_delete'),
+    path('staff/instrumentation/', InstrumentationStatsView.as_view(), name='instrumentation_stats'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
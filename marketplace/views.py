@@ -1,16 +1,34 @@
+import os
+
+from django.conf import settings
+from django.views import View
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
 from django.urls import reverse_lazy, reverse
-from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.shortcuts import get_object_or_404, redirect
 from django.http import HttpRequest, HttpResponse, JsonResponse
-from django.core.mail import EmailMultiAlternatives
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
 from django.template.loader import render_to_string
 from django.contrib import messages
+from django.utils.crypto import constant_time_compare
 
-from .models import Post, Category, Response, PostMedia
+from .models import Post, Response, PostMedia, Profile, UploadSession, PendingNotification
 from .forms import PostForm, PostEditForm
+from .caching import (AnonymousListingCacheMixin, ConditionalPostDetailMixin, cached_categories,
+                      render_post_cards)
+from . import digests, facets
+from .instrumentation import BUCKETS, view_stats
+from .media_serving import serve_media, serve_static
+from . import metrics
+from .outbox import enqueue_email
+from .pagination import CursorPaginationMixin
+from .search import get_search_backend
+from . import uploads
 
-class PostView(ListView):
+class PostView(AnonymousListingCacheMixin, CursorPaginationMixin, ListView):
     model = Post
     ordering = '-updated_at'
     template_name = 'marketplace/posts_list.html'
@@ -18,7 +36,7 @@ class PostView(ListView):
     paginate_by = 12
 
     def get_queryset(self):
-        queryset = super().get_queryset().filter(is_active=True)
+        queryset = super().get_queryset().filter(is_active=True).for_cards()
         
         category_id = self.request.GET.get('category')
         if category_id:
@@ -34,16 +52,65 @@ class PostView(ListView):
             queryset = queryset.filter(price__gte=price_min)
         if price_max:
             queryset = queryset.filter(price__lte=price_max)
+
+        query = self.request.GET.get('q', '').strip()
+        if query:
+            queryset = get_search_backend().apply(queryset, query)
         
         return queryset
 
+    def use_cursor_pagination(self):
+        # Результаты поиска упорядочены по релевантности, а курсор - по (updated_at, id)
+        if self.request.GET.get('q', '').strip():
+            return False
+        return super().use_cursor_pagination()
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['categories'] = Category.objects.all()
+        context['categories'] = self.get_categories()
+        context.update(self.get_facet_context(context['categories']))
+        context['post_cards'] = self.get_post_cards(context['posts'])
         return context
 
+    def get_categories(self):
+        return cached_categories()
+
+    def get_post_cards(self, posts):
+        return render_post_cards(posts)
+
+    def get_facet_rows(self):
+        return facets.cached_facet_rows()
 
-class MyPostList(LoginRequiredMixin, ListView):
+    def get_facet_context(self, categories):
+        '''Числа объявлений у вариантов фильтра и гистограмма цен'''
+        params = self.request.GET
+        category_id = params.get('category', '')
+        type_post = params.get('type_post')
+        counts = facets.facet_counts(
+            self.get_facet_rows(),
+            category_id=int(category_id) if category_id.isdigit() else None,
+            type_post=type_post if type_post in (Post.WTS, Post.WTB) else None,
+        )
+        price_ranges = []
+        for bucket, count in enumerate(counts['prices']):
+            low, high = facets.bucket_range(bucket)
+            query = params.copy()
+            for name in ('page', 'cursor'):
+                query.pop(name, None)
+            query['price_min'] = low
+            query['price_max'] = '' if high is None else high
+            price_ranges.append({'low': low, 'high': high, 'count': count,
+                                 'query': query.urlencode()})
+        return {
+            'category_options': [(category, counts['categories'].get(category.pk, 0))
+                                 for category in categories],
+            'type_options': [(value, label, counts['types'].get(value, 0))
+                             for value, label in Post.POST],
+            'price_ranges': price_ranges,
+        }
+
+
+class MyPostList(LoginRequiredMixin, CursorPaginationMixin, ListView):
     model = Post
     template_name = 'marketplace/my_post.html'
     context_object_name = 'my_posts'
@@ -52,12 +119,62 @@ class MyPostList(LoginRequiredMixin, ListView):
     def get_queryset(self):
         return Post.objects.filter(author=self.request.user).order_by('-updated_at')
     
+    def get_paginator(self, *args, **kwargs):
+        paginator = super().get_paginator(*args, **kwargs)
+        # Число объявлений берём из счётчика профиля вместо COUNT(*)
+        paginator.count = self.total_posts()
+        return paginator
+
+    def get_profile(self):
+        if not hasattr(self, '_profile'):
+            # Обычное чтение (можно с реплики), запись - только если профиля ещё нет
+            profile = Profile.objects.filter(user=self.request.user).only(
+                'post_count', 'digest_notifications').first()
+            if profile is None:
+                profile = Profile.objects.get_or_create(user=self.request.user)[0]
+            self._profile = profile
+        return self._profile
+
+    def total_posts(self):
+        return self.get_profile().post_count
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['total_posts'] = self.get_queryset().count()
+        context['total_posts'] = self.total_posts()
+        context['digest_notifications'] = self.get_profile().digest_notifications
         return context
 
 
+class NotificationSettingsView(LoginRequiredMixin, View):
+    """Письмо на каждый отзыв или сводка раз в интервал"""
+    def post(self, request):
+        enabled = request.POST.get('digest_notifications') == 'on'
+        Profile.objects.update_or_create(user=request.user,
+                                         defaults={'digest_notifications': enabled})
+        if enabled:
+            messages.success(request, 'Новые отзывы будут приходить сводкой')
+        else:
+            messages.info(request, 'Письмо будет приходить на каждый отзыв')
+        return redirect('my_posts')
+
+
+def ingest_media_files(request, post):
+    """Медиафайлы из формы одной пачкой (bulk_ingest), неподходящие файлы пропускаются"""
+    files = []
+    for file in request.FILES.getlist('media_files'):
+        metrics.UPLOAD_BYTES.inc(file.size, source='form')
+        try:
+            PostMedia(post=post, file=file).clean()
+        except ValidationError as e:
+            messages.error(request, f'{file.name}: {" ".join(e.messages)}')
+            continue
+        files.append(file)
+    try:
+        PostMedia.objects.bulk_ingest(post, files)
+    except Exception as e:
+        print(f'Ошибка загрузки медиафайлов: {e}. Объявление сохранено.')
+
+
 class PostEdit(LoginRequiredMixin, UpdateView):
     model = Post
     form_class = PostEditForm
@@ -69,13 +186,7 @@ class PostEdit(LoginRequiredMixin, UpdateView):
 
     def form_valid(self, form):
         response = super().form_valid(form)
-        files = self.request.FILES.getlist('media_files')
-        for file in files:
-            try:
-                PostMedia.objects.create(post=self.object, file=file)
-            except Exception as e:
-                print(f'Ошибка загрузки файла: {e}. Изменения поста сохранены')
-
+        ingest_media_files(self.request, self.object)
         return response
     
     def get_context_data(self, **kwargs):
@@ -84,17 +195,23 @@ class PostEdit(LoginRequiredMixin, UpdateView):
         return context
         
 
-class PostDetailView(DetailView):
+class PostDetailView(ConditionalPostDetailMixin, DetailView):
     model = Post
     template_name = 'marketplace/post_detail.html'
     context_object_name = 'post'
     slug_field = 'slug'
     slug_url_kwarg = 'slug'
 
+    def get_queryset(self):
+        return super().get_queryset().select_related('author', 'category').prefetch_related('media')
+
+    def get_responses(self):
+        # Получаем принятые отзывы
+        return self.object.post_response.filter(is_accepted=True).select_related('author')
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        # Получаем принятые отзывы
-        context['responses'] = self.object.post_response.filter(is_accepted=True)
+        context['responses'] = self.get_responses()
         return context
  
 
@@ -106,28 +223,30 @@ class CreateResponse(LoginRequiredMixin, CreateView):
     def form_valid(self, form):
         form.instance.author = self.request.user
         form.instance.post = get_object_or_404(Post, slug=self.kwargs['slug'])
-        response = super().form_valid(form)
-        self.send_notification_email(form.instance)    
+        # Отклик и письмо о нём сохраняются вместе, отправит их send_outbox
+        with transaction.atomic():
+            response = super().form_valid(form)
+            if digests.wants_digest(form.instance.post.author_id):
+                # Автор получает сводку раз в интервал (send_digests)
+                PendingNotification.objects.create(recipient_id=form.instance.post.author_id,
+                                                   response=form.instance)
+            else:
+                self.send_notification_email(form.instance)
+        metrics.RESPONSES_CREATED.inc()
         return response
     
     def send_notification_email(self, response):
-        try:
-            html_content = render_to_string(
-                'marketplace/response_notif.html',
-                {'response': response,
-                 'post': response.post,
-                 'author': response.author,}
-            )
-            msg = EmailMultiAlternatives(
-                subject=f'Новый отзыв к Вашему объявлению "{response.post.title}"',
-                body=f'Пользователь {response.author.username} оставил отзыв к Вашему объявлению "{response.post.title}": {response.content}',
-                from_email='mmo_marketplace@temp-mail.com',
-                to=[response.post.author.email],
-            )
-            msg.attach_alternative(html_content, 'text/html')
-            msg.send()
-        except Exception as e:
-            print(f'Ошибка отправки письма {e}')
+        html_content = render_to_string(
+            'marketplace/response_notif.html',
+            {'responses': [response],
+             'site_url': self.request.build_absolute_uri('/').rstrip('/')}
+        )
+        enqueue_email(
+            subject=f'Новый отзыв к Вашему объявлению "{response.post.title}"',
+            body=f'Пользователь {response.author.username} оставил отзыв к Вашему объявлению "{response.post.title}": {response.content}',
+            recipients=[response.post.author.email],
+            html_body=html_content,
+        )
     
     def get_success_url(self):
         return reverse_lazy('post_detail', kwargs={'slug': self.kwargs['slug']})
@@ -149,12 +268,8 @@ class CreatePostView(LoginRequiredMixin, CreateView):
     def form_valid(self, form):
         form.instance.author = self.request.user
         response = super().form_valid(form)
-        files = self.request.FILES.getlist('media_files')
-        for file in files:
-            try:
-                PostMedia.objects.create(post=self.object, file=file)
-            except Exception as e:
-                print(f'Ошибка загрузки медиафайлов: {e}. Объявление сохранено.')
+        metrics.POSTS_CREATED.inc(type_post=self.object.type_post)
+        ingest_media_files(self.request, self.object)
         return response
     
     
@@ -189,16 +304,44 @@ class ResponseListView(LoginRequiredMixin, ListView):
     paginate_by = 15
 
     def get_queryset(self):
-        queryset = Response.objects.filter(post__author=self.request.user)
+        queryset = Response.objects.filter(post__author=self.request.user).select_related('post', 'author')
         post_slug = self.request.GET.get('post')
         if post_slug:
             queryset = queryset.filter(post__slug=post_slug)
         return queryset.order_by('-created_at')
     
+    def get_user_posts(self):
+        if not hasattr(self, '_user_posts'):
+            self._user_posts = list(self.user_posts_queryset())
+        return self._user_posts
+
+    def user_posts_queryset(self):
+        return (Post.objects.filter(author=self.request.user)
+                .only('slug', 'title', 'response_count', 'accepted_response_count')
+                .order_by('-updated_at'))
+
+    def get_counted_posts(self):
+        post_slug = self.request.GET.get('post')
+        posts = self.get_user_posts()
+        if post_slug:
+            posts = [post for post in posts if post.slug == post_slug]
+        return posts
+
+    def get_paginator(self, *args, **kwargs):
+        paginator = super().get_paginator(*args, **kwargs)
+        # Число отзывов складываем из счётчиков объявлений вместо COUNT(*)
+        paginator.count = sum(post.response_count for post in self.get_counted_posts())
+        return paginator
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['user_posts'] = Post.objects.filter(author=self.request.user)
-        context['total_responses'] = self.get_queryset().count()
+        posts = self.get_counted_posts()
+        total = sum(post.response_count for post in posts)
+        accepted = sum(post.accepted_response_count for post in posts)
+        context['user_posts'] = self.get_user_posts()
+        context['total_responses'] = total
+        context['accepted_count'] = accepted
+        context['pending_count'] = total - accepted
         return context
     
 
@@ -218,49 +361,46 @@ class ResponseUpdateView(LoginRequiredMixin, UpdateView):
             return self.get_success_url()
         
         if action == 'accept':
-            self.object.is_accepted = True
-            self.object.save()
+            with transaction.atomic():
+                self.object.is_accepted = True
+                self.object.save()
+                # Отправляем уведомление автору отзыва
+                self.send_acceptance_notification(self.object)
+            metrics.RESPONSES_MODERATED.inc(action=action)
             messages.success(request, 'Отзыв принят и теперь виден на странице объявления')
             
-            # Отправляем уведомление автору отзыва
-            self.send_acceptance_notification(self.object)
-            
         elif action == 'reject':
             self.object.is_accepted = False
             self.object.save()
+            metrics.RESPONSES_MODERATED.inc(action=action)
             messages.info(request, 'Отзыв отклонен')
         
         elif action == 'delete':
             post_slug = self.object.post.slug
             self.object.delete()
+            metrics.RESPONSES_MODERATED.inc(action=action)
             messages.warning(request, 'Отзыв удален')
             return redirect('response_list')
         
         return redirect(self.get_success_url())
     
     def send_acceptance_notification(self, response):
-        """Отправка уведомления автору отзыва о принятии"""
-        try:
-            if response.author.email:
-                html_content = render_to_string(
-                    'marketplace/response_accepted.html',
-                    {
-                        'response': response,
-                        'post': response.post,
-                    }
-                )
-                
-                msg = EmailMultiAlternatives(
-                    subject=f'Ваш отзыв принят на объявлении "{response.post.title}"',
-                    body=f'Автор объявления "{response.post.title}" принял ваш отзыв.',
-                    from_email='mmo_marketplace@example.com',
-                    to=[response.author.email],
-                )
-                msg.attach_alternative(html_content, "text/html")
-                msg.send()
-                
-        except Exception as e:
-            print(f"Ошибка при отправке уведомления о принятии: {e}")
+        """Постановка в очередь уведомления автору отзыва о принятии"""
+        if response.author.email:
+            html_content = render_to_string(
+                'marketplace/response_accepted.html',
+                {
+                    'response': response,
+                    'post': response.post,
+                }
+            )
+            enqueue_email(
+                subject=f'Ваш отзыв принят на объявлении "{response.post.title}"',
+                body=f'Автор объявления "{response.post.title}" принял ваш отзыв.',
+                recipients=[response.author.email],
+                html_body=html_content,
+                from_email='mmo_marketplace@example.com',
+            )
     
     def get_success_url(self):
         return reverse_lazy('response_list')
@@ -282,4 +422,151 @@ class ResponseDeleteView(LoginRequiredMixin, DeleteView):
         return redirect('response_list')
     
     def get_success_url(self):
-        return reverse_lazy('response_list')   
\ No newline at end of file
+        return reverse_lazy('response_list')
+
+
+class UploadInitView(LoginRequiredMixin, View):
+    """Создание сессии поблочной загрузки медиафайла"""
+    def post(self, request, slug):
+        post = get_object_or_404(Post, slug=slug)
+        if post.author != request.user:
+            return JsonResponse({'error': 'Нет прав на загрузку'}, status=403)
+
+        filename = request.POST.get('filename', '')
+        try:
+            size = int(request.POST.get('size', ''))
+        except ValueError:
+            return JsonResponse({'error': 'Не указан размер файла'}, status=400)
+        if uploads.extension_media_type(filename) is None:
+            return JsonResponse({'error': f'Разрешены только: {", ".join(PostMedia.ALLOWED_EXTENSIONS)}'},
+                                status=400)
+        if not 0 < size <= PostMedia.MAX_SIZE_MB * 1024 * 1024:
+            return JsonResponse({'error': f'Максимальный размер файла: {PostMedia.MAX_SIZE_MB} МБ'},
+                                status=400)
+
+        session = UploadSession.objects.create(post=post, user=request.user,
+                                               filename=os.path.basename(filename), size=size)
+        return JsonResponse({'upload_id': str(session.pk), 'received': 0,
+                             'chunk_size': uploads.upload_chunk_size()}, status=201)
+
+
+class UploadChunkView(LoginRequiredMixin, View):
+    """
+    GET - сколько байт уже получено (для возобновления загрузки),
+    POST ?offset=N - дописать следующую часть (тело запроса - байты части)
+    """
+    def get(self, request, pk):
+        session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+        return JsonResponse({'upload_id': str(session.pk), 'received': session.received,
+                             'size': session.size})
+
+    def post(self, request, pk):
+        session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+        try:
+            offset = int(request.GET.get('offset', ''))
+        except ValueError:
+            return JsonResponse({'error': 'Не указано смещение'}, status=400)
+        if offset != session.received:
+            return JsonResponse({'error': 'Неверное смещение', 'received': session.received},
+                                status=409)
+
+        chunk = request.body
+        if not chunk or len(chunk) > uploads.upload_chunk_size():
+            return JsonResponse({'error': 'Недопустимый размер части'}, status=400)
+        if session.received + len(chunk) > session.size:
+            return JsonResponse({'error': 'Получено больше заявленного размера'}, status=400)
+
+        if offset == 0:
+            # Тип определяем по содержимому, а не по расширению или Content-Type
+            media_type = uploads.sniff_media_type(chunk[:uploads.SIGNATURE_BYTES])
+            if media_type is None or media_type != uploads.extension_media_type(session.filename):
+                session.delete()
+                return JsonResponse({'error': 'Содержимое файла не соответствует изображению или видео'},
+                                    status=400)
+            session.media_type = media_type
+            session.save(update_fields=['media_type'])
+
+        index = session.parts
+        temp = uploads.save_part(session, index, chunk)
+        updated = UploadSession.objects.filter(pk=session.pk, received=offset).update(
+            received=F('received') + len(chunk), parts=F('parts') + 1)
+        if not updated:
+            default_storage.delete(temp)
+            return JsonResponse({'error': 'Часть уже получена'}, status=409)
+        uploads.commit_part(temp, session, index)
+        metrics.UPLOAD_BYTES.inc(len(chunk), source='chunked')
+        return JsonResponse({'upload_id': str(session.pk), 'received': offset + len(chunk)})
+
+
+class UploadCompleteView(LoginRequiredMixin, View):
+    """Сборка файла из частей и создание PostMedia"""
+    def post(self, request, pk):
+        session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+        if session.received != session.size:
+            return JsonResponse({'error': 'Файл загружен не полностью', 'received': session.received},
+                                status=409)
+
+        parts = [uploads.part_name(session, index) for index in range(session.parts)]
+        content = uploads.ChunkedFile(parts, session.size, session.filename)
+        media = PostMedia(post=session.post, file=content)
+        try:
+            media.clean()
+        except ValidationError as e:
+            return JsonResponse({'error': ' '.join(e.messages)}, status=400)
+
+        # Сумма сверяется до создания PostMedia: при несовпадении не должны
+        # срабатывать счётчики, ссылки на blob, превью и сброс кэша ленты
+        sha256 = content.digest()
+        expected = request.POST.get('sha256')
+        if expected and expected.lower() != sha256:
+            return JsonResponse({'error': 'Контрольная сумма не совпадает'}, status=400)
+
+        media.save()
+        session.delete()
+        return JsonResponse({'id': media.pk, 'url': media.file.url,
+                             'size': session.size, 'sha256': sha256}, status=201)
+
+
+class InstrumentationStatsView(LoginRequiredMixin, UserPassesTestMixin, View):
+    """Сводные замеры по представлениям (InstrumentationMiddleware), только для персонала"""
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request):
+        return JsonResponse({'buckets_ms': [str(bound) for bound in BUCKETS],
+                             'views': view_stats.snapshot()})
+
+    def post(self, request):
+        view_stats.reset()
+        return JsonResponse({'reset': True})
+
+
+class MetricsView(View):
+    """
+    Метрики в формате Prometheus. Если задан MARKETPLACE_METRICS_TOKEN,
+    требуется заголовок Authorization: Bearer <токен>.
+    """
+    def get(self, request):
+        token = getattr(settings, 'MARKETPLACE_METRICS_TOKEN', '')
+        if token and not constant_time_compare(request.headers.get('Authorization', ''),
+                                               f'Bearer {token}'):
+            return HttpResponse(status=401, headers={'WWW-Authenticate': 'Bearer'})
+        return HttpResponse(metrics.exposition(), content_type=metrics.CONTENT_TYPE)
+
+
+class MediaFileView(View):
+    """
+    Медиафайлы по MEDIA_URL: диапазоны байт, условные запросы
+    и передача прокси (MARKETPLACE_MEDIA_OFFLOAD), см. media_serving.py
+    """
+    def get(self, request, name):
+        return serve_media(request, name)
+
+
+class StaticFileView(View):
+    """
+    Статика из STATIC_ROOT без прокси (продакшен-профиль, DEBUG выключен):
+    сжатые заранее копии и кэширование на год для имён с хэшем, см. media_serving.py
+    """
+    def get(self, request, name):
+        return serve_static(request, name)
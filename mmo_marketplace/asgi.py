@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mmo_marketplace.settings')
+# Под ASGI страницы чтения обслуживают async-представления
+os.environ.setdefault('MARKETPLACE_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
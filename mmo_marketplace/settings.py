@@ -47,6 +47,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'marketplace.instrumentation.InstrumentationMiddleware',
+    'marketplace.routers.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -87,6 +89,8 @@ DATABASES = {
     }
 }
 
+DATABASE_ROUTERS = ['marketplace.routers.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -123,6 +127,8 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
 STATIC_URL = 'static/'
+# Сюда collectstatic собирает статику (продакшен-профиль ниже)
+STATIC_ROOT = BASE_DIR / 'staticfiles'
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -157,4 +163,129 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
 ACCOUNT_SESSION_REMEMBER = True
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'post_media')
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'post_media')
+
+# Медиафайлы хранятся с дедупликацией по SHA-256 (marketplace/storage.py)
+STORAGES = {
+    'default': {
+        'BACKEND': 'marketplace.storage.DeduplicatingStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
+# Курсорная пагинация (по updated_at, id) для ленты и "Моих объявлений"
+MARKETPLACE_CURSOR_PAGINATION = False
+
+# Кэш ленты для анонимных пользователей, секунды (0 - отключить).
+# Подойдёт любой бэкенд CACHES, например файловый:
+# CACHES = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+#                       'LOCATION': BASE_DIR / 'cache'}}
+MARKETPLACE_LISTING_CACHE_TIMEOUT = 300
+# Сколько секунд браузеры и прокси могут показывать страницу объявления анонимным
+# без проверки ETag (0 - проверять каждый раз, ответ 304 дешёвый)
+MARKETPLACE_POST_DETAIL_MAX_AGE = 0
+# Время жизни HTML карточек ленты (для всех пользователей, 0 - без кэша).
+# Ключ меняется вместе с объявлением, поэтому таймаут может быть большим
+MARKETPLACE_POST_CARD_CACHE_TIMEOUT = 86400
+
+# Очередь писем (python manage.py send_outbox --loop)
+MARKETPLACE_OUTBOX_MAX_ATTEMPTS = 5
+MARKETPLACE_OUTBOX_BACKOFF_SECONDS = 30
+MARKETPLACE_OUTBOX_LEASE_SECONDS = 300
+
+# Сводки отзывов (python manage.py send_digests --loop): не чаще раза в интервал на автора.
+# Адрес сайта - для ссылок в письмах, которые собираются вне запроса
+MARKETPLACE_DIGEST_INTERVAL_SECONDS = 3600
+MARKETPLACE_SITE_URL = os.environ.get('MARKETPLACE_SITE_URL', 'http://localhost:8000')
+
+# Размер части при поблочной загрузке медиафайлов, не больше DATA_UPLOAD_MAX_MEMORY_SIZE
+MARKETPLACE_UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Потоки записи файлов в хранилище при загрузке нескольких медиафайлов (bulk_ingest)
+MARKETPLACE_MEDIA_INGEST_WORKERS = 4
+
+# Отдача медиафайлов (marketplace/media_serving.py). За nginx файлы лучше отдавать
+# самому прокси: MARKETPLACE_MEDIA_OFFLOAD = 'x-accel-redirect' и
+#   location /protected-media/ { internal; alias /путь/к/post_media/; }
+# Для Apache (mod_xsendfile) и lighttpd - 'x-sendfile'.
+MARKETPLACE_MEDIA_OFFLOAD = os.environ.get('MARKETPLACE_MEDIA_OFFLOAD') or None
+MARKETPLACE_MEDIA_ACCEL_PREFIX = '/protected-media/'
+MARKETPLACE_MEDIA_MAX_AGE = 86400
+
+# Превью медиафайлов: генерация в пуле процессов (False - сразу после коммита, в том же процессе)
+MARKETPLACE_DERIVATIVES_ASYNC = True
+MARKETPLACE_DERIVATIVES_WORKERS = 2
+
+# Async-варианты ленты, объявления и списка отзывов; asgi.py включает их по умолчанию
+MARKETPLACE_ASYNC_VIEWS = os.environ.get('MARKETPLACE_ASYNC_VIEWS') == '1'
+
+# Замеры запросов: Server-Timing, лог медленных запросов и N+1, /staff/instrumentation/
+MARKETPLACE_INSTRUMENTATION = True
+MARKETPLACE_SLOW_REQUEST_MS = 500
+MARKETPLACE_NPLUSONE_THRESHOLD = 5
+
+# Метрики Prometheus (/metrics). Под gunicorn с несколькими воркерами задайте
+# общий каталог (PROMETHEUS_MULTIPROC_DIR), очищаемый при перезапуске сервиса.
+# MARKETPLACE_METRICS_TOKEN - необязательный Bearer-токен для сборщика.
+MARKETPLACE_METRICS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR') or None
+MARKETPLACE_METRICS_TOKEN = os.environ.get('MARKETPLACE_METRICS_TOKEN', '')
+
+# Реплики для чтения - псевдонимы из DATABASES, например:
+# DATABASES['replica'] = {'ENGINE': 'django.db.backends.postgresql', 'HOST': 'db-replica', ...,
+#                         'TEST': {'MIRROR': 'default'}}
+# MARKETPLACE_READ_REPLICAS = ['replica']
+# Сколько секунд после своей записи клиент читает с основной базы
+MARKETPLACE_READ_REPLICAS = []
+MARKETPLACE_PRIMARY_PIN_SECONDS = 10
+
+# Профиль SQLite для нагруженного сервера (MARKETPLACE_SQLITE_TUNING=1): WAL - читатели
+# не блокируют запись, synchronous=NORMAL - без fsync на каждый коммит (в WAL это безопасно
+# для целостности), mmap и кэш страниц, ожидание блокировки вместо ошибки "database is
+# locked", BEGIN IMMEDIATE - транзакция сразу берёт блокировку записи и не падает при
+# попытке повысить блокировку чтения, постоянные соединения вместо нового на каждый запрос.
+# Сравнение с настройками по умолчанию: python manage.py sqlite_stress
+MARKETPLACE_SQLITE_PROFILE = {
+    'CONN_MAX_AGE': 600,
+    'CONN_HEALTH_CHECKS': True,
+    'OPTIONS': {
+        'transaction_mode': 'IMMEDIATE',
+        'timeout': 5,  # busy_timeout, секунды
+        'init_command': ';'.join([
+            'PRAGMA journal_mode=WAL',
+            'PRAGMA synchronous=NORMAL',
+            'PRAGMA mmap_size=268435456',
+            'PRAGMA cache_size=-65536',
+            'PRAGMA temp_store=MEMORY',
+        ]),
+    },
+}
+if os.environ.get('MARKETPLACE_SQLITE_TUNING') == '1':
+    DATABASES['default'].update(MARKETPLACE_SQLITE_PROFILE)
+
+# Продакшен-профиль (MARKETPLACE_PRODUCTION=1): без DEBUG, шаблоны компилируются один раз
+# на процесс (cached loader задан явно, без автоперезагрузки), статика собирается
+# python manage.py collectstatic с хэшем содержимого в именах и сжатыми заранее копиями
+# .gz/.br (.br - если установлен пакет brotli). Отдаёт её nginx:
+#   location /static/ { alias /путь/к/staticfiles/; gzip_static on; brotli_static on;
+#                       expires max; }
+# или, без прокси, само приложение (StaticFileView). Сравнение с настройками разработки:
+# python manage.py bench_startup
+MARKETPLACE_CACHED_TEMPLATE_LOADERS = [
+    ('django.template.loaders.cached.Loader', [
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    ]),
+]
+MARKETPLACE_PRODUCTION_STATICFILES = {
+    'BACKEND': 'marketplace.storage.CompressedManifestStaticFilesStorage',
+}
+# Сколько секунд кэшируются файлы статики с хэшем в имени
+MARKETPLACE_STATIC_MAX_AGE = 365 * 24 * 3600
+if os.environ.get('MARKETPLACE_PRODUCTION') == '1':
+    DEBUG = False
+    SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY', SECRET_KEY)
+    ALLOWED_HOSTS = os.environ.get('DJANGO_ALLOWED_HOSTS', 'localhost').split(',')
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = MARKETPLACE_CACHED_TEMPLATE_LOADERS
+    STORAGES['staticfiles'] = MARKETPLACE_PRODUCTION_STATICFILES
@@ -16,14 +16,17 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.conf import settings
-from django.conf.urls.static import static
 from django.urls import path, include
 
+from marketplace.views import MediaFileView, StaticFileView
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('accounts/', include('allauth.urls')),
     path('', include('marketplace.urls')),
+    # Медиафайлы отдаёт приложение (или прокси по X-Accel-Redirect) и без DEBUG
+    path(f'{settings.MEDIA_URL.lstrip("/")}<path:name>', MediaFileView.as_view(), name='media_file'),
+    # Собранная статика; с DEBUG её раньше перехватывает runserver (django.contrib.staticfiles)
+    path(f'{settings.STATIC_URL.lstrip("/")}<path:name>', StaticFileView.as_view(),
+         name='static_file'),
     ]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)